@@ -12,6 +12,7 @@ from datetime import datetime
 
 from app.dependencies import get_current_user, get_db
 from app.models import User
+from app.services.org_config_service import invalidate_org_config
 
 router = APIRouter()
 
@@ -103,6 +104,7 @@ async def register_bridge(
     if org:
         org.wppconnect_bridge_url = registration.bridge_url
         db.commit()
+        invalidate_org_config(db, org.id)
         
         return {
             "success": True,
@@ -175,6 +177,7 @@ async def disconnect_bridge(
         org.wppconnect_bridge_url = None
         org.updated_at = datetime.utcnow()
         db.commit()
+        invalidate_org_config(db, current_user.organization_id)
         
         return {
             "success": True,
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Query
-import httpx
 from bs4 import BeautifulSoup
 from urllib.parse import quote_plus
 import re
 
+from app.services.http_client_service import get_generic_http_client
+
 router = APIRouter()
 
 
@@ -24,8 +25,8 @@ async def browse_url(
         url = f"https://html.duckduckgo.com/html/?q={quote_plus(q)}"
 
     try:
-        async with httpx.AsyncClient(timeout=10.0, follow_redirects=True) as client:
-            resp = await client.get(url, headers=headers)
+        client = get_generic_http_client()
+        resp = await client.get(url, headers=headers, timeout=10.0, follow_redirects=True)
             
         if resp.status_code != 200:
             return {"error": f"Failed to retrieve content (status {resp.status_code})"}
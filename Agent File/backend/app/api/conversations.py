@@ -1,6 +1,7 @@
 """
 Conversations API Endpoints
-Handles chat status triage (open, escalated, resolved) and human handover AI pause controls
+Handles chat status triage (open, escalated, resolved), human handover AI pause controls
+and the precomputed reply drafts of "suggest" mode
 """
 
 from fastapi import APIRouter, Depends, HTTPException, status, Query
@@ -16,6 +17,7 @@ from app.dependencies import get_current_active_user
 from app.models.user import User
 from app.models.contact import Contact
 from app.models.message import Message
+from app.services.reply_draft_service import get_reply_draft
 
 router = APIRouter(prefix="/api/conversations", tags=["Conversations"])
 
@@ -131,3 +133,17 @@ async def toggle_ai_pause(
         "ai_paused": req.paused,
         "ai_paused_until": contact.ai_paused_until.isoformat() if contact.ai_paused_until else None
     }
+
+
+@router.get("/{contact_id}/draft")
+async def get_conversation_draft(
+    contact_id: str,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Suggested reply and proposed action for the contact's latest message (suggest mode)."""
+    try:
+        contact_uuid = UUID(contact_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Contact not found")
+    return {"contact_id": contact_id, **get_reply_draft(db, current_user.organization_id, contact_uuid)}
@@ -7,6 +7,8 @@ from app.models.knowledge import KnowledgeResource
 from app.models.user import User
 from app.schemas.knowledge import KnowledgeResourceCreate, KnowledgeResourceResponse
 from app.dependencies import get_current_active_user
+from app.services.org_config_service import invalidate_org_config
+from app.services.reply_cache_service import bump_knowledge_version
 
 router = APIRouter()
 
@@ -56,6 +58,12 @@ async def create_resource(
         await index_resource(db, str(new_resource.id))
     except Exception as rag_err:
         print(f"Error indexing resource: {rag_err}")
+        db.rollback()
+
+    # Bumped after indexing so no reply gets cached against a half-indexed KB
+    bump_knowledge_version(db, current_user.organization_id)
+    db.commit()
+    invalidate_org_config(db, current_user.organization_id)
     
     return KnowledgeResourceResponse.model_validate(new_resource)
 
@@ -100,5 +108,7 @@ async def delete_resource(
         )
         
     db.delete(resource)
+    bump_knowledge_version(db, current_user.organization_id)
     db.commit()
+    invalidate_org_config(db, current_user.organization_id)
     return None
@@ -144,6 +144,8 @@ async def generate_ai_message(
     """Generate an AI message for a contact."""
     from app.services.ai_service import generate_message
     from app.services.rag_service import search_knowledge_base
+    from app.services.ai_rate_limiter import AIRateLimitExceeded, PRIORITY_BULK
+    from app.services.org_config_service import get_org_config
     from app.models.organization import Organization
     
     # Get contact
@@ -184,17 +186,28 @@ async def generate_ai_message(
         {"org_id": str(current_user.organization_id)}
     ).fetchone()
     
-    message_text = await generate_message(
-        contact_name=contact.name,
-        contact_category=contact.category,
-        context=final_context,
-        tone=tone,
-        sender_name=current_user.full_name or "Pastor",
-        organization_name=org.name if org else "Church",
-        ai_provider=ai_config_result[0] if ai_config_result else "gemini",
-        ai_api_key=ai_config_result[1] if ai_config_result else None,
-        ai_model=ai_config_result[2] if ai_config_result else "gemini-2.0-flash",
-        ai_base_url=ai_config_result[3] if ai_config_result else None
-    )
+    org_config = get_org_config(db, current_user.organization_id)
+
+    try:
+        message_text = await generate_message(
+            contact_name=contact.name,
+            contact_category=contact.category,
+            context=final_context,
+            tone=tone,
+            sender_name=current_user.full_name or "Pastor",
+            organization_name=org.name if org else "Church",
+            ai_provider=ai_config_result[0] if ai_config_result else "gemini",
+            ai_api_key=ai_config_result[1] if ai_config_result else None,
+            ai_model=ai_config_result[2] if ai_config_result else "gemini-2.0-flash",
+            ai_base_url=ai_config_result[3] if ai_config_result else None,
+            rate_limits=org_config.rate_limits() if org_config else None,
+            priority=PRIORITY_BULK
+        )
+    except AIRateLimitExceeded as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(int(e.retry_after))}
+        )
     
     return {"content": message_text}
@@ -0,0 +1,92 @@
+"""
+Metrics API Endpoints
+Exposes in-process pipeline metrics, DB pool pressure and agent job queue depth for monitoring,
+a Prometheus scrape endpoint and the slowest recent agent replies with their stage breakdown.
+
+The summary and Prometheus endpoints report on the whole process (every org), so they
+need an admin user; the Prometheus endpoint also accepts settings.metrics_token as a
+bearer token so a scraper does not need a user session. Per-provider LLM stats are not
+exposed here at all, since they describe other orgs' credentials. Slow replies are
+limited to the caller's organization.
+"""
+
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import get_db, get_pool_stats
+from app.dependencies import get_current_active_user, get_current_admin_user, get_current_user_optional
+from app.models import User
+from app.utils.metrics import metrics
+from app.utils.tracing import recent_replies
+from app.services.reply_cache_service import get_reply_cache_stats
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/metrics", tags=["Metrics"])
+
+
+async def require_scrape_access(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False)),
+    db: Session = Depends(get_db)
+):
+    """The metrics token (Prometheus) or an admin user's JWT."""
+    token = credentials.credentials if credentials else ""
+    if settings.metrics_token and hmac.compare_digest(token.encode("utf-8"), settings.metrics_token.encode("utf-8")):
+        return
+    user = await get_current_user_optional(credentials, db) if credentials else None
+    if user and user.role == "admin":
+        return
+    if user:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin role required")
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+@router.get("/")
+async def get_metrics(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Counters, gauges and latency histograms for this worker plus shared queue depth (admins only)."""
+    from app.services.agent_queue_service import get_queue_stats
+    try:
+        queue = get_queue_stats(db)
+    except Exception as e:
+        logger.warning(f"Agent queue stats unavailable: {e}")
+        queue = {"error": str(e)}
+
+    return {
+        "agent_queue": queue,
+        "db_pool": get_pool_stats(),
+        "reply_cache": get_reply_cache_stats(),
+        "llm_calls_avoided": {
+            reason: metrics.get_counter("llm_calls_avoided", reason=reason)
+            for reason in ("fast_path", "reply_cache")
+        },
+        **metrics.snapshot()
+    }
+
+
+@router.get("/prometheus", response_class=PlainTextResponse, dependencies=[Depends(require_scrape_access)])
+async def get_prometheus_metrics():
+    """This worker's counters, gauges and histograms in the Prometheus text format."""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/slow-replies")
+async def get_slow_replies(
+    limit: int = Query(20, ge=1, le=200),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Slowest of the organization's agent replies among this worker's recent ones, with per-stage timings."""
+    return {"replies": recent_replies.slowest(limit, org_id=str(current_user.organization_id))}
@@ -5,16 +5,22 @@ Manages user/organization settings for AI and WhatsApp configuration
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import List, Optional
+import json
 from datetime import datetime
 
 from app.dependencies import get_current_user, get_db
 from app.models import User, Organization
 from app.schemas.ai_config import (
-    AIConfigCreate, AIConfigUpdate, AIConfigResponse, AIConfigTest,
+    AIFallbackProvider, AIConfigCreate, AIConfigUpdate, AIConfigResponse, AIConfigTest,
     WhatsAppMetaConfig, WhatsAppMetaConfigResponse
 )
 from app.services.ai_provider_service import ai_provider_service
+from app.services.org_config_service import invalidate_org_config
+from app.services.reply_cache_service import clear_reply_cache, get_org_reply_cache_summary
+from app.services.intent_router_service import DEFAULT_QUICK_REPLIES, parse_quick_replies
+from app.services.transcription_job_service import WHISPER_LANGUAGES
+from app.config import settings as app_settings
 from sqlalchemy import text
 import logging
 
@@ -22,6 +28,18 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/settings", tags=["settings"])
 
+# Below this the static prompt prefix alone would not fit
+MIN_PROMPT_TOKEN_BUDGET = 1500
+# Looser thresholds start matching different questions
+MIN_REPLY_CACHE_THRESHOLD = 0.8
+
+
+def _effective_quick_replies(raw: Optional[str]) -> dict:
+    """Fast-path templates per intent: the org's overrides on top of the built-in defaults."""
+    templates = {intent: list(defaults) for intent, defaults in DEFAULT_QUICK_REPLIES.items()}
+    templates.update({intent: list(overrides) for intent, overrides in parse_quick_replies(raw)})
+    return templates
+
 
 def mask_api_key(key: str) -> str:
     """Mask API key for security (show only last 4 characters)"""
@@ -30,6 +48,46 @@ def mask_api_key(key: str) -> str:
     return f"***{key[-4:]}"
 
 
+def _load_fallback_chain(raw: Optional[str]) -> List[dict]:
+    try:
+        chain = json.loads(raw) if raw else []
+    except (TypeError, ValueError):
+        return []
+    return chain if isinstance(chain, list) else []
+
+
+def _merge_fallback_keys(chain: List[AIFallbackProvider], existing: List[dict]) -> List[dict]:
+    """
+    Keep stored keys for entries the client sent back masked. A masked entry is matched
+    to a stored one by provider and key fingerprint (the last 4 characters the mask
+    shows), then by model when that is still ambiguous - never by position, since the
+    client may have reordered or removed entries. A mask that matches no stored key
+    (or several different ones) is rejected rather than saved as "***".
+    """
+    merged = []
+    for entry in chain:
+        data = entry.model_dump()
+        if data["api_key"].startswith("***"):
+            fingerprint = data["api_key"][3:]
+            candidates = [
+                stored for stored in existing
+                if stored.get("provider") == entry.provider and stored.get("api_key")
+                and mask_api_key(stored["api_key"]) == data["api_key"]
+            ]
+            if len({stored["api_key"] for stored in candidates}) > 1:
+                candidates = [stored for stored in candidates if (stored.get("model") or "") == entry.model]
+            keys = {stored["api_key"] for stored in candidates}
+            if len(keys) != 1:
+                shown = f"key ending in {fingerprint}" if fingerprint else "masked key"
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Fallback provider {entry.provider}: {shown} does not match a saved key, enter the full key",
+                )
+            data["api_key"] = keys.pop()
+        merged.append(data)
+    return merged
+
+
 @router.get("/ai-config")
 async def get_ai_config(
     db: Session = Depends(get_db),
@@ -42,7 +100,10 @@ async def get_ai_config(
     # Query organization for AI config
     result = db.execute(
         text("""
-            SELECT ai_provider, ai_api_key, ai_model, ai_base_url
+            SELECT ai_provider, ai_api_key, ai_model, ai_base_url, ai_prompt_token_budget,
+                   ai_fallback_chain, ai_hedge_enabled,
+                   ai_rate_limit_rpm, ai_rate_limit_tpm, ai_max_concurrency,
+                   ai_reply_cache_enabled, ai_reply_cache_threshold
             FROM organizations
             WHERE id = :org_id
         """),
@@ -56,6 +117,15 @@ async def get_ai_config(
             "api_key_masked": "",
             "model": "gemini-2.0-flash",
             "base_url": None,
+            "prompt_token_budget": app_settings.agent_prompt_token_budget,
+            "fallback_chain": [],
+            "hedge_enabled": False,
+            "rate_limit_rpm": app_settings.ai_rate_limit_rpm,
+            "rate_limit_tpm": app_settings.ai_rate_limit_tpm,
+            "max_concurrency": app_settings.ai_max_concurrency,
+            "reply_cache_enabled": False,
+            "reply_cache_threshold": app_settings.reply_cache_similarity_threshold,
+            "reply_cache": {"entries": 0, "hits": 0},
             "configured": False
         }
     
@@ -64,6 +134,18 @@ async def get_ai_config(
         "api_key_masked": mask_api_key(result[1]),
         "model": result[2] or "gemini-2.0-flash",
         "base_url": result[3],
+        "prompt_token_budget": int(result[4]) if result[4] else app_settings.agent_prompt_token_budget,
+        "fallback_chain": [
+            {**entry, "api_key": mask_api_key(entry.get("api_key"))}
+            for entry in _load_fallback_chain(result[5])
+        ],
+        "hedge_enabled": str(result[6]).lower() == "true",
+        "rate_limit_rpm": int(result[7]) if result[7] else app_settings.ai_rate_limit_rpm,
+        "rate_limit_tpm": int(result[8]) if result[8] else app_settings.ai_rate_limit_tpm,
+        "max_concurrency": int(result[9]) if result[9] else app_settings.ai_max_concurrency,
+        "reply_cache_enabled": str(result[10]).lower() == "true",
+        "reply_cache_threshold": float(result[11]) if result[11] else app_settings.reply_cache_similarity_threshold,
+        "reply_cache": get_org_reply_cache_summary(db, current_user.organization_id),
         "configured": True
     }
 
@@ -80,22 +162,48 @@ async def update_ai_config(
     """
     logger.info(f"User {current_user.id} updating AI config: provider={config.provider}")
     
+    if config.prompt_token_budget is not None and config.prompt_token_budget < MIN_PROMPT_TOKEN_BUDGET:
+        raise HTTPException(status_code=400, detail=f"prompt_token_budget must be at least {MIN_PROMPT_TOKEN_BUDGET}")
+    for field_name in ("rate_limit_rpm", "rate_limit_tpm", "max_concurrency"):
+        value = getattr(config, field_name)
+        if value is not None and value < 1:
+            raise HTTPException(status_code=400, detail=f"{field_name} must be a positive integer")
+    if config.reply_cache_threshold is not None and not MIN_REPLY_CACHE_THRESHOLD <= config.reply_cache_threshold <= 1:
+        raise HTTPException(status_code=400, detail=f"reply_cache_threshold must be between {MIN_REPLY_CACHE_THRESHOLD} and 1")
+
     try:
+        existing = db.execute(
+            text("SELECT ai_api_key, ai_fallback_chain FROM organizations WHERE id = :org_id"),
+            {"org_id": str(current_user.organization_id)}
+        ).fetchone()
+
         api_key = config.api_key
         if api_key and api_key.startswith("***"):
-            existing = db.execute(
-                text("SELECT ai_api_key FROM organizations WHERE id = :org_id"),
-                {"org_id": str(current_user.organization_id)}
-            ).fetchone()
             if existing and existing[0]:
                 api_key = existing[0]
 
+        fallback_chain = None
+        if config.fallback_chain is not None:
+            fallback_chain = json.dumps(
+                _merge_fallback_keys(config.fallback_chain, _load_fallback_chain(existing[1] if existing else None))
+            )
+        hedge_enabled = None if config.hedge_enabled is None else ("true" if config.hedge_enabled else "false")
+        reply_cache_enabled = None if config.reply_cache_enabled is None else ("true" if config.reply_cache_enabled else "false")
+
         # Update organization AI config
         db.execute(
             text("""
                 UPDATE organizations
                 SET ai_provider = :provider, ai_api_key = :api_key, 
-                    ai_model = :model, ai_base_url = :base_url
+                    ai_model = :model, ai_base_url = :base_url,
+                    ai_prompt_token_budget = COALESCE(:prompt_token_budget, ai_prompt_token_budget),
+                    ai_fallback_chain = COALESCE(:fallback_chain, ai_fallback_chain),
+                    ai_hedge_enabled = COALESCE(:hedge_enabled, ai_hedge_enabled),
+                    ai_rate_limit_rpm = COALESCE(:rate_limit_rpm, ai_rate_limit_rpm),
+                    ai_rate_limit_tpm = COALESCE(:rate_limit_tpm, ai_rate_limit_tpm),
+                    ai_max_concurrency = COALESCE(:max_concurrency, ai_max_concurrency),
+                    ai_reply_cache_enabled = COALESCE(:reply_cache_enabled, ai_reply_cache_enabled),
+                    ai_reply_cache_threshold = COALESCE(:reply_cache_threshold, ai_reply_cache_threshold)
                 WHERE id = :org_id
             """),
             {
@@ -103,10 +211,21 @@ async def update_ai_config(
                 "api_key": api_key,
                 "model": config.model,
                 "base_url": config.base_url,
+                "prompt_token_budget": str(config.prompt_token_budget) if config.prompt_token_budget else None,
+                "fallback_chain": fallback_chain,
+                "hedge_enabled": hedge_enabled,
+                "rate_limit_rpm": str(config.rate_limit_rpm) if config.rate_limit_rpm else None,
+                "rate_limit_tpm": str(config.rate_limit_tpm) if config.rate_limit_tpm else None,
+                "max_concurrency": str(config.max_concurrency) if config.max_concurrency else None,
+                "reply_cache_enabled": reply_cache_enabled,
+                "reply_cache_threshold": str(config.reply_cache_threshold) if config.reply_cache_threshold else None,
                 "org_id": str(current_user.organization_id)
             }
         )
+        # A different provider or model may answer differently
+        clear_reply_cache(db, current_user.organization_id)
         db.commit()
+        invalidate_org_config(db, current_user.organization_id)
         logger.info(f"Updated AI config for org {current_user.organization_id}")
         
         return {
@@ -116,6 +235,8 @@ async def update_ai_config(
             "api_key_masked": mask_api_key(config.api_key)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         logger.error(f"Error saving AI config: {str(e)}")
@@ -163,7 +284,9 @@ async def delete_ai_config(
             """),
             {"org_id": str(current_user.organization_id)}
         )
+        clear_reply_cache(db, current_user.organization_id)
         db.commit()
+        invalidate_org_config(db, current_user.organization_id)
         
         logger.info(f"Deleted AI config for org {current_user.organization_id}")
         return {"success": True, "message": "AI configuration deleted"}
@@ -239,6 +362,7 @@ async def update_whatsapp_meta_config(
             }
         )
         db.commit()
+        invalidate_org_config(db, current_user.organization_id)
         
         logger.info(f"Updated WhatsApp Meta config for org {current_user.organization_id}")
         
@@ -295,6 +419,7 @@ async def update_bridge_config(
             }
         )
         db.commit()
+        invalidate_org_config(db, current_user.organization_id)
         
         logger.info(f"Updated bridge URL for org {current_user.organization_id}: {bridge_url}")
         
@@ -320,7 +445,9 @@ async def get_ai_autopilot_settings(
     """Get AI auto-reply and autopilot configuration for the organization"""
     result = db.execute(
         text("""
-            SELECT ai_auto_reply_enabled, ai_reply_mode, ai_reply_delay_seconds, ai_tone, ai_payment_link, ai_business_type, ai_voice_reply_mode, ai_voice_name
+            SELECT ai_auto_reply_enabled, ai_reply_mode, ai_reply_delay_seconds, ai_tone, ai_payment_link, ai_business_type, ai_voice_reply_mode, ai_voice_name,
+                   ai_fast_path_enabled, ai_quick_replies, ai_transcription_language,
+                   ai_reply_drafts_enabled
             FROM organizations
             WHERE id = :org_id
         """),
@@ -336,7 +463,11 @@ async def get_ai_autopilot_settings(
             "payment_link": "",
             "business_type": "Organization",
             "voice_reply_mode": "text",
-            "voice_name": "en-NG-EzinneNeural"
+            "voice_name": "en-NG-EzinneNeural",
+            "fast_path_enabled": True,
+            "quick_replies": _effective_quick_replies(None),
+            "transcription_language": "",
+            "reply_drafts_enabled": False
         }
 
     return {
@@ -347,7 +478,11 @@ async def get_ai_autopilot_settings(
         "payment_link": result[4] or "",
         "business_type": result[5] or "Organization",
         "voice_reply_mode": result[6] or "text",
-        "voice_name": result[7] or "en-NG-EzinneNeural"
+        "voice_name": result[7] or "en-NG-EzinneNeural",
+        "fast_path_enabled": str(result[8]).lower() != "false",
+        "quick_replies": _effective_quick_replies(result[9]),
+        "transcription_language": result[10] or "",
+        "reply_drafts_enabled": str(result[11]).lower() == "true"
     }
 
 
@@ -367,6 +502,30 @@ async def update_ai_autopilot_settings(
         business_type = settings_data.get("business_type", "Organization")
         voice_reply_mode = settings_data.get("voice_reply_mode", "text")
         voice_name = settings_data.get("voice_name", "en-NG-EzinneNeural")
+        # Optional: omitted keys keep their current value
+        fast_path_enabled = None
+        if "fast_path_enabled" in settings_data:
+            fast_path_enabled = "true" if settings_data["fast_path_enabled"] in [True, "true", "True", 1] else "false"
+        reply_drafts_enabled = None
+        if "reply_drafts_enabled" in settings_data:
+            reply_drafts_enabled = "true" if settings_data["reply_drafts_enabled"] in [True, "true", "True", 1] else "false"
+        quick_replies = None
+        if settings_data.get("quick_replies") is not None:
+            if not isinstance(settings_data["quick_replies"], dict):
+                raise HTTPException(status_code=400, detail="quick_replies must be an object of intent -> template(s)")
+            unknown = set(settings_data["quick_replies"]) - set(DEFAULT_QUICK_REPLIES)
+            if unknown:
+                raise HTTPException(status_code=400, detail=f"Unknown quick reply intents: {', '.join(sorted(unknown))}")
+            quick_replies = json.dumps(settings_data["quick_replies"])
+        # "" clears the hint (detect the language of every voice note)
+        transcription_language = None
+        if settings_data.get("transcription_language") is not None:
+            transcription_language = str(settings_data["transcription_language"]).strip().lower()
+            if transcription_language and transcription_language not in WHISPER_LANGUAGES:
+                raise HTTPException(
+                    status_code=400,
+                    detail="transcription_language must be a language code Whisper supports, such as 'en', 'yo' or 'ha'"
+                )
 
         db.execute(
             text("""
@@ -378,7 +537,11 @@ async def update_ai_autopilot_settings(
                     ai_payment_link = :payment_link,
                     ai_business_type = :business_type,
                     ai_voice_reply_mode = :voice_reply_mode,
-                    ai_voice_name = :voice_name
+                    ai_voice_name = :voice_name,
+                    ai_fast_path_enabled = COALESCE(:fast_path_enabled, ai_fast_path_enabled),
+                    ai_quick_replies = COALESCE(:quick_replies, ai_quick_replies),
+                    ai_transcription_language = NULLIF(COALESCE(:transcription_language, ai_transcription_language), ''),
+                    ai_reply_drafts_enabled = COALESCE(:reply_drafts_enabled, ai_reply_drafts_enabled)
                 WHERE id = :org_id
             """),
             {
@@ -390,10 +553,17 @@ async def update_ai_autopilot_settings(
                 "business_type": business_type,
                 "voice_reply_mode": voice_reply_mode,
                 "voice_name": voice_name,
+                "fast_path_enabled": fast_path_enabled,
+                "quick_replies": quick_replies,
+                "transcription_language": transcription_language,
+                "reply_drafts_enabled": reply_drafts_enabled,
                 "org_id": str(current_user.organization_id)
             }
         )
+        # Tone, payment link and business type shape every reply
+        clear_reply_cache(db, current_user.organization_id)
         db.commit()
+        invalidate_org_config(db, current_user.organization_id)
 
         return {
             "success": True,
@@ -403,6 +573,8 @@ async def update_ai_autopilot_settings(
             "voice_reply_mode": voice_reply_mode,
             "voice_name": voice_name
         }
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         logger.error(f"Error updating AI autopilot settings: {e}")
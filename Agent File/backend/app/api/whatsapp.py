@@ -12,11 +12,15 @@ from typing import Optional
 from datetime import datetime
 from uuid import UUID
 from sqlalchemy import text
+import json
 
+from app.config import settings
 from app.dependencies import get_current_user, get_db
 from app.models import User, Message, Contact
 from app.services.whatsapp_service import get_whatsapp_service
 from app.services.meta_whatsapp_service import get_meta_whatsapp_service
+from app.services.http_client_service import get_http_client
+from app.services.org_config_service import get_org_config
 import logging
 
 logger = logging.getLogger(__name__)
@@ -46,42 +50,15 @@ class WhatsAppMediaSend(BaseModel):
 def get_organization_whatsapp_config(db: Session, org_id: UUID) -> dict:
     """
     Get WhatsApp configuration for organization
-    Returns delivery method and credentials
+    Returns delivery method and credentials (from the cached org config snapshot)
     """
-    result = db.execute(
-        text("""
-            SELECT 
-                wppconnect_bridge_url,
-                whatsapp_phone_id,
-                whatsapp_business_account_id,
-                whatsapp_access_token
-            FROM organizations 
-            WHERE id = :org_id
-        """),
-        {"org_id": str(org_id)}
-    ).fetchone()
-    
-    if not result:
+    config = get_org_config(db, org_id)
+    if not config:
         return {
             "delivery_method": "wppconnect",
             "bridge_url": "http://localhost:3001"
         }
-    
-    # Determine delivery method based on what's configured
-    has_meta = result[1] and result[3]  # Has phone_id and access_token
-    has_wppconnect = result[0]
-    
-    if has_meta:
-        return {
-            "delivery_method": "meta",
-            "phone_number_id": result[1],
-            "access_token": result[3]
-        }
-    else:
-        return {
-            "delivery_method": "wppconnect",
-            "bridge_url": result[0] or "http://localhost:3001"
-        }
+    return config.whatsapp_config()
 
 
 @router.get("/status")
@@ -310,6 +287,30 @@ async def send_whatsapp_media(
         }
 
 
+@router.post("/transcription-callback")
+async def transcription_callback(request: Request, db: Session = Depends(get_db)):
+    """
+    Result of an asynchronous voice note transcription, POSTed by the transcription
+    service's job API and signed with the shared service key. Wakes the parked reply.
+    """
+    from app.services.transcription_job_service import verify_callback_signature, record_transcription_callback
+    from app.services.agent_queue_service import notify_agent_workers
+
+    body = await request.body()
+    if not verify_callback_signature(body, request.headers.get("X-Transcribe-Signature")):
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    attached = record_transcription_callback(db, data)
+    if attached:
+        notify_agent_workers()
+    logger.info(f"🎙️ Transcription callback for job {data.get('job_id')} ({data.get('status')}): {'resuming reply' if attached else 'nothing waiting'}")
+    return {"status": "ok", "resumed": attached}
+
+
 @router.get("/webhook")
 async def verify_whatsapp_webhook(
     request: Request,
@@ -337,30 +338,31 @@ async def verify_whatsapp_webhook(
     return {"status": "ok"}
 
 
-async def _async_trigger_reply(
-    contact_id: UUID,
-    content: str,
-    org_id: UUID,
-    audio_media_id: Optional[str] = None,
-    audio_mime_type: str = "audio/ogg"
-):
-    """Background task to run AI agent auto-reply so Meta webhook responds immediately."""
-    from app.database import SessionLocal
-    from app.services.agent_service import trigger_ai_agent_reply
-    db_bg = SessionLocal()
+def get_ai_reply_delay_seconds(db: Session, org_id: UUID) -> int:
+    """Org's ai_reply_delay_seconds (stored as text), clamped to the coalescing window."""
     try:
-        await trigger_ai_agent_reply(
-            contact_id=contact_id,
-            incoming_text=content,
-            org_id=org_id,
-            db=db_bg,
-            audio_media_id=audio_media_id,
-            audio_mime_type=audio_mime_type
-        )
-    except Exception as agent_err:
-        logger.error(f"Error in background AI agent auto-reply: {agent_err}", exc_info=True)
-    finally:
-        db_bg.close()
+        config = get_org_config(db, org_id)
+    except Exception as e:
+        logger.warning(f"Could not read ai_reply_delay_seconds for org {org_id}: {e}")
+        return 0
+    delay = config.ai_reply_delay_seconds if config else 0
+    return max(0, min(delay, settings.agent_coalesce_max_wait_seconds))
+
+
+def wants_reply_draft(db: Session, org_id: UUID) -> bool:
+    """
+    Suggest-mode orgs with the agent on that opted in to reply drafts get a stored draft
+    for the operator instead of an auto-sent reply. Everyone else keeps auto-sending.
+    """
+    try:
+        config = get_org_config(db, org_id)
+    except Exception as e:
+        logger.warning(f"Could not read ai_reply_mode for org {org_id}: {e}")
+        return False
+    return bool(
+        config and config.ai_auto_reply_enabled and config.ai_reply_drafts_enabled
+        and config.ai_reply_mode == "suggest"
+    )
 
 
 async def process_received_message(
@@ -456,21 +458,42 @@ async def process_received_message(
         message.attachment_type = media_type
         
     db.add(message)
-    db.commit()
-    logger.info(f"✅ Incoming message saved for contact {contact.name} (ID: {contact.id}) in organization {org_id}")
-
-    # Trigger 24/7 Cloud AI Agent auto-reply in background as async task
-    # so Meta Webhook immediately gets HTTP 200 and never retries in a loop
-    import asyncio
-    asyncio.create_task(
-        _async_trigger_reply(
+    db.flush()
+
+    # Queue the 24/7 Cloud AI Agent auto-reply as a durable job in the same transaction,
+    # so Meta Webhook immediately gets HTTP 200 and the reply survives restarts.
+    # Messages sent in quick succession land in the contact's mailbox and get one reply.
+    # Orgs that opted in to reply drafts (suggest mode) get a draft for the operator
+    # instead (the new message also invalidates the previous draft).
+    from app.services.agent_queue_service import enqueue_inbound_message, notify_agent_workers
+    entry = {
+        "message_id": str(message.id),
+        "content": content,
+        "audio_media_id": audio_media_id,
+        "audio_mime_type": audio_mime_type
+    }
+    if wants_reply_draft(db, org_id):
+        from app.services.reply_draft_service import mark_draft_pending
+        mark_draft_pending(db, org_id, contact.id, message.id)
+        enqueue_inbound_message(
+            db,
+            org_id=org_id,
             contact_id=contact.id,
-            content=content,
+            entry=entry,
+            delay_seconds=settings.agent_draft_delay_seconds,
+            job_type="draft"
+        )
+    else:
+        enqueue_inbound_message(
+            db,
             org_id=org_id,
-            audio_media_id=audio_media_id,
-            audio_mime_type=audio_mime_type
+            contact_id=contact.id,
+            entry=entry,
+            delay_seconds=get_ai_reply_delay_seconds(db, org_id)
         )
-    )
+    db.commit()
+    notify_agent_workers()
+    logger.info(f"✅ Incoming message saved for contact {contact.name} (ID: {contact.id}) in organization {org_id}")
 
     return contact.id, message.id
 
@@ -682,31 +705,31 @@ async def get_whatsapp_media(
     # 3. Request the media metadata from Meta
     import httpx
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            meta_url = f"https://graph.facebook.com/v18.0/{media_id}"
-            headers = {"Authorization": f"Bearer {access_token}"}
+        client = get_http_client("https://graph.facebook.com")
+        meta_url = f"https://graph.facebook.com/v18.0/{media_id}"
+        headers = {"Authorization": f"Bearer {access_token}"}
             
-            res = await client.get(meta_url, headers=headers)
-            if res.status_code != 200:
-                logger.error(f"Meta media info request failed with status {res.status_code}: {res.text}")
-                raise HTTPException(status_code=res.status_code, detail="Failed to fetch media metadata from Meta")
+        res = await client.get(meta_url, headers=headers, timeout=15.0)
+        if res.status_code != 200:
+            logger.error(f"Meta media info request failed with status {res.status_code}: {res.text}")
+            raise HTTPException(status_code=res.status_code, detail="Failed to fetch media metadata from Meta")
                 
-            media_info = res.json()
-            download_url = media_info.get("url")
-            mime_type = media_info.get("mime_type", "application/octet-stream")
+        media_info = res.json()
+        download_url = media_info.get("url")
+        mime_type = media_info.get("mime_type", "application/octet-stream")
             
-            if not download_url:
-                logger.error("Meta media info response did not contain a download URL")
-                raise HTTPException(status_code=500, detail="Meta API did not return download URL")
+        if not download_url:
+            logger.error("Meta media info response did not contain a download URL")
+            raise HTTPException(status_code=500, detail="Meta API did not return download URL")
                 
-            # 4. Download the actual binary file from Meta
-            file_res = await client.get(download_url, headers=headers)
-            if file_res.status_code != 200:
-                logger.error(f"Meta media download request failed with status {file_res.status_code}")
-                raise HTTPException(status_code=file_res.status_code, detail="Failed to download file content from Meta")
+        # 4. Download the actual binary file from Meta (served from a different CDN host)
+        file_res = await get_http_client(download_url).get(download_url, headers=headers, timeout=15.0)
+        if file_res.status_code != 200:
+            logger.error(f"Meta media download request failed with status {file_res.status_code}")
+            raise HTTPException(status_code=file_res.status_code, detail="Failed to download file content from Meta")
                 
-            # 5. Return the file content with the correct mime type
-            return Response(content=file_res.content, media_type=mime_type)
+        # 5. Return the file content with the correct mime type
+        return Response(content=file_res.content, media_type=mime_type)
             
     except httpx.TimeoutException:
         logger.error("Timeout connecting to Meta WhatsApp API for media download")
@@ -18,6 +18,11 @@ class Settings(BaseSettings):
     # AI - Optional, users provide their own keys
     gemini_api_key: Optional[str] = None
     google_embedding_api_key: Optional[str] = None
+    gemini_max_concurrency: int = 16  # concurrent Gemini calls per app process
+    gemini_context_cache_enabled: bool = False  # explicit (billed) cached content; implicit caching works without it
+    gemini_context_cache_ttl_seconds: int = 3600
+    gemini_context_cache_max_entries: int = 256  # prefixes remembered per process (LRU)
+    gemini_context_cache_min_tokens: int = 1024  # below the model minimum the API rejects the cache
     
     # WhatsApp
     whatsapp_api_url: str = "https://graph.facebook.com/v18.0"
@@ -26,6 +31,84 @@ class Settings(BaseSettings):
     whatsapp_verify_token: str = "shepherd_ai_verify_token"
     meta_app_secret: str = ""
     
+    # Agent job queue (durable auto-reply workers)
+    agent_worker_concurrency: int = 4
+    agent_job_max_attempts: int = 3
+    agent_job_retry_backoff_seconds: float = 5.0
+    agent_job_poll_interval_seconds: float = 2.0
+    agent_job_lock_timeout_seconds: int = 300  # running jobs refresh their lock every third of this
+    agent_job_drain_timeout_seconds: float = 20.0
+    agent_coalesce_max_wait_seconds: int = 30  # cap on how long a burst of messages delays the reply
+    agent_draft_delay_seconds: int = 2  # debounce before drafting a suggestion (orgs with reply drafts on)
+    
+    # Agent conversation memory (rolling summary + last N short turns in the prompt)
+    agent_history_recent_turns: int = 6
+    agent_history_turn_max_chars: int = 400
+    agent_summary_min_new_messages: int = 4  # messages that must age out of the window before re-summarizing
+    agent_summary_max_chars: int = 1500
+    agent_summary_delay_seconds: int = 30
+    agent_prompt_token_budget: int = 6000  # default when the org has no ai_prompt_token_budget
+    
+    # LLM router (per-org fallback chain, rolling provider stats, hedged requests)
+    llm_request_timeout_seconds: float = 45.0  # per provider attempt
+    llm_total_timeout_seconds: float = 60.0  # whole chain, including fallbacks and hedges
+    llm_stats_window_seconds: int = 300
+    llm_unhealthy_min_samples: int = 10
+    llm_unhealthy_error_rate: float = 0.5  # providers above this are tried last
+    llm_hedge_default_delay_seconds: float = 8.0  # hedge delay until a provider has enough samples for a p95
+    llm_hedge_min_delay_seconds: float = 1.0
+    
+    # AI rate limiting per org API key (per app process; orgs override via /api/settings/ai-config)
+    ai_rate_limit_rpm: int = 60
+    ai_rate_limit_tpm: int = 120000
+    ai_max_concurrency: int = 8
+    ai_rate_limit_interactive_wait_seconds: float = 10.0  # agent replies
+    ai_rate_limit_bulk_wait_seconds: float = 60.0  # workflows, drafts, summaries
+    
+    # Semantic reply cache (opt-in per org via /api/settings/ai-config)
+    reply_cache_similarity_threshold: float = 0.93  # default when the org has no ai_reply_cache_threshold
+    reply_cache_ttl_hours: int = 168
+    reply_cache_max_entries_per_org: int = 500
+    reply_cache_max_question_chars: int = 300  # longer messages are rarely repeat questions
+    
+    # Voice replies (ai_voice_reply_mode voice/match_input): LLM output is spoken sentence by sentence as it streams
+    voice_streaming_enabled: bool = True
+    voice_tts_concurrency: int = 2  # sentences synthesized ahead of the encoder per voice note
+    voice_min_sentence_chars: int = 24  # shorter sentences are joined with the next one
+    voice_max_sentence_chars: int = 240  # longer runs are split at a comma or space
+    voice_encoder_pool_size: int = 8  # ffmpeg encoders running at once per app process
+    voice_encoder_spares: int = 1  # encoders kept spawned so a note never waits on process start-up
+    voice_tts_native_opus: bool = False  # ask edge-tts for OGG/Opus and skip ffmpeg (needs edge-tts output_format support)
+    
+    # Voice note cache (content-addressed OGG/Opus; memory LRU per process + disk tier shared on the host)
+    tts_cache_enabled: bool = True
+    tts_cache_memory_mb: int = 32
+    tts_cache_dir: str = ""  # empty = <system temp dir>/shepherd-tts-cache
+    tts_cache_disk_mb: int = 512
+    
+    # Voice note transcripts cached per process by sha256 of the audio (0 disables)
+    transcript_cache_size: int = 256
+    
+    # Long voice notes go to the transcription service's job API and the reply resumes on its callback
+    transcribe_async_enabled: bool = False
+    transcribe_async_min_bytes: int = 100_000  # ~50 s of WhatsApp Opus; shorter notes are transcribed inline
+    transcribe_callback_url: str = ""  # public URL of /api/whatsapp/transcription-callback; empty = poll only
+    transcribe_poll_interval_seconds: int = 60  # backstop poll of the service job when no callback arrives
+    transcribe_async_timeout_seconds: int = 900  # then the note is transcribed inline after all
+    
+    # Reply pipeline tracing (stage spans; OpenTelemetry export when an SDK is configured)
+    trace_recent_replies: int = 200  # finished replies kept for /api/metrics/slow-replies
+    metrics_token: str = ""  # bearer token for Prometheus scrapes of /api/metrics/prometheus; empty = logged-in users only
+    
+    # Organization config snapshot cache (invalidated via Postgres NOTIFY on settings writes)
+    org_config_cache_ttl_seconds: int = 60
+    
+    # Outbound HTTP (shared pooled clients per upstream host)
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry_seconds: float = 30.0
+    http2_enabled: bool = True  # used only when the h2 package is installed
+    
     # App
     environment: str = "development"
     frontend_url: str = "http://localhost:3000"
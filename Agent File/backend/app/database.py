@@ -1,7 +1,11 @@
-from sqlalchemy import create_engine
+import threading
+import time
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
+from app.utils.metrics import metrics
 
 # Create database engine
 engine = create_engine(
@@ -18,6 +22,43 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+# Pool pressure tracking: how many connections are checked out, the high-water mark,
+# and how long each checkout is held (long holds mean a session spans slow external calls).
+_pool_lock = threading.Lock()
+_pool_high_water = 0
+
+
+@event.listens_for(engine, "checkout")
+def _on_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    global _pool_high_water
+    connection_record.info["checked_out_at"] = time.monotonic()
+    checked_out = engine.pool.checkedout()
+    with _pool_lock:
+        _pool_high_water = max(_pool_high_water, checked_out)
+    metrics.set_gauge("db_pool_checked_out", checked_out)
+    metrics.set_gauge("db_pool_checked_out_high_water", _pool_high_water)
+
+
+@event.listens_for(engine, "checkin")
+def _on_pool_checkin(dbapi_connection, connection_record):
+    started = connection_record.info.pop("checked_out_at", None)
+    if started is not None:
+        metrics.observe("db_connection_hold_seconds", time.monotonic() - started)
+    metrics.set_gauge("db_pool_checked_out", engine.pool.checkedout())
+
+
+def get_pool_stats() -> dict:
+    """Current connection pool usage for /api/metrics."""
+    pool = engine.pool
+    stats = {"high_water": _pool_high_water}
+    for name in ("size", "checkedout", "checkedin", "overflow"):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    if hasattr(pool, "size"):
+        stats["max_connections"] = pool.size() + getattr(pool, "_max_overflow", 0)
+    return stats
+
+
 def get_db():
     """Dependency to get database session."""
     db = SessionLocal()
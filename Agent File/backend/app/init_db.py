@@ -139,6 +139,19 @@ def init_chat_tables():
     ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_business_type VARCHAR(100) DEFAULT 'Organization';
     ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_voice_reply_mode VARCHAR(50) DEFAULT 'text';
     ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_voice_name VARCHAR(100) DEFAULT 'en-NG-EzinneNeural';
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_prompt_token_budget VARCHAR(10);
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_fallback_chain TEXT;
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_hedge_enabled VARCHAR(10) DEFAULT 'false';
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_rate_limit_rpm VARCHAR(10);
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_rate_limit_tpm VARCHAR(10);
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_max_concurrency VARCHAR(10);
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_reply_cache_enabled VARCHAR(10) DEFAULT 'false';
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_reply_cache_threshold VARCHAR(10);
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS knowledge_version INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_fast_path_enabled VARCHAR(10) DEFAULT 'true';
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_quick_replies TEXT;
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_transcription_language VARCHAR(10);
+    ALTER TABLE organizations ADD COLUMN IF NOT EXISTS ai_reply_drafts_enabled VARCHAR(10) DEFAULT 'false';
 
     -- Add chat handover & triage columns to contacts if not present
     ALTER TABLE contacts ADD COLUMN IF NOT EXISTS conversation_status VARCHAR(50) DEFAULT 'open';
@@ -199,9 +212,126 @@ def init_media_table():
         pass
 
 
+def init_agent_jobs_table():
+    """Create the durable agent job queue table if it doesn't exist."""
+    jobs_sql = """
+    CREATE TABLE IF NOT EXISTS agent_jobs (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        organization_id UUID NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
+        contact_id UUID NOT NULL REFERENCES contacts(id) ON DELETE CASCADE,
+        job_type VARCHAR(50) NOT NULL DEFAULT 'reply',
+        payload TEXT DEFAULT '{}',
+        status VARCHAR(50) NOT NULL DEFAULT 'queued',
+        attempts INTEGER DEFAULT 0,
+        max_attempts INTEGER DEFAULT 3,
+        last_error TEXT,
+        run_after TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+        locked_by VARCHAR(255),
+        locked_at TIMESTAMP WITH TIME ZONE,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+        started_at TIMESTAMP WITH TIME ZONE,
+        finished_at TIMESTAMP WITH TIME ZONE
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_agent_jobs_claim ON agent_jobs(status, run_after);
+    CREATE INDEX IF NOT EXISTS idx_agent_jobs_contact ON agent_jobs(contact_id, status);
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text(jobs_sql))
+            conn.commit()
+            logger.info("✅ Agent job queue table ready")
+    except Exception as e:
+        logger.error(f"❌ Error initializing Agent job queue table: {e}")
+        pass
+
+
+def init_conversation_summaries_table():
+    """Create the rolling per-contact conversation summary table if it doesn't exist."""
+    summaries_sql = """
+    CREATE TABLE IF NOT EXISTS conversation_summaries (
+        contact_id UUID PRIMARY KEY REFERENCES contacts(id) ON DELETE CASCADE,
+        organization_id UUID NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
+        summary TEXT DEFAULT '',
+        profile_card TEXT DEFAULT '',
+        summarized_until TIMESTAMP WITH TIME ZONE,
+        summarized_messages INTEGER DEFAULT 0,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_conversation_summaries_org ON conversation_summaries(organization_id);
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text(summaries_sql))
+            conn.commit()
+            logger.info("✅ Conversation summaries table ready")
+    except Exception as e:
+        logger.error(f"❌ Error initializing Conversation summaries table: {e}")
+        pass
+
+
+def init_reply_cache_table():
+    """Create the semantic reply cache table (requires the pgvector extension) if it doesn't exist."""
+    reply_cache_sql = """
+    CREATE TABLE IF NOT EXISTS reply_cache (
+        id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        organization_id UUID NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
+        knowledge_version INTEGER NOT NULL DEFAULT 0,
+        prefix_fingerprint VARCHAR(64) NOT NULL,
+        question TEXT NOT NULL,
+        embedding vector(768) NOT NULL,
+        reply TEXT NOT NULL,
+        action TEXT DEFAULT '{}',
+        hits INTEGER DEFAULT 0,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+        last_hit_at TIMESTAMP WITH TIME ZONE
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_reply_cache_lookup ON reply_cache(organization_id, knowledge_version, prefix_fingerprint);
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text(reply_cache_sql))
+            conn.commit()
+            logger.info("✅ Reply cache table ready")
+    except Exception as e:
+        logger.error(f"❌ Error initializing Reply cache table: {e}")
+        pass
+
+
+def init_reply_drafts_table():
+    """Create the per-contact suggested reply table (ai_reply_mode "suggest") if it doesn't exist."""
+    drafts_sql = """
+    CREATE TABLE IF NOT EXISTS reply_drafts (
+        contact_id UUID PRIMARY KEY REFERENCES contacts(id) ON DELETE CASCADE,
+        organization_id UUID NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        based_on_message_id UUID,
+        reply TEXT,
+        action TEXT,
+        source VARCHAR(20),
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_reply_drafts_org ON reply_drafts(organization_id);
+    """
+    try:
+        with engine.connect() as conn:
+            conn.execute(text(drafts_sql))
+            conn.commit()
+            logger.info("✅ Reply drafts table ready")
+    except Exception as e:
+        logger.error(f"❌ Error initializing Reply drafts table: {e}")
+        pass
+
+
 if __name__ == "__main__":
     init_groups_tables()
     init_bookings_table()
     init_chat_tables()
     init_media_table()
-
+    init_agent_jobs_table()
+    init_conversation_summaries_table()
+    init_reply_cache_table()
+    init_reply_drafts_table()
@@ -38,7 +38,7 @@ async def health_check():
     return {"status": "healthy"}
 
 
-from app.api import auth, contacts, messages, knowledge, workflows, whatsapp, settings, bridge, bridge_polling, groups, bookings, browse, conversations, widget, media_library
+from app.api import auth, contacts, messages, knowledge, workflows, whatsapp, settings, bridge, bridge_polling, groups, bookings, browse, conversations, widget, media_library, metrics
 app.include_router(auth.router, prefix="/api/auth", tags=["Authentication"])
 app.include_router(contacts.router, prefix="/api/contacts", tags=["Contacts"])
 app.include_router(messages.router, prefix="/api/messages", tags=["Messages"])
@@ -54,20 +54,37 @@ app.include_router(browse.router, prefix="/api/browse", tags=["Web Browsing"])
 app.include_router(conversations.router, tags=["Conversations"])
 app.include_router(widget.router, tags=["Website Widget"])
 app.include_router(media_library.router, tags=["Media Library"])
+app.include_router(metrics.router, tags=["Metrics"])
 
 
 @app.on_event("startup")
 async def startup_event():
-    """Start scheduler on app startup."""
+    """Start HTTP client registry, org config listener, scheduler and agent job workers on app startup."""
     from app.services.scheduler_service import start_scheduler
+    from app.services.agent_queue_service import agent_job_pool
+    from app.services.http_client_service import http_clients
+    from app.services.org_config_service import org_config_listener
+    await http_clients.start()
+    org_config_listener.start()
     start_scheduler()
+    await agent_job_pool.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Stop scheduler on app shutdown."""
+    """Drain agent job workers, stop scheduler, close AI/HTTP clients and spare encoders on app shutdown."""
     from app.services.scheduler_service import stop_scheduler
+    from app.services.agent_queue_service import agent_job_pool
+    from app.services.gemini_service import close_gemini_clients
+    from app.services.http_client_service import http_clients
+    from app.services.org_config_service import org_config_listener
+    from app.services.voice_pipeline import close_encoder_pool
+    await agent_job_pool.stop()
     stop_scheduler()
+    org_config_listener.stop()
+    await close_gemini_clients()
+    await http_clients.close()
+    await close_encoder_pool()
 
 
 if __name__ == "__main__":
@@ -76,11 +93,15 @@ if __name__ == "__main__":
 
 # Initialize Tables & Schema on startup
 try:
-    from app.init_db import init_groups_tables, init_bookings_table, init_chat_tables, init_media_table
+    from app.init_db import init_groups_tables, init_bookings_table, init_chat_tables, init_media_table, init_agent_jobs_table, init_conversation_summaries_table, init_reply_cache_table, init_reply_drafts_table
     init_groups_tables()
     init_bookings_table()
     init_chat_tables()
     init_media_table()
+    init_agent_jobs_table()
+    init_conversation_summaries_table()
+    init_reply_cache_table()
+    init_reply_drafts_table()
 except Exception as e:
     print(f"Startup DB initialization error: {e}")
 
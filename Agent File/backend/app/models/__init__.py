@@ -10,6 +10,10 @@ from app.models.booking import Booking
 from app.models.group import Group
 from app.models.media_file import MediaFile
 from app.models.conversation_session import ConversationSession
+from app.models.agent_job import AgentJob
+from app.models.conversation_summary import ConversationSummary
+from app.models.reply_cache import ReplyCacheEntry
+from app.models.reply_draft import ReplyDraft
 
 __all__ = [
     "Organization",
@@ -24,4 +28,8 @@ __all__ = [
     "Group",
     "MediaFile",
     "ConversationSession",
+    "AgentJob",
+    "ConversationSummary",
+    "ReplyCacheEntry",
+    "ReplyDraft",
 ]
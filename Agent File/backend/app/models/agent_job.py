@@ -0,0 +1,32 @@
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Text, Index, func
+from sqlalchemy.dialects.postgresql import UUID
+import uuid
+
+from app.database import Base
+
+
+class AgentJob(Base):
+    """Durable unit of AI agent work (e.g. an auto-reply run) claimed by the agent worker pool."""
+    
+    __tablename__ = "agent_jobs"
+    
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    organization_id = Column(UUID(as_uuid=True), ForeignKey("organizations.id", ondelete="CASCADE"), nullable=False)
+    contact_id = Column(UUID(as_uuid=True), ForeignKey("contacts.id", ondelete="CASCADE"), nullable=False)
+    job_type = Column(String(50), nullable=False, default="reply")  # 'reply', 'summarize', 'draft', 'transcription'
+    payload = Column(Text, default="{}")                          # JSON string of job arguments
+    status = Column(String(50), nullable=False, default="queued")  # queued, running, done, failed
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    last_error = Column(Text, nullable=True)
+    run_after = Column(DateTime(timezone=True), server_default=func.now())
+    locked_by = Column(String(255), nullable=True)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index('idx_agent_jobs_claim', 'status', 'run_after'),
+        Index('idx_agent_jobs_contact', 'contact_id', 'status'),
+    )
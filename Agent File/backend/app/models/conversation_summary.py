@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Text, Index, func
+from sqlalchemy.dialects.postgresql import UUID
+
+from app.database import Base
+
+
+class ConversationSummary(Base):
+    """Rolling summary of a contact's conversation plus a compact profile card, maintained by the agent worker."""
+
+    __tablename__ = "conversation_summaries"
+
+    contact_id = Column(UUID(as_uuid=True), ForeignKey("contacts.id", ondelete="CASCADE"), primary_key=True)
+    organization_id = Column(UUID(as_uuid=True), ForeignKey("organizations.id", ondelete="CASCADE"), nullable=False)
+    summary = Column(Text, default="")                         # LLM-maintained digest of older turns
+    profile_card = Column(Text, default="")                    # bookings and notes, rebuilt from the DB
+    summarized_until = Column(DateTime(timezone=True), nullable=True)  # created_at of the newest summarized message
+    summarized_messages = Column(Integer, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index('idx_conversation_summaries_org', 'organization_id'),
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, func
+from sqlalchemy import Column, String, Integer, DateTime, func
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 import uuid
@@ -32,6 +32,19 @@ class Organization(Base):
     ai_business_type = Column(String(100), nullable=True, default="Organization")
     ai_voice_reply_mode = Column(String(50), nullable=True, default="text")  # "text", "match_input", "voice"
     ai_voice_name = Column(String(100), nullable=True, default="en-NG-EzinneNeural")
+    ai_prompt_token_budget = Column(String, nullable=True)  # empty = server default (AGENT_PROMPT_TOKEN_BUDGET)
+    ai_fallback_chain = Column(String, nullable=True)  # JSON list of {provider, api_key, model, base_url}
+    ai_hedge_enabled = Column(String, nullable=True, default="false")  # "true" or "false"
+    ai_rate_limit_rpm = Column(String, nullable=True)   # empty = server defaults (AI_RATE_LIMIT_*)
+    ai_rate_limit_tpm = Column(String, nullable=True)
+    ai_max_concurrency = Column(String, nullable=True)
+    ai_reply_cache_enabled = Column(String, nullable=True, default="false")  # "true" or "false"
+    ai_reply_cache_threshold = Column(String, nullable=True)  # empty = REPLY_CACHE_SIMILARITY_THRESHOLD
+    knowledge_version = Column(Integer, nullable=False, default=0, server_default="0")  # bumped on every knowledge base edit
+    ai_fast_path_enabled = Column(String, nullable=True, default="true")  # templated replies to greetings/thanks/ok
+    ai_quick_replies = Column(String, nullable=True)  # JSON {intent: template or [templates]}; empty = built-in defaults
+    ai_transcription_language = Column(String(10), nullable=True)  # e.g. "en", "yo"; empty = detect per voice note
+    ai_reply_drafts_enabled = Column(String, nullable=True, default="false")  # suggest mode: draft for the operator instead of auto-sending
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
@@ -0,0 +1,28 @@
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index, func
+from sqlalchemy.dialects.postgresql import UUID
+from pgvector.sqlalchemy import Vector
+import uuid
+
+from app.database import Base
+
+
+class ReplyCacheEntry(Base):
+    """Non-personalized agent reply cached against the embedding of the question that produced it."""
+
+    __tablename__ = "reply_cache"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    organization_id = Column(UUID(as_uuid=True), ForeignKey("organizations.id", ondelete="CASCADE"), nullable=False)
+    knowledge_version = Column(Integer, nullable=False, default=0)  # organizations.knowledge_version when answered
+    prefix_fingerprint = Column(String(64), nullable=False)         # static prompt prefix (persona, tone, links, files)
+    question = Column(Text, nullable=False)
+    embedding = Column(Vector(768), nullable=False)
+    reply = Column(Text, nullable=False)
+    action = Column(Text, default="{}")                             # JSON action returned with the reply
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_hit_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index('idx_reply_cache_lookup', 'organization_id', 'knowledge_version', 'prefix_fingerprint'),
+    )
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, String, DateTime, ForeignKey, Text, Index, func
+from sqlalchemy.dialects.postgresql import UUID
+
+from app.database import Base
+
+
+class ReplyDraft(Base):
+    """Suggested reply for a contact's latest message, precomputed by the agent worker for "suggest" mode orgs."""
+
+    __tablename__ = "reply_drafts"
+
+    contact_id = Column(UUID(as_uuid=True), ForeignKey("contacts.id", ondelete="CASCADE"), primary_key=True)
+    organization_id = Column(UUID(as_uuid=True), ForeignKey("organizations.id", ondelete="CASCADE"), nullable=False)
+    status = Column(String(20), nullable=False, default="pending")  # pending, ready
+    based_on_message_id = Column(UUID(as_uuid=True), nullable=True)  # inbound message the draft answers
+    reply = Column(Text, nullable=True)
+    action = Column(Text, nullable=True)                             # proposed action, JSON; never executed
+    source = Column(String(20), nullable=True)                       # fast_path, reply_cache, llm
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index('idx_reply_drafts_org', 'organization_id'),
+    )
@@ -4,16 +4,32 @@ For managing AI provider settings per organization
 """
 
 from pydantic import BaseModel, UUID4
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
+class AIFallbackProvider(BaseModel):
+    """One entry of the org's LLM fallback chain (tried in order after the primary)"""
+    provider: str
+    api_key: str
+    model: str = ''
+    base_url: Optional[str] = None
+
+
 class AIConfigCreate(BaseModel):
     """Schema for creating/updating AI configuration"""
     provider: str  # 'gemini', 'openai', 'deepseek', 'groq', 'custom'
     api_key: str
     model: str = 'gemini-pro'
     base_url: Optional[str] = None  # For custom providers
+    prompt_token_budget: Optional[int] = None  # agent prompt budget; None = keep current
+    fallback_chain: Optional[List[AIFallbackProvider]] = None  # None = keep current, [] = clear
+    hedge_enabled: Optional[bool] = None  # hedge slow requests to the next provider in the chain
+    rate_limit_rpm: Optional[int] = None  # requests/min per key; None = keep current
+    rate_limit_tpm: Optional[int] = None  # tokens/min per key
+    max_concurrency: Optional[int] = None  # in-flight requests per key
+    reply_cache_enabled: Optional[bool] = None  # serve cached replies to repeat generic questions
+    reply_cache_threshold: Optional[float] = None  # cosine similarity needed for a cache hit
 
 
 class AIConfigUpdate(BaseModel):
@@ -22,6 +38,7 @@ class AIConfigUpdate(BaseModel):
     api_key: Optional[str] = None
     model: Optional[str] = None
     base_url: Optional[str] = None
+    prompt_token_budget: Optional[int] = None
 
 
 class AIConfigResponse(BaseModel):
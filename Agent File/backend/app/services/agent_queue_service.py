@@ -0,0 +1,701 @@
+"""
+Agent Job Queue Service
+Durable Postgres-backed queue for AI agent work.
+
+Inbound messages enqueue a job in the same transaction that saves the message.
+Each contact has a mailbox: messages arriving while a reply job is still queued
+are appended to that job (debounced by the org's ai_reply_delay_seconds), and a
+contact never has two reply jobs running at once (enqueues and claims for one
+contact's mailbox serialize on a transaction-scoped advisory lock). A bounded pool of async workers (one pool per app process) claims jobs with
+FOR UPDATE SKIP LOCKED, so any number of gunicorn workers can share the queue
+without double-processing, and jobs survive restarts. Besides replies the pool
+runs 'summarize' jobs that keep each contact's rolling conversation summary current,
+'draft' jobs that precompute suggestions for suggest-mode orgs that opted in to
+reply drafts (same mailbox coalescing as replies; see reply_draft_service), and 'transcription'
+jobs that hold a reply parked on an asynchronous voice note transcription until its
+result arrives (see transcription_job_service).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Callable, Awaitable, List
+from uuid import UUID
+
+from sqlalchemy import text, func
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import SessionLocal
+from app.models.agent_job import AgentJob
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RetryLater(Exception):
+    """Raised by a handler that is waiting on something external: run the job again after delay seconds, without using up an attempt."""
+
+    def __init__(self, delay: float):
+        super().__init__(f"not ready, retry in {delay:.0f}s")
+        self.delay = delay
+
+
+# Process-local wake-up signal so workers pick up freshly enqueued jobs without waiting a poll interval
+_wakeup_event: Optional[asyncio.Event] = None
+
+
+def _get_wakeup_event() -> asyncio.Event:
+    global _wakeup_event
+    if _wakeup_event is None:
+        _wakeup_event = asyncio.Event()
+    return _wakeup_event
+
+
+def _mailbox_lock_key(contact_id: Any, job_type: str) -> str:
+    return f"agent_jobs:{contact_id}:{job_type}"
+
+
+def lock_mailbox(db: Session, contact_id: Any, job_type: str):
+    """
+    Serialize writers of one contact's mailbox until the transaction ends. Row locks
+    cannot cover the case where no queued job exists yet: two concurrent webhooks would
+    both insert one and the contact would get two replies.
+    """
+    db.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": _mailbox_lock_key(contact_id, job_type)})
+
+
+def enqueue_agent_job(
+    db: Session,
+    org_id: UUID,
+    contact_id: UUID,
+    payload: Dict[str, Any],
+    job_type: str = "reply",
+    run_after: Optional[datetime] = None
+) -> AgentJob:
+    """
+    Add an agent job to the session. The caller commits, so the job becomes
+    visible atomically with whatever else the transaction writes (e.g. the inbound message).
+    """
+    job = AgentJob(
+        organization_id=org_id,
+        contact_id=contact_id,
+        job_type=job_type,
+        payload=json.dumps(payload),
+        status="queued",
+        attempts=0,
+        max_attempts=settings.agent_job_max_attempts,
+    )
+    if run_after is not None:
+        job.run_after = run_after
+    db.add(job)
+    metrics.incr("agent_jobs_enqueued", job_type=job_type)
+    return job
+
+
+def enqueue_inbound_message(
+    db: Session,
+    org_id: UUID,
+    contact_id: UUID,
+    entry: Dict[str, Any],
+    delay_seconds: int = 0,
+    job_type: str = "reply"
+) -> AgentJob:
+    """
+    Put an inbound message into the contact's mailbox.
+
+    If the contact already has a queued (not yet running) job of this type ('reply',
+    or 'draft' in suggest mode), the message is appended to it and its run time is
+    pushed back by delay_seconds, but never past agent_coalesce_max_wait_seconds after
+    the first message. Otherwise a new job is created that becomes runnable after
+    delay_seconds. While the contact's reply is parked on a voice note transcription,
+    replies join the parked mailbox instead, so they are answered together with the
+    voice note rather than before it. The caller commits.
+    """
+    delay = timedelta(seconds=max(0, delay_seconds))
+    lock_mailbox(db, contact_id, job_type)
+    if job_type == "reply":
+        parked = db.query(AgentJob).filter(
+            AgentJob.contact_id == contact_id,
+            AgentJob.job_type == "transcription",
+            AgentJob.status == "queued"
+        ).order_by(AgentJob.created_at.desc()).with_for_update().first()
+        if parked:
+            payload = _load_payload(parked.payload)
+            payload["messages"] = list(payload.get("messages") or []) + [entry]
+            parked.payload = json.dumps(payload)
+            metrics.incr("agent_messages_coalesced")
+            return parked
+    pending = db.query(AgentJob).filter(
+        AgentJob.contact_id == contact_id,
+        AgentJob.job_type == job_type,
+        AgentJob.status == "queued"
+    ).order_by(AgentJob.created_at.desc()).with_for_update().first()
+
+    if pending:
+        payload = coalesce_payload(_load_payload(pending.payload), entry)
+        pending.payload = json.dumps(payload)
+        pending.run_after = func.least(
+            func.now() + delay,
+            AgentJob.created_at + timedelta(seconds=settings.agent_coalesce_max_wait_seconds)
+        )
+        metrics.incr("agent_messages_coalesced")
+        return pending
+
+    return enqueue_agent_job(
+        db,
+        org_id=org_id,
+        contact_id=contact_id,
+        payload={"messages": [entry]},
+        job_type=job_type,
+        run_after=func.now() + delay if delay_seconds > 0 else None
+    )
+
+
+def requeue_mailbox(db: Session, org_id: UUID, contact_id: UUID, messages: List[Dict[str, Any]]) -> AgentJob:
+    """
+    Put messages whose reply was parked back on the contact's reply queue, runnable now.
+    Messages that arrived while the reply was parked are already in the mailbox (see
+    enqueue_inbound_message); a reply job queued since the parked job was claimed is
+    merged behind them. The caller commits.
+    """
+    lock_mailbox(db, contact_id, "reply")
+    pending = db.query(AgentJob).filter(
+        AgentJob.contact_id == contact_id,
+        AgentJob.job_type == "reply",
+        AgentJob.status == "queued"
+    ).order_by(AgentJob.created_at.desc()).with_for_update().first()
+
+    if pending:
+        newer = _load_payload(pending.payload).get("messages") or []
+        pending.payload = json.dumps({"messages": list(messages) + newer})
+        pending.run_after = func.now()
+        metrics.incr("agent_messages_coalesced")
+        return pending
+    return enqueue_agent_job(db, org_id=org_id, contact_id=contact_id, payload={"messages": list(messages)})
+
+
+def enqueue_summary_job(db: Session, org_id: UUID, contact_id: UUID) -> Optional[AgentJob]:
+    """
+    Schedule a conversation summary refresh for the contact, unless one is already queued.
+    Delayed by agent_summary_delay_seconds so a busy conversation is summarized once per burst. The caller commits.
+    """
+    lock_mailbox(db, contact_id, "summarize")
+    already_queued = db.query(AgentJob.id).filter(
+        AgentJob.contact_id == contact_id,
+        AgentJob.job_type == "summarize",
+        AgentJob.status == "queued"
+    ).first()
+    if already_queued:
+        return None
+    return enqueue_agent_job(
+        db,
+        org_id=org_id,
+        contact_id=contact_id,
+        payload={},
+        job_type="summarize",
+        run_after=func.now() + timedelta(seconds=settings.agent_summary_delay_seconds)
+    )
+
+
+def _load_payload(raw: Optional[str]) -> Dict[str, Any]:
+    try:
+        return json.loads(raw or "{}")
+    except (TypeError, ValueError):
+        return {}
+
+
+def coalesce_payload(payload: Dict[str, Any], entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Append an inbound message entry to a reply payload (upgrading single-message payloads)."""
+    messages = list(payload.get("messages") or [])
+    if not messages and payload.get("content") is not None:
+        messages.append({
+            "message_id": payload.get("message_id"),
+            "content": payload.get("content"),
+            "audio_media_id": payload.get("audio_media_id"),
+            "audio_mime_type": payload.get("audio_mime_type"),
+        })
+    messages.append(entry)
+    return {"messages": messages}
+
+
+def notify_agent_workers():
+    """Wake local workers after a commit that enqueued jobs."""
+    try:
+        _get_wakeup_event().set()
+    except RuntimeError:
+        pass
+
+
+def get_queue_stats(db: Session) -> Dict[str, Any]:
+    """Queue depth per status plus age of the oldest runnable job."""
+    rows = db.execute(
+        text("SELECT status, COUNT(*) FROM agent_jobs GROUP BY status")
+    ).fetchall()
+    oldest = db.execute(
+        text("""
+            SELECT EXTRACT(EPOCH FROM (NOW() - MIN(run_after)))
+            FROM agent_jobs
+            WHERE status = 'queued' AND run_after <= NOW()
+        """)
+    ).scalar()
+    depth = {row[0]: row[1] for row in rows}
+    metrics.set_gauge("agent_queue_depth", depth.get("queued", 0))
+    return {
+        "depth": depth,
+        "oldest_queued_seconds": round(float(oldest), 2) if oldest is not None else 0.0,
+        "workers": agent_job_pool.concurrency,
+        "in_flight": len(agent_job_pool.in_flight),
+    }
+
+
+async def _run_reply_job(job: Dict[str, Any]):
+    """Run one AI auto-reply for a contact's mailbox (one or more inbound messages)."""
+    from app.services.agent_service import trigger_ai_agent_reply
+    payload = job["payload"]
+    messages = payload.get("messages")
+    if not messages:
+        messages = [payload]
+    first = messages[0]
+    db = SessionLocal()
+    try:
+        result = await trigger_ai_agent_reply(
+            contact_id=job["contact_id"],
+            incoming_text="\n".join(m.get("content") or "" for m in messages).strip(),
+            org_id=job["organization_id"],
+            db=db,
+            audio_media_id=first.get("audio_media_id") if len(messages) == 1 else None,
+            audio_mime_type=first.get("audio_mime_type") or "audio/ogg",
+            raise_errors=True,
+            inbound_messages=messages
+        )
+        # Keep the rolling summary current, off the reply path. Nothing was sent for a
+        # silenced, paused or parked (TranscriptionDeferred) turn, so nothing to summarize yet
+        if result is not None:
+            await asyncio.to_thread(_enqueue_summary_after_reply, db, job["organization_id"], job["contact_id"])
+    finally:
+        db.close()
+
+
+def _enqueue_summary_after_reply(db: Session, org_id: UUID, contact_id: UUID):
+    try:
+        if enqueue_summary_job(db, org_id, contact_id):
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Could not queue summary refresh for contact {contact_id}: {e}")
+
+
+async def _run_draft_job(job: Dict[str, Any]):
+    """Precompute the suggested reply for a suggest-mode contact's mailbox (nothing is sent)."""
+    from app.services.agent_service import generate_reply_draft
+    from app.services.reply_draft_service import save_reply_draft, discard_reply_draft
+    messages = job["payload"].get("messages") or []
+    if not messages:
+        return
+    # The draft answers the newest message in the mailbox; a later one supersedes it
+    message_id = messages[-1].get("message_id")
+    db = SessionLocal()
+    try:
+        try:
+            draft = await generate_reply_draft(job["contact_id"], job["organization_id"], db, messages)
+        except Exception:
+            if job["attempts"] >= job["max_attempts"]:
+                metrics.incr("reply_drafts", result="failed")
+                await asyncio.to_thread(discard_reply_draft, db, job["contact_id"], message_id)
+            raise
+        await asyncio.to_thread(save_reply_draft, db, job["contact_id"], message_id, draft)
+        await asyncio.to_thread(_enqueue_summary_after_reply, db, job["organization_id"], job["contact_id"])
+    finally:
+        db.close()
+
+
+async def _run_transcription_job(job: Dict[str, Any]):
+    """Resume a reply parked on an asynchronous voice note transcription (callback result, or poll the service)."""
+    from app.services.transcription_job_service import resolve_transcription, resume_parked_reply
+    try:
+        result = await resolve_transcription(job["payload"])
+    except RetryLater:
+        raise
+    except Exception as e:
+        if job["attempts"] < job["max_attempts"]:
+            raise
+        # Never drop the parked mailbox: the last attempt transcribes the note inline instead
+        logger.warning(f"🎙️ Giving up on transcription job for contact {job['contact_id']}, resuming inline: {e}")
+        result = None
+    db = SessionLocal()
+    try:
+        await asyncio.to_thread(resume_parked_reply, db, job["organization_id"], job["contact_id"], job["payload"], result)
+    finally:
+        db.close()
+    notify_agent_workers()
+
+
+async def _run_summarize_job(job: Dict[str, Any]):
+    """Refresh a contact's profile card and rolling conversation summary."""
+    from app.services.conversation_summary_service import update_conversation_summary
+    db = SessionLocal()
+    try:
+        await update_conversation_summary(db, job["organization_id"], job["contact_id"])
+    finally:
+        db.close()
+
+
+# job_type -> coroutine handler
+JOB_HANDLERS: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]] = {
+    "reply": _run_reply_job,
+    "summarize": _run_summarize_job,
+    "draft": _run_draft_job,
+    "transcription": _run_transcription_job,
+}
+
+
+class AgentJobWorkerPool:
+    """Bounded pool of async workers that claim and execute agent jobs."""
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = settings.agent_worker_concurrency
+        self.poll_interval = settings.agent_job_poll_interval_seconds
+        self.in_flight: Dict[str, asyncio.Task] = {}
+        self._workers = []
+        self._stopping = False
+        self._last_recovery = 0.0
+
+    async def start(self):
+        """Recover orphaned jobs and spawn the worker coroutines."""
+        if self._workers:
+            return
+        self._stopping = False
+        _get_wakeup_event()
+        try:
+            await asyncio.to_thread(self._recover_stale_jobs)
+        except Exception as e:
+            logger.error(f"Agent job recovery failed: {e}")
+        for i in range(max(1, self.concurrency)):
+            self._workers.append(asyncio.create_task(self._worker_loop(i)))
+        logger.info(f"🧵 Agent job pool started with {len(self._workers)} workers ({self.worker_id})")
+
+    async def stop(self, drain_timeout: Optional[float] = None):
+        """
+        Stop claiming new jobs and wait for in-flight jobs to finish.
+        Jobs still running after the drain timeout are cancelled and put back on the queue.
+        """
+        if not self._workers:
+            return
+        self._stopping = True
+        _get_wakeup_event().set()
+        timeout = settings.agent_job_drain_timeout_seconds if drain_timeout is None else drain_timeout
+
+        pending = list(self.in_flight.values())
+        if pending:
+            logger.info(f"⏳ Draining {len(pending)} in-flight agent jobs (timeout {timeout}s)")
+            done, still_running = await asyncio.wait(pending, timeout=timeout)
+            if still_running:
+                unfinished_ids = [job_id for job_id, task in self.in_flight.items() if task in still_running]
+                for task in still_running:
+                    task.cancel()
+                await asyncio.gather(*still_running, return_exceptions=True)
+                try:
+                    await asyncio.to_thread(self._requeue_jobs, unfinished_ids)
+                except Exception as e:
+                    logger.error(f"Failed to requeue unfinished agent jobs: {e}")
+                logger.warning(f"⚠️ Requeued {len(unfinished_ids)} agent jobs that did not finish before shutdown")
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("🧵 Agent job pool stopped")
+
+    async def _worker_loop(self, index: int):
+        wakeup = _get_wakeup_event()
+        while not self._stopping:
+            try:
+                if index == 0 and time.monotonic() - self._last_recovery > 60:
+                    await asyncio.to_thread(self._recover_stale_jobs)
+
+                job = await asyncio.to_thread(self._claim_next_job)
+                if not job:
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                await self._execute(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Agent worker {index} loop error: {e}", exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _execute(self, job: Dict[str, Any]):
+        job_id = str(job["id"])
+        job_type = job["job_type"]
+        metrics.observe("agent_job_wait_seconds", job["wait_seconds"], job_type=job_type)
+        metrics.add_gauge("agent_jobs_in_flight", 1)
+        started = time.monotonic()
+        task = asyncio.create_task(self._dispatch(job))
+        self.in_flight[job_id] = task
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, task))
+        try:
+            await asyncio.shield(task)
+            elapsed = time.monotonic() - started
+            metrics.observe("agent_job_run_seconds", elapsed, job_type=job_type)
+            metrics.incr("agent_jobs_completed", job_type=job_type)
+            await asyncio.to_thread(self._complete_job, job_id)
+        except asyncio.CancelledError:
+            # Shutdown cancelled us; stop() requeues the job
+            raise
+        except RetryLater as e:
+            await asyncio.to_thread(self._reschedule_job, job_id, e.delay)
+        except Exception as e:
+            logger.error(f"❌ Agent job {job_id} ({job_type}) failed on attempt {job['attempts']}: {e}", exc_info=True)
+            await asyncio.to_thread(self._fail_job, job_id, job["attempts"], job["max_attempts"], str(e))
+        finally:
+            heartbeat.cancel()
+            self.in_flight.pop(job_id, None)
+            metrics.add_gauge("agent_jobs_in_flight", -1)
+
+    async def _heartbeat(self, job_id: str, task: asyncio.Task):
+        """Keep a running job's lock fresh, so a slow but live reply is never recovered and run twice."""
+        interval = max(1.0, settings.agent_job_lock_timeout_seconds / 3)
+        while not task.done():
+            await asyncio.sleep(interval)
+            if task.done():
+                return
+            try:
+                await asyncio.to_thread(self._touch_job, job_id)
+            except Exception as e:
+                logger.warning(f"Agent job {job_id} heartbeat failed: {e}")
+
+    def _touch_job(self, job_id: str):
+        db = SessionLocal()
+        try:
+            db.execute(
+                text("""
+                    UPDATE agent_jobs SET locked_at = NOW()
+                    WHERE id = :job_id AND status = 'running' AND locked_by = :worker_id
+                """),
+                {"job_id": job_id, "worker_id": self.worker_id}
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    async def _dispatch(self, job: Dict[str, Any]):
+        handler = JOB_HANDLERS.get(job["job_type"])
+        if not handler:
+            raise ValueError(f"No handler registered for agent job type '{job['job_type']}'")
+        await handler(job)
+
+    def _claim_next_job(self) -> Optional[Dict[str, Any]]:
+        db = SessionLocal()
+        try:
+            candidate = db.execute(
+                text("""
+                    SELECT id, contact_id, job_type FROM agent_jobs
+                    WHERE status = 'queued' AND run_after <= NOW()
+                      AND NOT EXISTS (
+                          SELECT 1 FROM agent_jobs busy
+                          WHERE busy.contact_id = agent_jobs.contact_id
+                            AND (busy.job_type = agent_jobs.job_type
+                                 OR (agent_jobs.job_type = 'reply' AND busy.job_type = 'transcription'))
+                            AND busy.status = 'running'
+                      )
+                    ORDER BY run_after
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                """)
+            ).fetchone()
+            if not candidate:
+                db.commit()
+                return None
+            # A reply waits while the contact's parked reply is being resumed, so it is not
+            # answered ahead of the voice note. The NOT EXISTS above reads a snapshot: another worker may have claimed this
+            # contact's previous job meanwhile. Re-check under the mailbox lock. Only try it:
+            # an enqueue holding the lock may be waiting for the row lock taken above.
+            locked = db.execute(
+                text("SELECT pg_try_advisory_xact_lock(hashtext(:key))"),
+                {"key": _mailbox_lock_key(candidate[1], candidate[2])}
+            ).scalar()
+            if not locked:
+                db.rollback()
+                return None
+            busy = db.execute(
+                text("""
+                    SELECT 1 FROM agent_jobs
+                    WHERE contact_id = :contact_id AND status = 'running'
+                      AND (job_type = :job_type OR (:job_type = 'reply' AND job_type = 'transcription'))
+                    LIMIT 1
+                """),
+                {"contact_id": candidate[1], "job_type": candidate[2]}
+            ).fetchone()
+            if busy:
+                db.rollback()
+                return None
+            row = db.execute(
+                text("""
+                    UPDATE agent_jobs
+                    SET status = 'running',
+                        attempts = attempts + 1,
+                        locked_by = :worker_id,
+                        locked_at = NOW(),
+                        started_at = NOW()
+                    WHERE id = :job_id
+                    RETURNING id, organization_id, contact_id, job_type, payload, attempts, max_attempts,
+                              EXTRACT(EPOCH FROM (NOW() - created_at))
+                """),
+                {"worker_id": self.worker_id, "job_id": candidate[0]}
+            ).fetchone()
+            db.commit()
+            payload = _load_payload(row[4])
+            return {
+                "id": row[0],
+                "organization_id": row[1],
+                "contact_id": row[2],
+                "job_type": row[3],
+                "payload": payload,
+                "attempts": row[5],
+                "max_attempts": row[6] or settings.agent_job_max_attempts,
+                "wait_seconds": float(row[7] or 0),
+            }
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _complete_job(self, job_id: str):
+        db = SessionLocal()
+        try:
+            db.execute(
+                text("""
+                    UPDATE agent_jobs
+                    SET status = 'done', finished_at = NOW(), locked_by = NULL, locked_at = NULL
+                    WHERE id = :job_id
+                """),
+                {"job_id": job_id}
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _fail_job(self, job_id: str, attempts: int, max_attempts: int, error: str):
+        """Schedule a retry with exponential backoff, or mark the job failed once attempts are exhausted."""
+        db = SessionLocal()
+        try:
+            if attempts < max_attempts:
+                delay = settings.agent_job_retry_backoff_seconds * (2 ** (attempts - 1))
+                db.execute(
+                    text("""
+                        UPDATE agent_jobs
+                        SET status = 'queued', last_error = :error, locked_by = NULL, locked_at = NULL,
+                            run_after = NOW() + make_interval(secs => :delay)
+                        WHERE id = :job_id
+                    """),
+                    {"job_id": job_id, "error": error[:2000], "delay": delay}
+                )
+                metrics.incr("agent_jobs_retried")
+                logger.info(f"🔁 Agent job {job_id} retry {attempts}/{max_attempts} in {delay:.0f}s")
+            else:
+                db.execute(
+                    text("""
+                        UPDATE agent_jobs
+                        SET status = 'failed', last_error = :error, finished_at = NOW(),
+                            locked_by = NULL, locked_at = NULL
+                        WHERE id = :job_id
+                    """),
+                    {"job_id": job_id, "error": error[:2000]}
+                )
+                metrics.incr("agent_jobs_failed")
+            db.commit()
+        finally:
+            db.close()
+
+    def _reschedule_job(self, job_id: str, delay: float):
+        """Put a job that is waiting on something external back on the queue without counting the attempt."""
+        db = SessionLocal()
+        try:
+            db.execute(
+                text("""
+                    UPDATE agent_jobs
+                    SET status = 'queued', locked_by = NULL, locked_at = NULL,
+                        attempts = GREATEST(attempts - 1, 0),
+                        run_after = NOW() + make_interval(secs => :delay)
+                    WHERE id = :job_id
+                """),
+                {"job_id": job_id, "delay": delay}
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _requeue_jobs(self, job_ids):
+        if not job_ids:
+            return
+        db = SessionLocal()
+        try:
+            for job_id in job_ids:
+                db.execute(
+                    text("""
+                        UPDATE agent_jobs
+                        SET status = 'queued', locked_by = NULL, locked_at = NULL,
+                            attempts = GREATEST(attempts - 1, 0)
+                        WHERE id = :job_id AND status = 'running'
+                    """),
+                    {"job_id": job_id}
+                )
+            db.commit()
+        finally:
+            db.close()
+
+    def _recover_stale_jobs(self):
+        """
+        Put back jobs whose worker died mid-run (no heartbeat within the lock timeout).
+        A job that has used up its attempts is marked failed instead, so one that
+        crashes its worker every time does not loop forever.
+        """
+        self._last_recovery = time.monotonic()
+        db = SessionLocal()
+        try:
+            params = {"timeout": settings.agent_job_lock_timeout_seconds, "max_attempts": settings.agent_job_max_attempts}
+            failed = db.execute(
+                text("""
+                    UPDATE agent_jobs
+                    SET status = 'failed', finished_at = NOW(), locked_by = NULL, locked_at = NULL,
+                        last_error = 'worker lost while running (attempts exhausted)'
+                    WHERE status = 'running'
+                      AND locked_at < NOW() - make_interval(secs => :timeout)
+                      AND attempts >= COALESCE(max_attempts, :max_attempts)
+                """),
+                params
+            )
+            recovered = db.execute(
+                text("""
+                    UPDATE agent_jobs
+                    SET status = 'queued', locked_by = NULL, locked_at = NULL
+                    WHERE status = 'running'
+                      AND locked_at < NOW() - make_interval(secs => :timeout)
+                """),
+                params
+            )
+            db.commit()
+            if failed.rowcount:
+                metrics.incr("agent_jobs_failed", failed.rowcount)
+                logger.error(f"💀 Failed {failed.rowcount} stale agent jobs that had used up their attempts")
+            if recovered.rowcount:
+                metrics.incr("agent_jobs_recovered", recovered.rowcount)
+                logger.warning(f"♻️ Recovered {recovered.rowcount} stale agent jobs")
+        finally:
+            db.close()
+
+
+# Singleton instance
+agent_job_pool = AgentJobWorkerPool()
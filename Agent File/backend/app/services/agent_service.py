@@ -9,12 +9,15 @@ import logging
 import re
 import base64
 import asyncio
-import tempfile
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, List, Callable
 from uuid import UUID, uuid4
-import httpx
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 
@@ -22,11 +25,47 @@ from app.models.contact import Contact
 from app.models.message import Message
 from app.models.booking import Booking
 from app.models.conversation_session import ConversationSession
-from app.models.organization import Organization
-from app.services.rag_service import search_knowledge_base
+from app.models.conversation_summary import ConversationSummary
+from app.services.rag_service import search_knowledge_base_sync
+from app.services.reply_cache_service import should_lookup, is_cacheable, lookup_cached_reply, store_cached_reply
+from app.services.intent_router_service import classify_trivial_intent, fast_path_reply
+from app.services.ai_service import generate_embedding
+from app.utils.metrics import metrics
+from app.utils.tracing import reply_trace, stage_span, annotate_reply, annotate_stage
+from app.config import settings
+from app.services.http_client_service import get_http_client
+from app.services.org_config_service import get_org_config
+from app.services.prompt_builder import build_agent_prompt, prefix_fingerprint, truncate_to_tokens
+from app.services.conversation_summary_service import truncate_turn
+from app.services.transcription_job_service import (
+    TranscriptionDeferred, defer_transcription, should_defer, transcribe_service_config, TRANSCRIPTION_FAILED
+)
 
 logger = logging.getLogger(__name__)
 
+# Per-chunk cap for knowledge base hits; the prompt budget trims the section as a whole
+KB_CHUNK_MAX_TOKENS = 400
+
+
+def _record_llm_usage(provider: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int):
+    """Token usage counters; cached prompt tokens show how much of the stable prefix was reused."""
+    metrics.incr("llm_prompt_tokens", prompt_tokens or 0, provider=provider)
+    metrics.incr("llm_cached_prompt_tokens", cached_tokens or 0, provider=provider)
+    metrics.incr("llm_completion_tokens", completion_tokens or 0, provider=provider)
+    annotate_stage(provider=provider, prompt_tokens=prompt_tokens, cached_tokens=cached_tokens, completion_tokens=completion_tokens)
+    logger.info(f"🧮 {provider} usage: prompt={prompt_tokens} cached={cached_tokens} completion={completion_tokens}")
+
+
+def _openai_usage(data: Dict[str, Any]) -> Tuple[int, int, int]:
+    """(prompt, cached, completion) from an OpenAI-compatible usage block.
+    OpenAI reports prompt_tokens_details.cached_tokens, DeepSeek prompt_cache_hit_tokens."""
+    usage = data.get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens")
+    if cached is None:
+        cached = usage.get("prompt_cache_hit_tokens", 0)
+    return usage.get("prompt_tokens", 0), cached or 0, usage.get("completion_tokens", 0)
+
 
 async def call_ai_provider(
     provider: str,
@@ -34,26 +73,35 @@ async def call_ai_provider(
     model: str,
     system_prompt: str,
     user_turn: str,
-    base_url: Optional[str] = None
+    base_url: Optional[str] = None,
+    timeout: float = 45.0,
+    on_text: Optional[Callable[[str], None]] = None
 ) -> str:
-    """Call configured AI provider with system prompt and user turn."""
+    """
+    Call configured AI provider with system prompt and user turn.
+    The system prompt should be the stable per-org prefix (see prompt_builder) so
+    provider-side prefix caching can reuse it across replies.
+    With on_text the response is streamed and each text chunk is passed to it as it
+    arrives (voice replies start TTS on the first sentence); the return value is the same.
+    """
     if not api_key:
         raise ValueError("AI API key is missing.")
 
     if provider == "gemini":
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
+        from app.services.gemini_service import gemini_generate_reply
         # Use provided model or fallback to standard flash
         model_name = model if model and "gemini" in model else "gemini-2.0-flash"
-        generative_model = genai.GenerativeModel(
-            model_name=model_name,
-            system_instruction=system_prompt
-        )
-        response = generative_model.generate_content(
-            user_turn,
-            generation_config={"temperature": 0.7}
+        reply, usage = await gemini_generate_reply(
+            api_key=api_key,
+            model=model_name,
+            prompt=user_turn,
+            system_instruction=system_prompt,
+            temperature=0.7,
+            timeout=timeout,
+            on_text=on_text
         )
-        return response.text.strip() if response and response.text else "{}"
+        _record_llm_usage(provider, usage["prompt_tokens"], usage["cached_tokens"], usage["completion_tokens"])
+        return reply or "{}"
 
     # OpenAI-compatible providers (OpenAI, DeepSeek, Groq, Custom)
     url = base_url
@@ -69,27 +117,68 @@ async def call_ai_provider(
 
     url = url.rstrip('/')
 
-    async with httpx.AsyncClient(timeout=45.0) as client:
-        response = await client.post(
-            f"{url}/chat/completions",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            },
-            json={
-                "model": model or "gpt-4o",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_turn}
-                ],
-                "temperature": 0.7,
-                "response_format": {"type": "json_object"}
-            }
-        )
+    client = get_http_client(url)
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    body = {
+        "model": model or "gpt-4o",
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_turn}
+        ],
+        "temperature": 0.7,
+        "response_format": {"type": "json_object"}
+    }
+    if on_text:
+        return await _stream_openai_compatible(client, provider, f"{url}/chat/completions", headers, body, timeout, on_text)
+
+    response = await client.post(f"{url}/chat/completions", headers=headers, json=body, timeout=timeout)
+    if not response.is_success:
+        raise Exception(f"AI Provider HTTP {response.status_code}: {response.text}")
+    data = response.json()
+    _record_llm_usage(provider, *_openai_usage(data))
+    return data["choices"][0]["message"]["content"].strip()
+
+
+async def _stream_openai_compatible(
+    client,
+    provider: str,
+    url: str,
+    headers: Dict[str, str],
+    body: Dict[str, Any],
+    timeout: float,
+    on_text: Callable[[str], None]
+) -> str:
+    """Server-sent-events chat completion: chunks go to on_text, the full text is returned."""
+    body = {**body, "stream": True}
+    if provider in ("openai", "deepseek"):
+        body["stream_options"] = {"include_usage": True}
+    parts: List[str] = []
+    usage_data: Dict[str, Any] = {}
+    async with client.stream("POST", url, headers=headers, json=body, timeout=timeout) as response:
         if not response.is_success:
+            await response.aread()
             raise Exception(f"AI Provider HTTP {response.status_code}: {response.text}")
-        data = response.json()
-        return data["choices"][0]["message"]["content"].strip()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            chunk = json.loads(payload)
+            # Groq reports usage on the last chunk under x_groq
+            usage = chunk.get("usage") or (chunk.get("x_groq") or {}).get("usage")
+            if usage:
+                usage_data = {"usage": usage}
+            for choice in chunk.get("choices") or []:
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    on_text(delta)
+    _record_llm_usage(provider, *_openai_usage(usage_data))
+    return "".join(parts).strip()
 
 
 def strip_emojis(text: str) -> str:
@@ -120,7 +209,8 @@ def parse_agent_response(raw_text: str) -> Dict[str, Any]:
             reply = strip_emojis(data.get("reply", "").strip())
             return {
                 "reply": reply,
-                "action": data.get("action") or {"type": "NONE"}
+                "action": data.get("action") or {"type": "NONE"},
+                "generic": data.get("generic") is True
             }
     except Exception as e:
         logger.warning(f"Failed to parse agent JSON response: {e}")
@@ -128,27 +218,73 @@ def parse_agent_response(raw_text: str) -> Dict[str, Any]:
     # Fallback to plain text cleaning
     clean = re.sub(r"```(json)?|```", "", raw_text).strip()
     clean = strip_emojis(clean)
-    return {"reply": clean, "action": {"type": "NONE"}}
+    return {"reply": clean, "action": {"type": "NONE"}, "generic": False}
 
 
 
+# sha256(language hint, audio bytes) -> transcript. Forwarded and re-sent voice notes carry identical
+# bytes, so a repeat is answered here without a round trip to the microservice (which
+# keeps its own, larger cache keyed by audio + model + decoding options).
+_transcript_cache: "OrderedDict[str, str]" = OrderedDict()
+_transcript_cache_lock = threading.Lock()
+
+
+def _cached_transcript(audio_key: str) -> Optional[str]:
+    with _transcript_cache_lock:
+        transcript = _transcript_cache.get(audio_key)
+        if transcript is not None:
+            _transcript_cache.move_to_end(audio_key)
+    metrics.incr("transcript_cache", result="hit" if transcript is not None else "miss")
+    return transcript
+
+
+def _remember_transcript(audio_key: str, transcript: str):
+    if not transcript or settings.transcript_cache_size <= 0:
+        return
+    with _transcript_cache_lock:
+        _transcript_cache[audio_key] = transcript
+        _transcript_cache.move_to_end(audio_key)
+        while len(_transcript_cache) > settings.transcript_cache_size:
+            _transcript_cache.popitem(last=False)
+
+
 async def transcribe_voice_note(
     audio_bytes: bytes,
     mime_type: str = "audio/ogg",
     api_key: Optional[str] = None,
     provider: str = "gemini",
-    base_url: Optional[str] = None
+    base_url: Optional[str] = None,
+    language: Optional[str] = None
 ) -> str:
     """
     Transcribes WhatsApp voice notes via the dedicated self-hosted faster-whisper microservice.
     Replaces the previous Gemini-based transcription which fails on OGG/Opus.
+    language ("en", "yo", ...) skips language detection; None = detect.
     """
     if not audio_bytes:
         logger.warning("🔇 Transcription skipped — audio_bytes is empty.")
         return ""
 
-    import os
-    import time
+    audio_key = hashlib.sha256(f"{language or ''}\x00".encode("utf-8") + audio_bytes).hexdigest()
+    if settings.transcript_cache_size > 0:
+        cached = _cached_transcript(audio_key)
+        if cached is not None:
+            logger.info(f"🎙️ ♻️ Transcript cache hit ({len(audio_bytes)} bytes): '{cached[:120]}'")
+            return cached
+
+    text = await _transcribe_uncached(audio_bytes, mime_type, api_key, provider, base_url, language)
+    _remember_transcript(audio_key, text)
+    return text
+
+
+async def _transcribe_uncached(
+    audio_bytes: bytes,
+    mime_type: str,
+    api_key: Optional[str],
+    provider: str,
+    base_url: Optional[str],
+    language: Optional[str] = None
+) -> str:
     import httpx
 
     # Check raw binary and log magic bytes for debugging
@@ -158,14 +294,10 @@ async def transcribe_voice_note(
     logger.info(f"🎙️ TRANSCRIBE START: {len(audio_bytes)} bytes | magic={first_4_str} (is_ogg={is_ogg}) | mime={mime_type}")
 
     # Read self-hosted faster-whisper microservice configuration
-    transcribe_url = (os.getenv("TRANSCRIBE_SERVICE_URL", "").strip() or "https://shepherdai.duckdns.org/transcribe")
-    transcribe_key = (os.getenv("TRANSCRIBE_SERVICE_KEY", "").strip() or "17f187c37b8164bc2f038779fa9ebe886ef771e3f721793e584bd816bf1a8ac5")
+    service_url, transcribe_key = transcribe_service_config()
+    transcribe_url = f"{service_url}/transcribe"
 
-    if transcribe_url:
-        # Automatically ensure /transcribe path is present
-        transcribe_url = transcribe_url.rstrip("/")
-        if not transcribe_url.endswith("/transcribe"):
-            transcribe_url = f"{transcribe_url}/transcribe"
+    if service_url:
 
         start_t = time.time()
         logger.info(f"🎙️ Calling self-hosted Whisper microservice: {transcribe_url}")
@@ -173,21 +305,24 @@ async def transcribe_voice_note(
             headers = {"X-Api-Key": transcribe_key}
 
             clean_mime = "audio/ogg" if ("ogg" in (mime_type or "").lower() or is_ogg) else (mime_type or "audio/ogg")
-            async with httpx.AsyncClient(timeout=25.0) as client:
-                files = {"file": ("voice.ogg", audio_bytes, clean_mime)}
-                resp = await client.post(transcribe_url, files=files, headers=headers)
-                elapsed = time.time() - start_t
-                logger.info(f"🎙️ Whisper microservice HTTP {resp.status_code} in {elapsed:.2f}s")
-                if resp.status_code == 200:
-                    data = resp.json()
-                    text = data.get("text", "").strip()
-                    if text:
-                        logger.info(f"🎙️ ✅ Whisper transcription SUCCESS: '{text[:120]}'")
-                        return text
-                    else:
-                        logger.warning("🎙️ Whisper microservice returned empty text.")
+            client = get_http_client(transcribe_url)
+            files = {"file": ("voice.ogg", audio_bytes, clean_mime)}
+            data = {"language": language} if language else None
+            with stage_span("transcribe", audio_bytes=len(audio_bytes)) as span:
+                resp = await client.post(transcribe_url, files=files, data=data, headers=headers, timeout=25.0)
+                span.set(status=resp.status_code)
+            elapsed = time.time() - start_t
+            logger.info(f"🎙️ Whisper microservice HTTP {resp.status_code} in {elapsed:.2f}s")
+            if resp.status_code == 200:
+                data = resp.json()
+                text = data.get("text", "").strip()
+                if text:
+                    logger.info(f"🎙️ ✅ Whisper transcription SUCCESS: '{text[:120]}'")
+                    return text
                 else:
-                    logger.error(f"🎙️ Whisper microservice error HTTP {resp.status_code}: {resp.text[:300]}")
+                    logger.warning("🎙️ Whisper microservice returned empty text.")
+            else:
+                logger.error(f"🎙️ Whisper microservice error HTTP {resp.status_code}: {resp.text[:300]}")
         except Exception as e:
             elapsed = time.time() - start_t
             logger.error(f"🎙️ Whisper microservice request failed after {elapsed:.2f}s: {e}", exc_info=True)
@@ -203,19 +338,23 @@ async def transcribe_voice_note(
                 whisper_url = "https://api.groq.com/openai/v1/audio/transcriptions"
                 model_name = "whisper-large-v3-turbo"
             logger.info(f"🎙️ Trying OpenAI/Groq Whisper fallback at {whisper_url}")
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                clean_mime = "audio/ogg" if mime_type and "ogg" in mime_type else (mime_type or "audio/ogg")
-                files = {"file": ("voice_message.ogg", audio_bytes, clean_mime)}
-                data_w = {"model": model_name}
-                headers_w = {"Authorization": f"Bearer {api_key}"}
-                wres = await client.post(whisper_url, headers=headers_w, data=data_w, files=files)
-                if wres.status_code == 200:
-                    text_out = wres.json().get("text", "").strip()
-                    if text_out:
-                        logger.info(f"🎙️ Whisper fallback transcript: '{text_out[:120]}'")
-                        return text_out
-                else:
-                    logger.warning(f"🎙️ Whisper fallback HTTP {wres.status_code}: {wres.text[:200]}")
+            client = get_http_client(whisper_url)
+            clean_mime = "audio/ogg" if mime_type and "ogg" in mime_type else (mime_type or "audio/ogg")
+            files = {"file": ("voice_message.ogg", audio_bytes, clean_mime)}
+            data_w = {"model": model_name}
+            if language:
+                data_w["language"] = language
+            headers_w = {"Authorization": f"Bearer {api_key}"}
+            with stage_span("transcribe", audio_bytes=len(audio_bytes), fallback=model_name) as span:
+                wres = await client.post(whisper_url, headers=headers_w, data=data_w, files=files, timeout=30.0)
+                span.set(status=wres.status_code)
+            if wres.status_code == 200:
+                text_out = wres.json().get("text", "").strip()
+                if text_out:
+                    logger.info(f"🎙️ Whisper fallback transcript: '{text_out[:120]}'")
+                    return text_out
+            else:
+                logger.warning(f"🎙️ Whisper fallback HTTP {wres.status_code}: {wres.text[:200]}")
         except Exception as e_w:
             logger.error(f"🎙️ Whisper fallback exception: {e_w}")
 
@@ -230,6 +369,9 @@ async def synthesize_voice_note(text: str, voice: str = "en-NG-EzinneNeural") ->
     """
     Synthesize natural speech for WhatsApp voice notes (100% free, zero API cost via edge-tts).
     Returns OGG/OPUS bytes which WhatsApp renders as the native green voice note bubble.
+    Runs the sentence pipeline (app/services/voice_pipeline.py) over the complete text;
+    LLM replies are normally spoken while they stream instead (AgentContext.voice_stream).
+    Text that was spoken before in this voice is served from the TTS cache.
     Voices supported:
     - en-NG-EzinneNeural (Nigerian English - Female)
     - en-NG-AbeoNeural (Nigerian English - Male)
@@ -237,440 +379,754 @@ async def synthesize_voice_note(text: str, voice: str = "en-NG-EzinneNeural") ->
     - en-US-GuyNeural (US English - Male)
     - en-GB-SoniaNeural (British English - Female)
     """
-    import edge_tts
+    from app.services.voice_pipeline import synthesize_text
     try:
-        import re, io
-        clean_text = strip_emojis(text)
-        clean_text = re.sub(r"[\*\_~`#]", "", clean_text)
-        clean_text = re.sub(r"\[.*?\]", "", clean_text).strip()
-        if not clean_text:
-            clean_text = strip_emojis(text).strip()
-
-        # edge-tts produces MP3 by default. Collect MP3 bytes then convert to OGG.
-        communicate = edge_tts.Communicate(clean_text, voice or "en-NG-EzinneNeural")
-        mp3_chunks = []
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                mp3_chunks.append(chunk["data"])
-        mp3_bytes = b"".join(mp3_chunks)
-        if not mp3_bytes:
-            return b""
-
-        # Convert MP3 → OGG (opus) using the imageio-ffmpeg bundled binary
-        import imageio_ffmpeg
-        ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
-        with tempfile.TemporaryDirectory() as tmpdir:
-            mp3_path = os.path.join(tmpdir, "voice.mp3")
-            ogg_path = os.path.join(tmpdir, "voice.ogg")
-            with open(mp3_path, "wb") as f:
-                f.write(mp3_bytes)
-            proc = await asyncio.create_subprocess_exec(
-                ffmpeg_exe, "-y", "-i", mp3_path,
-                "-c:a", "libopus", "-b:a", "64k",
-                "-vbr", "on", ogg_path,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await proc.communicate()
-            if os.path.exists(ogg_path):
-                with open(ogg_path, "rb") as f:
-                    ogg_bytes = f.read()
-                logger.info(f"🎙️ Synthesized {len(ogg_bytes)} bytes of OGG/OPUS audio for WhatsApp voice note")
-                return ogg_bytes
-            else:
-                logger.warning("ffmpeg OGG conversion failed, falling back to raw MP3 bytes")
-                return mp3_bytes
+        return await synthesize_text(text, voice or "en-NG-EzinneNeural")
     except Exception as e:
         logger.error(f"Voice synthesis error: {e}")
         return b""
 
 
-async def trigger_ai_agent_reply(
-    contact_id: UUID,
-    incoming_text: str,
-    org_id: UUID,
-    db: Session,
-    audio_media_id: Optional[str] = None,
-    audio_mime_type: str = "audio/ogg"
-) -> Optional[Dict[str, Any]]:
+VOICE_PLACEHOLDERS = ("[Voice message]", "[Voice note]", "")
+
+
+async def _transcribe_meta_voice_note(
+    audio_media_id: str,
+    audio_mime_type: str,
+    meta_token: Optional[str],
+    ai_api_key: Optional[str],
+    provider: str,
+    base_url: Optional[str],
+    defer: Optional[Callable[[bytes, str], Any]] = None,
+    language: Optional[str] = None
+) -> Optional[str]:
     """
-    Main 24/7 backend agent orchestrator.
-    Called on every incoming message.
-    If audio_media_id is provided, downloads and transcribes the voice note
-    using the org's API key (guaranteed available here via ORM).
+    Download a voice note from Meta and transcribe it. Returns None on any failure.
+    defer(audio, mime) may hand a long note to the transcription job API instead
+    (raises TranscriptionDeferred when it did).
     """
+    if not meta_token:
+        logger.warning("🎙️ No WhatsApp access token on org — cannot download audio")
+        return None
+    logger.info(f"🎙️ Transcribing voice note {audio_media_id} inside agent service")
     try:
-        # 1. Fetch organization settings
-        org = db.query(Organization).filter(Organization.id == org_id).first()
+        _dl_headers = {
+            "Authorization": f"Bearer {meta_token}",
+            "User-Agent": "curl/7.64.1"
+        }
+        with stage_span("meta_media_fetch") as span:
+            _client = get_http_client("https://graph.facebook.com")
+            _info = await _client.get(
+                f"https://graph.facebook.com/v18.0/{audio_media_id}",
+                headers=_dl_headers,
+                timeout=30.0,
+                follow_redirects=True
+            )
+            logger.info(f"🎙️ Meta media info HTTP {_info.status_code}: {_info.text[:300]}")
+            if _info.status_code != 200:
+                logger.warning(f"Failed to fetch media metadata from Meta: HTTP {_info.status_code}")
+                return None
+            _down_url = _info.json().get("url")
+            _mime = _info.json().get("mime_type", audio_mime_type)
+            if not _down_url:
+                return None
+            _bin = await get_http_client(_down_url).get(_down_url, headers=_dl_headers, timeout=30.0, follow_redirects=True)
+            span.set(bytes=len(_bin.content))
+            logger.info(f"🎙️ Audio download HTTP {_bin.status_code}, bytes={len(_bin.content)}")
+        if _bin.status_code != 200 or not _bin.content:
+            return None
+
+        if defer is not None and should_defer(len(_bin.content)) and await defer(_bin.content, _mime):
+            raise TranscriptionDeferred(audio_media_id)
+
+        _transcript = await transcribe_voice_note(
+            audio_bytes=_bin.content,
+            mime_type=_mime,
+            api_key=ai_api_key,
+            provider=provider,
+            base_url=base_url,
+            language=language
+        )
+        if _transcript and len(_transcript) > 2:
+            logger.info(f"🎙️ ✅ Transcription SUCCESS: '{_transcript[:100]}'")
+            return _transcript
+        logger.warning(f"🎙️ Transcription returned empty for {audio_media_id}")
+    except TranscriptionDeferred:
+        raise
+    except Exception as _te:
+        logger.error(f"🎙️ Voice transcription inside agent failed: {_te}", exc_info=True)
+    return None
+
+
+def _save_transcript(db: Session, contact_id: UUID, transcript: str, message_id: Optional[str] = None):
+    """Store the transcript on the inbound voice message so dashboard Live Chats displays it."""
+    try:
+        query = db.query(Message).filter(
+            Message.contact_id == contact_id,
+            Message.type == "Inbound"
+        )
+        if message_id:
+            inbound = query.filter(Message.id == message_id).first()
+        else:
+            inbound = query.order_by(Message.created_at.desc()).first()
+        if inbound and inbound.content in ("[Voice message]", "[voice message]"):
+            inbound.content = f"🎙️ {transcript}"
+            db.commit()
+            logger.info(f"💾 Updated inbound message content in DB with transcript")
+    except Exception as db_err:
+        logger.warning(f"Failed to update message content in DB: {db_err}")
+        db.rollback()
+
+
+@dataclass
+class AgentContext:
+    """
+    Plain-value snapshot of what one reply needs from the database.
+    The slow external phase (transcription, LLM, TTS, Meta send) reads only this,
+    never ORM objects, so it runs without holding a pooled connection.
+    """
+    org_id: UUID
+    contact_id: UUID
+    now: datetime
+    org_name: str
+    ai_name: str
+    biz_type: str
+    tone: str
+    payment_link: str
+    ai_provider: str
+    ai_model: str
+    ai_api_key: str
+    ai_base_url: Optional[str]
+    voice_reply_mode: str
+    voice_name: str
+    wa_config: Dict[str, Any]
+    meta_token: Optional[str]
+    inbound: List[Dict[str, Any]] = field(default_factory=list)
+    contact_name: str = ""
+    contact_category: Optional[str] = None
+    contact_phone: Optional[str] = None
+    contact_notes: Optional[str] = None
+    # (message_id, type, content) of the last agent_history_recent_turns messages, oldest first
+    history: List[Tuple[str, str, str]] = field(default_factory=list)
+    # Rolling summary of older turns and the contact's profile card (see conversation_summary_service)
+    conversation_summary: str = ""
+    profile_card: str = ""
+    session_id: Optional[UUID] = None
+    session_prompt: str = ""
+    collected_data: Dict[str, Any] = field(default_factory=dict)
+    available_files_str: str = "None uploaded yet."
+    # Org override of settings.agent_prompt_token_budget
+    prompt_token_budget: Optional[int] = None
+    # Primary provider + fallback chain (LLMTarget) and whether to hedge slow requests
+    llm_targets: List[Any] = field(default_factory=list)
+    hedge_enabled: bool = False
+    # RateLimits for the org's keys (None = server defaults)
+    rate_limits: Optional[Any] = None
+    # Semantic reply cache (opt-in); entries are only valid for this knowledge base version
+    reply_cache_enabled: bool = False
+    reply_cache_threshold: Optional[float] = None
+    knowledge_version: int = 0
+    # Local fast path for trivial turns: enabled flag and per-intent template overrides
+    fast_path_enabled: bool = True
+    quick_replies: Tuple[Tuple[str, Tuple[str, ...]], ...] = ()
+    conversation_status: str = "open"
+    # Voice note synthesized while the LLM reply streams (voice_pipeline.VoiceNoteStream)
+    voice_stream: Optional[Any] = None
+    # A long voice note may park the reply on the transcription job API (queued replies only)
+    defer_transcription: bool = False
+    # Language hint for voice notes (skips detection); None = detect
+    transcription_language: Optional[str] = None
+
+
+def _should_send_voice(ctx: AgentContext, incoming_text: str) -> bool:
+    """Reply with a voice note: org voice mode (or match_input on a voice turn) and Meta delivery."""
+    is_inbound_voice = incoming_text.startswith("[Voice Note") or incoming_text.startswith("[Voice message") or any(
+        entry.get("audio_media_id") for entry in ctx.inbound
+    )
+    should_send_voice = (ctx.voice_reply_mode == "voice") or (ctx.voice_reply_mode == "match_input" and is_inbound_voice)
+    return should_send_voice and ctx.wa_config.get("delivery_method") == "meta"
+
+
+def _release_connection(db: Session):
+    """End the current unit of work so the session hands its pooled connection back."""
+    db.commit()
+
+
+def _load_org_context(
+    db: Session,
+    org_id: UUID,
+    contact_id: UUID,
+    inbound: List[Dict[str, Any]]
+) -> Optional[AgentContext]:
+    """DB phase 1: org settings, delivery config and the voice note media id (everything the external calls need)."""
+    try:
+        org = get_org_config(db, org_id)
         if not org:
             logger.warning(f"Organization {org_id} not found for agent reply.")
             return None
 
-        # Check if auto-reply is enabled (or stored as string "true")
-        auto_enabled = str(org.ai_auto_reply_enabled).lower() == "true"
-        if not auto_enabled:
-            logger.info(f"AI Auto-reply is disabled for org {org.name} ({org.id}).")
+        # Check if auto-reply is enabled
+        if not org.ai_auto_reply_enabled:
+            logger.info(f"AI Auto-reply is disabled for org {org.name} ({org.org_id}).")
             return None
 
-        ai_api_key = org.ai_api_key
-        if not ai_api_key:
+        if not org.ai_api_key:
             logger.warning(f"No AI API key configured for org {org.name}.")
             return None
 
-        # 1b. If a voice note was sent, transcribe it NOW
-        from app.api.whatsapp import get_organization_whatsapp_config
-        wa_config = get_organization_whatsapp_config(db, org_id)
-        _meta_token = getattr(org, "whatsapp_access_token", None) or getattr(org, "access_token", None) or wa_config.get("access_token")
-
-        if not audio_media_id and incoming_text in ("[Voice message]", "[Voice note]", ""):
+        if len(inbound) == 1 and not inbound[0].get("audio_media_id") and inbound[0].get("content", "") in VOICE_PLACEHOLDERS:
             # Try to find attachment_url from the latest inbound message for this contact
             latest_msg = db.query(Message).filter(
                 Message.contact_id == contact_id,
                 Message.type == "Inbound"
             ).order_by(Message.created_at.desc()).first()
             if latest_msg and latest_msg.attachment_url and latest_msg.attachment_url.startswith("meta_media_id:"):
-                audio_media_id = latest_msg.attachment_url.replace("meta_media_id:", "").strip()
-                logger.info(f"🎙️ Extracted audio_media_id '{audio_media_id}' from latest inbound message attachment_url")
-
-        if audio_media_id and incoming_text in ("[Voice message]", "[Voice note]", ""):
-            logger.info(f"🎙️ Transcribing voice note {audio_media_id} inside agent service")
-            try:
-                import httpx as _httpx
-                if _meta_token:
-                    _dl_headers = {
-                        "Authorization": f"Bearer {_meta_token}",
-                        "User-Agent": "curl/7.64.1"
-                    }
-                    async with _httpx.AsyncClient(timeout=30.0, follow_redirects=True) as _client:
-                        _info = await _client.get(
-                            f"https://graph.facebook.com/v18.0/{audio_media_id}",
-                            headers=_dl_headers
-                        )
-                        logger.info(f"🎙️ Meta media info HTTP {_info.status_code}: {_info.text[:300]}")
-                        if _info.status_code == 200:
-                            _down_url = _info.json().get("url")
-                            _mime = _info.json().get("mime_type", audio_mime_type)
-                            if _down_url:
-                                _bin = await _client.get(_down_url, headers=_dl_headers)
-                                logger.info(f"🎙️ Audio download HTTP {_bin.status_code}, bytes={len(_bin.content)}")
-                                if _bin.status_code == 200 and _bin.content:
-                                    _transcript = await transcribe_voice_note(
-                                        audio_bytes=_bin.content,
-                                        mime_type=_mime,
-                                        api_key=ai_api_key,
-                                        provider=getattr(org, "ai_provider", "gemini") or "gemini",
-                                        base_url=getattr(org, "ai_base_url", None)
-                                    )
-                                    if _transcript and len(_transcript) > 2:
-                                        incoming_text = f"[Voice Note]: {_transcript}"
-                                        logger.info(f"🎙️ ✅ Transcription SUCCESS: '{_transcript[:100]}'")
-                                        # Update latest inbound message in database so dashboard Live Chats displays the transcription
-                                        try:
-                                            latest_inbound = db.query(Message).filter(
-                                                Message.contact_id == contact_id,
-                                                Message.type == "Inbound"
-                                            ).order_by(Message.created_at.desc()).first()
-                                            if latest_inbound and latest_inbound.content in ("[Voice message]", "[voice message]"):
-                                                latest_inbound.content = f"🎙️ {_transcript}"
-                                                db.commit()
-                                                logger.info(f"💾 Updated inbound message content in DB with transcript")
-                                        except Exception as db_err:
-                                            logger.warning(f"Failed to update message content in DB: {db_err}")
-                                    else:
-                                        incoming_text = "[Voice message — transcription failed]"
-                                        logger.warning(f"🎙️ Transcription returned empty for {audio_media_id}")
-                        else:
-                            incoming_text = "[Voice message — transcription failed]"
-                            logger.warning(f"Failed to fetch media metadata from Meta: HTTP {_info.status_code}")
-                else:
-                    logger.warning("🎙️ No WhatsApp access token on org — cannot download audio")
-            except Exception as _te:
-                incoming_text = "[Voice message — transcription failed]"
-                logger.error(f"🎙️ Voice transcription inside agent failed: {_te}", exc_info=True)
-
+                inbound[0]["audio_media_id"] = latest_msg.attachment_url.replace("meta_media_id:", "").strip()
+                inbound[0]["message_id"] = str(latest_msg.id)
+                logger.info(f"🎙️ Extracted audio_media_id '{inbound[0]['audio_media_id']}' from latest inbound message attachment_url")
+
+        return AgentContext(
+            org_id=org_id,
+            contact_id=contact_id,
+            now=datetime.utcnow(),
+            org_name=org.name or "Our Organization",
+            ai_name=org.ai_name or "Shepherd AI",
+            biz_type=org.ai_business_type or "Organization",
+            tone=org.ai_tone or "Warm, professional, and helpful. WhatsApp-friendly.",
+            payment_link=org.ai_payment_link or "Not configured",
+            ai_provider=org.ai_provider,
+            ai_model=org.ai_model,
+            ai_api_key=org.ai_api_key,
+            ai_base_url=org.ai_base_url,
+            voice_reply_mode=org.ai_voice_reply_mode,
+            voice_name=org.ai_voice_name,
+            wa_config=org.whatsapp_config(),
+            meta_token=org.whatsapp_access_token,
+            inbound=inbound,
+            prompt_token_budget=org.ai_prompt_token_budget,
+            llm_targets=org.llm_targets(),
+            hedge_enabled=org.ai_hedge_enabled,
+            rate_limits=org.rate_limits(),
+            reply_cache_enabled=org.ai_reply_cache_enabled,
+            reply_cache_threshold=org.ai_reply_cache_threshold,
+            knowledge_version=org.knowledge_version,
+            fast_path_enabled=org.ai_fast_path_enabled,
+            quick_replies=org.ai_quick_replies,
+            transcription_language=org.ai_transcription_language,
+        )
+    finally:
+        _release_connection(db)
 
 
-        # 2. Check contact and human handover state
-        contact = db.query(Contact).filter(Contact.id == contact_id).first()
+def _load_contact_context(db: Session, ctx: AgentContext) -> bool:
+    """
+    DB phase 2: contact and handover state, history, active flow session and media library,
+    in one unit of work. Returns False when the contact is missing or a human has taken over.
+    """
+    try:
+        contact = db.query(Contact).filter(Contact.id == ctx.contact_id).first()
         if not contact:
-            logger.warning(f"Contact {contact_id} not found.")
-            return None
+            logger.warning(f"Contact {ctx.contact_id} not found.")
+            return False
 
-        now = datetime.utcnow()
         if contact.ai_paused_until:
             # Handle timezone-aware comparison
             paused_time = contact.ai_paused_until.replace(tzinfo=None)
-            if paused_time > now:
+            if paused_time > ctx.now:
                 logger.info(f"AI is paused for contact {contact.name} until {contact.ai_paused_until} (human in control).")
-                return None
+                return False
+
+        ctx.contact_name = contact.name
+        ctx.conversation_status = contact.conversation_status or "open"
+        ctx.contact_category = contact.category
+        ctx.contact_phone = contact.phone
+        ctx.contact_notes = contact.notes
 
-        # 3. Retrieve conversation history (last 8 messages)
         history_msgs = db.query(Message).filter(
-            Message.contact_id == contact_id
-        ).order_by(Message.created_at.desc()).limit(8).all()
+            Message.contact_id == ctx.contact_id
+        ).order_by(Message.created_at.desc()).limit(settings.agent_history_recent_turns).all()
         history_msgs.reverse()
+        ctx.history = [(str(m.id), m.type, m.content) for m in history_msgs]
 
-        history_lines = []
-        for m in history_msgs:
-            sender = org.ai_name if m.type == "Outbound" else contact.name
-            history_lines.append(f"{sender}: {m.content}")
-        history_text = "\n".join(history_lines) if history_lines else "No previous conversation."
+        summary = db.query(ConversationSummary).filter(ConversationSummary.contact_id == ctx.contact_id).first()
+        if summary:
+            ctx.conversation_summary = summary.summary or ""
+            ctx.profile_card = summary.profile_card or ""
 
-        # 4. RAG semantic knowledge retrieval
-        kb_chunks = []
-        try:
-            results = await search_knowledge_base(db, str(org_id), incoming_text, limit=3, api_key=ai_api_key)
-            for res, sim in results:
-                kb_chunks.append(f"--- {res.title} ---\n{res.content[:500]}")
-        except Exception as rag_err:
-            logger.warning(f"RAG search error: {rag_err}")
-
-        kb_context = "\n\n".join(kb_chunks) if kb_chunks else "No specific knowledge base entry matched."
-
-        # 5. Check active multi-turn session
+        # Check active multi-turn session
         session = db.query(ConversationSession).filter(
-            ConversationSession.contact_id == contact_id,
-            ConversationSession.expires_at > now
+            ConversationSession.contact_id == ctx.contact_id,
+            ConversationSession.expires_at > ctx.now
         ).first()
 
-        session_prompt = ""
-        collected_data = {}
         if session:
+            ctx.session_id = session.id
             try:
-                collected_data = json.loads(session.collected_slots or "{}")
+                ctx.collected_data = json.loads(session.collected_slots or "{}")
             except:
-                collected_data = {}
-            session_prompt = f"""
+                ctx.collected_data = {}
+            ctx.session_prompt = f"""
 CURRENT ACTIVE FLOW: {session.active_flow.upper()}
-Collected Information so far: {json.dumps(collected_data)}
+Collected Information so far: {json.dumps(ctx.collected_data)}
 Your task: Continue this flow naturally. Ask for whatever is still missing.
 """
 
-        # 6. Fetch available media files from media_library table
+        # Fetch available media files from media_library table
         available_files_list = []
         try:
             rows = db.execute(
                 text("SELECT name, type, description FROM media_library WHERE organization_id = :org_id LIMIT 15"),
-                {"org_id": str(org_id)}
+                {"org_id": str(ctx.org_id)}
             ).fetchall()
             for r in rows:
                 available_files_list.append(f"'{r[0]}' ({r[1]} - {r[2] or 'No desc'})")
         except Exception as media_err:
             logger.warning(f"Media fetch error: {media_err}")
+            db.rollback()
+
+        ctx.available_files_str = ", ".join(available_files_list) if available_files_list else "None uploaded yet."
+        return True
+    finally:
+        _release_connection(db)
+
+
+def _render_history(ctx: AgentContext, transcripts: List[Tuple[Optional[str], str]]) -> str:
+    """History text, with voice notes transcribed during this reply shown as their transcript."""
+    by_id = {message_id: transcript for message_id, transcript in transcripts if message_id}
+    latest_transcript = next((t for message_id, t in transcripts if not message_id), None)
+    lines = []
+    for message_id, msg_type, content in reversed(ctx.history):
+        if content in ("[Voice message]", "[voice message]"):
+            if message_id in by_id:
+                content = f"🎙️ {by_id[message_id]}"
+            elif latest_transcript and msg_type == "Inbound":
+                content = f"🎙️ {latest_transcript}"
+                latest_transcript = None
+        sender = ctx.ai_name if msg_type == "Outbound" else ctx.contact_name
+        lines.append(f"{sender}: {truncate_turn(content)}")
+    lines.reverse()
+    return "\n".join(lines) if lines else "No previous conversation."
+
+
+async def _transcribe_inbound(ctx: AgentContext) -> List[Tuple[Optional[str], str]]:
+    """External phase: transcribe the voice notes in the mailbox concurrently. Returns (message_id, transcript) pairs to persist."""
+    pending = [
+        entry for entry in ctx.inbound
+        if entry.get("audio_media_id") and (entry.get("content") or "") in VOICE_PLACEHOLDERS
+    ]
+    if not pending:
+        return []
+    if not ctx.meta_token:
+        logger.warning("🎙️ No WhatsApp access token on org — cannot download audio")
+        return []
+
+    defer = None
+    # Only a lone voice note parks the reply: several would need several results to resume
+    if ctx.defer_transcription and len(pending) == 1 and not pending[0].get("transcribe_sync"):
+        parked = pending[0]
+
+        def defer(audio: bytes, mime: str):
+            return defer_transcription(
+                ctx.org_id, ctx.contact_id, ctx.inbound, parked["audio_media_id"], audio, mime,
+                language=ctx.transcription_language
+            )
 
-        available_files_str = ", ".join(available_files_list) if available_files_list else "None uploaded yet."
-
-        # 7. Build real-time calendar & clock context
-        today_day_name = now.strftime("%A")
-        today_date_str = now.strftime("%Y-%m-%d")
-        tomorrow_dt = now + timedelta(days=1)
-        tomorrow_day_name = tomorrow_dt.strftime("%A")
-        tomorrow_date_str = tomorrow_dt.strftime("%Y-%m-%d")
-        current_time_str = now.strftime("%I:%M %p").lstrip("0")
-
-        ai_name = org.ai_name or "Shepherd AI"
-        org_name = org.name or "Our Organization"
-        biz_type = org.ai_business_type or "Organization"
-        tone = org.ai_tone or "Warm, professional, and helpful. WhatsApp-friendly."
-        payment_link = org.ai_payment_link or "Not configured"
-
-        system_prompt = f"""You are {ai_name}, the AI representative for {org_name} ({biz_type}).
-
-CURRENT CALENDAR & CLOCK CONTEXT:
-- Today is: {today_day_name}, {now.strftime('%B %d, %Y')} ({today_date_str})
-- Current Time: {current_time_str}
-- Tomorrow is: {tomorrow_day_name}, {tomorrow_dt.strftime('%B %d, %Y')} ({tomorrow_date_str})
-
-CONTACT DETAILS:
-- Name: {contact.name}
-- Category: {contact.category}
-- Phone: {contact.phone}
-{f'- Notes: {contact.notes}' if contact.notes else ''}
-
-TONE & STYLE:
-{tone}
-Write WhatsApp-appropriate messages (concise, warm, attentive, helpful, natural). Never sound like an emotionless robot. Always answer greetings, check-ins ("are you there", "hello"), and continue conversations seamlessly.
-
-KNOWLEDGE BASE:
-{kb_context}
-
-AVAILABLE FILES TO DELIVER:
-{available_files_str}
-
-PAYMENT LINK:
-{payment_link}
-
-{session_prompt}
-
-CONVERSATION HISTORY:
-{history_text}
-
-APPOINTMENT & BOOKING RULES:
-1. When a contact wants to book, find out: (1) Purpose/Topic, (2) Date, (3) Time.
-2. When the contact gives relative dates like "tomorrow", "this time tomorrow", "Friday at 2pm", ALWAYS convert:
-   - "preferredDate": Exact ISO date format "{tomorrow_date_str}" (YYYY-MM-DD). NEVER return relative words.
-   - "preferredTime": Standard 12-hour format "{current_time_str}" (e.g. "10:30 PM", "03:00 PM").
-3. When confirming an appointment or when the contact says "yes", "correct", or confirms details:
-   - Set "type": "CREATE_BOOKING" with finalized "purpose", "preferredDate" (YYYY-MM-DD), and "preferredTime" (HH:MM AM/PM).
-   - Your "reply" MUST explicitly confirm the booking to the contact (e.g. "Awesome, {contact.name}! Your appointment for [Topic] is booked for tomorrow, {tomorrow_dt.strftime('%B %d, %Y')} at {current_time_str}. Looking forward to speaking with you!").
-
-NO EMOJIS RULE:
-- NEVER use emojis, smileys, or emoticons in your replies (do NOT use emojis like 😊, 🙌, 🎉, etc.).
-- Keep all responses completely free of emojis in both text and voice notes.
-
-VOICE NOTE RULES:
-- When a customer sends a voice message that was successfully transcribed, it appears as "[Voice Note]: <transcription>". Answer their message directly, warmly, and helpfully as if they spoke to you.
-- If the message is exactly "[Voice message]" (NOT "[Voice Note]: ..."), it means the audio could NOT be transcribed. In this case, politely let them know you heard their voice message but couldn't make it out clearly, and ask them to send it again or type it out. Example: "Hey, I got your voice message but couldn't quite make it out! Could you type it out or try sending it again?"
-- NEVER say "Thanks for your voice message, I'm here and ready to listen. What's on your mind?" — this sounds robotic.
-- NEVER say "I cannot listen to voice notes" — you CAN listen to them most of the time.
-
-
-
-RESPONSE FORMAT — You must return ONLY a JSON object:
-{{
-  "reply": "Your WhatsApp response text to the contact",
-  "action": {{
-    "type": "NONE",
-    "documentName": "",
-    "imageName": "",
-    "purpose": "",
-    "preferredDate": "",
-    "preferredTime": "",
-    "query": "",
-    "reason": ""
-  }}
-}}
-
-ACTION TYPE GUIDE:
-- NONE: standard conversational reply / answering greetings and questions
-- CREATE_BOOKING: customer wants to book/schedule an appointment (include purpose, preferredDate YYYY-MM-DD, preferredTime HH:MM AM/PM)
-- SEND_DOCUMENT: customer asks for a document, price list, menu, PDF, or form
-- SEND_IMAGE: customer asks for a photo, map, or picture
-- SEND_PAYMENT_LINK: customer asks how to pay, fees, pricing, or purchase
-- WEB_SEARCH: customer asks factual/timely question not in knowledge base
-- FLAG_FOR_HUMAN: customer is in crisis, angry, or asks for a human manager
-"""
+    results = await asyncio.gather(*[
+        _transcribe_meta_voice_note(
+            entry["audio_media_id"], entry.get("audio_mime_type") or "audio/ogg",
+            ctx.meta_token, ctx.ai_api_key, ctx.ai_provider, ctx.ai_base_url,
+            defer=defer, language=ctx.transcription_language
+        )
+        for entry in pending
+    ])
+    transcripts = []
+    for entry, transcript in zip(pending, results):
+        if transcript:
+            entry["content"] = f"[Voice Note]: {transcript}"
+            transcripts.append((entry.get("message_id"), transcript))
+        else:
+            entry["content"] = TRANSCRIPTION_FAILED
+    return transcripts
 
-        user_turn = f"New message from {contact.name}:\n\"{incoming_text}\"\n\nGenerate your JSON response."
 
-        # 8. Call AI Provider
-        raw_reply = await call_ai_provider(
-            provider=org.ai_provider or "gemini",
-            api_key=ai_api_key,
-            model=org.ai_model or "gemini-2.0-flash",
-            system_prompt=system_prompt,
-            user_turn=user_turn,
-            base_url=org.ai_base_url
-        )
+def _inbound_text(ctx: AgentContext) -> str:
+    return "\n".join(entry["content"] for entry in ctx.inbound if entry.get("content"))
 
-        parsed = parse_agent_response(raw_reply)
-        reply_text = parsed.get("reply", "")
-        action = parsed.get("action", {})
-        action_type = action.get("type", "NONE")
 
-        if not reply_text:
-            logger.warning("AI Agent returned empty reply.")
-            return None
+async def _prepare_query(ctx: AgentContext) -> Tuple[List[Tuple[Optional[str], str]], str, List[float]]:
+    """
+    External phase: transcribe voice notes, then embed the final message text for RAG.
+    For plain text the embedding call starts immediately.
+    """
+    transcripts = await _transcribe_inbound(ctx)
+    incoming_text = _inbound_text(ctx)
+    query_embedding = []
+    if incoming_text:
+        with stage_span("embedding", chars=len(incoming_text)):
+            query_embedding = await generate_embedding(incoming_text, api_key=ctx.ai_api_key)
+    return transcripts, incoming_text, query_embedding
+
+
+def _search_kb_chunks(db: Session, ctx: AgentContext, incoming_text: str, query_embedding: List[float]) -> List[str]:
+    """DB phase: vector / keyword KB search with a precomputed embedding."""
+    kb_chunks = []
+    try:
+        results = search_knowledge_base_sync(db, str(ctx.org_id), incoming_text, limit=3, query_embedding=query_embedding)
+        for res, sim in results:
+            kb_chunks.append(f"--- {res.title} ---\n{truncate_to_tokens(res.content, KB_CHUNK_MAX_TOKENS)}")
+    except Exception as rag_err:
+        logger.warning(f"RAG search error: {rag_err}")
+        db.rollback()
+    finally:
+        _release_connection(db)
+    return kb_chunks
 
-        # 9. Process Intent Actions
-        if action_type == "FLAG_FOR_HUMAN":
+
+def _apply_intent_action(db: Session, ctx: AgentContext, action: Dict[str, Any], reply_text: str) -> str:
+    """DB phase 3: escalation / booking side effects. Returns the (possibly replaced) reply text."""
+    now = ctx.now
+    action_type = action.get("type", "NONE")
+    collected_data = ctx.collected_data
+    session = ctx.session_id is not None
+
+    if action_type == "FLAG_FOR_HUMAN":
+        contact = db.query(Contact).filter(Contact.id == ctx.contact_id).first()
+        if contact:
             contact.conversation_status = "escalated"
             contact.ai_paused_until = now + timedelta(hours=12)
             db.commit()
-            logger.info(f"🚩 Chat with {contact.name} flagged for human triage.")
-            if not reply_text:
-                reply_text = "I've escalated your message to our leadership team. A representative will reach out to you shortly."
-
-        elif action_type == "CREATE_BOOKING":
-            purpose = action.get("purpose") or (collected_data.get("purpose") if session else None) or "Appointment"
-            raw_date = (action.get("preferredDate") or (collected_data.get("date") if session else None) or "").strip().lower()
-            raw_time = (action.get("preferredTime") or (collected_data.get("time") if session else None) or "").strip()
-
-            # Resolve relative dates (tomorrow / today / ISO)
-            import re
-            resolved_date = ""
-            if "tomorrow" in raw_date:
-                resolved_date = (now + timedelta(days=1)).strftime("%Y-%m-%d")
-            elif "today" in raw_date:
-                resolved_date = now.strftime("%Y-%m-%d")
-            elif re.search(r"\b\d{4}-\d{2}-\d{2}\b", raw_date):
-                resolved_date = re.search(r"\b\d{4}-\d{2}-\d{2}\b", raw_date).group(0)
-            else:
-                resolved_date = (now + timedelta(days=1)).strftime("%Y-%m-%d")
+        logger.info(f"🚩 Chat with {ctx.contact_name} flagged for human triage.")
+        if not reply_text:
+            reply_text = "I've escalated your message to our leadership team. A representative will reach out to you shortly."
+
+    elif action_type == "CREATE_BOOKING":
+        purpose = action.get("purpose") or (collected_data.get("purpose") if session else None) or "Appointment"
+        raw_date = (action.get("preferredDate") or (collected_data.get("date") if session else None) or "").strip().lower()
+        raw_time = (action.get("preferredTime") or (collected_data.get("time") if session else None) or "").strip()
+
+        # Resolve relative dates (tomorrow / today / ISO)
+        resolved_date = ""
+        if "tomorrow" in raw_date:
+            resolved_date = (now + timedelta(days=1)).strftime("%Y-%m-%d")
+        elif "today" in raw_date:
+            resolved_date = now.strftime("%Y-%m-%d")
+        elif re.search(r"\b\d{4}-\d{2}-\d{2}\b", raw_date):
+            resolved_date = re.search(r"\b\d{4}-\d{2}-\d{2}\b", raw_date).group(0)
+        else:
+            resolved_date = (now + timedelta(days=1)).strftime("%Y-%m-%d")
 
-            # Resolve time
-            resolved_time = ""
-            if not raw_time or "this time" in raw_time.lower() or "around" in raw_time.lower() or raw_time.lower() == "now":
-                resolved_time = now.strftime("%I:%M %p").lstrip("0")
-            else:
-                resolved_time = raw_time
-
-            # Create confirmed booking in DB
-            booking = Booking(
-                contact_id=contact.id,
-                contact_name=contact.name,
-                contact_phone=contact.phone,
-                purpose=purpose,
-                date=resolved_date,
-                time=resolved_time,
-                notes=f"Auto-created by AI Agent on {now.strftime('%Y-%m-%d %H:%M')}",
-                status="confirmed"
-            )
-            db.add(booking)
+        # Resolve time
+        resolved_time = ""
+        if not raw_time or "this time" in raw_time.lower() or "around" in raw_time.lower() or raw_time.lower() == "now":
+            resolved_time = now.strftime("%I:%M %p").lstrip("0")
+        else:
+            resolved_time = raw_time
+
+        # Create confirmed booking in DB
+        booking = Booking(
+            contact_id=ctx.contact_id,
+            contact_name=ctx.contact_name,
+            contact_phone=ctx.contact_phone,
+            purpose=purpose,
+            date=resolved_date,
+            time=resolved_time,
+            notes=f"Auto-created by AI Agent on {now.strftime('%Y-%m-%d %H:%M')}",
+            status="confirmed"
+        )
+        db.add(booking)
+        db.commit()
+        logger.info(f"📅 Booking confirmed for {ctx.contact_name}: {purpose} on {resolved_date} at {resolved_time}")
+
+        if session:
+            db.query(ConversationSession).filter(ConversationSession.id == ctx.session_id).delete()
             db.commit()
-            logger.info(f"📅 Booking confirmed for {contact.name}: {purpose} on {resolved_date} at {resolved_time}")
 
-            if session:
-                db.delete(session)
-                db.commit()
+    return reply_text
+
+
+def _save_outbound_message(db: Session, ctx: AgentContext, reply_text: str, **fields) -> str:
+    """DB phase 4: record the delivered (or queued) reply. Returns the message id."""
+    out_msg_id = uuid4()
+    out_msg = Message(
+        id=out_msg_id,
+        organization_id=ctx.org_id,
+        contact_id=ctx.contact_id,
+        content=reply_text,
+        type="Outbound",
+        **fields
+    )
+    db.add(out_msg)
+    db.commit()
+    return str(out_msg_id)
+
+
+async def _compose_reply(
+    db: Session,
+    ctx: AgentContext,
+    transcripts: List[Tuple[Optional[str], str]],
+    incoming_text: str,
+    query_embedding: List[float],
+    gather_start: float,
+    priority: Optional[str] = None,
+    stream_voice: bool = False
+) -> Optional[Tuple[str, Dict[str, Any], str]]:
+    """
+    Reply text, action and source ("reply_cache" or "llm") for a turn that needs the agent.
+    Returns None when the model produced an empty reply. With stream_voice, a voice reply
+    is synthesized while the LLM streams and left in ctx.voice_stream for delivery.
+    """
+    # 4a. Persist transcripts so dashboard Live Chats shows them
+    for message_id, transcript in transcripts:
+        with stage_span("save_transcript"):
+            await asyncio.to_thread(_save_transcript, db, ctx.contact_id, transcript, message_id)
+
+    # 4b. Semantic reply cache (opt-in): a near-identical generic question skips KB search and the LLM
+    cached = None
+    use_reply_cache = should_lookup(ctx, incoming_text, query_embedding)
+    if use_reply_cache:
+        with stage_span("reply_cache_lookup") as span:
+            cached = await asyncio.to_thread(lookup_cached_reply, db, ctx, query_embedding)
+            span.set(hit=cached is not None)
+
+    if cached:
+        metrics.observe("agent_context_seconds", time.monotonic() - gather_start)
+        logger.info(f"♻️ Serving cached reply (similarity {cached.similarity:.3f}) to {ctx.contact_name}")
+        return cached.reply, cached.action, "reply_cache"
+
+    # 4c. The short vector query
+    with stage_span("kb_search") as span:
+        kb_chunks = await asyncio.to_thread(_search_kb_chunks, db, ctx, incoming_text, query_embedding)
+        span.set(chunks=len(kb_chunks))
+    metrics.observe("agent_context_seconds", time.monotonic() - gather_start)
+    history_text = _render_history(ctx, transcripts)
+
+    kb_context = "\n\n".join(kb_chunks) if kb_chunks else "No specific knowledge base entry matched."
+
+    # 4d. Build the prompt: stable per-org prefix as the system prompt (cacheable by the
+    #     provider), clock/contact/flow/KB/history and the new message in the user turn
+    system_prompt, user_turn = build_agent_prompt(ctx, kb_context, history_text, incoming_text)
+    logger.debug(f"Prompt prefix {prefix_fingerprint(system_prompt)} for org {ctx.org_id}")
+
+    # 4e. Call AI Provider (primary, then the org's fallback chain; optionally hedged)
+    from app.services.llm_router_service import llm_router, LLMTarget
+    from app.services.ai_rate_limiter import PRIORITY_INTERACTIVE
+    targets = ctx.llm_targets or [LLMTarget(ctx.ai_provider, ctx.ai_api_key, ctx.ai_model, ctx.ai_base_url)]
+    if stream_voice and settings.voice_streaming_enabled and _should_send_voice(ctx, incoming_text):
+        from app.services.voice_pipeline import VoiceNoteStream
+        ctx.voice_stream = VoiceNoteStream(ctx.voice_name)
+    try:
+        with stage_span("llm", streamed=ctx.voice_stream is not None) as span:
+            raw_reply = await llm_router.complete(
+                targets,
+                system_prompt=system_prompt,
+                user_turn=user_turn,
+                hedge=ctx.hedge_enabled,
+                limits=ctx.rate_limits,
+                priority=priority or PRIORITY_INTERACTIVE,
+                on_text=ctx.voice_stream.feed_json if ctx.voice_stream else None
+            )
+            span.set(reply_chars=len(raw_reply or ""))
+    except BaseException:
+        if ctx.voice_stream:
+            await ctx.voice_stream.cancel()
+        raise
+
+    parsed = parse_agent_response(raw_reply)
+    reply_text = parsed.get("reply", "")
+    action = parsed.get("action", {})
+
+    if not reply_text:
+        logger.warning("AI Agent returned empty reply.")
+        if ctx.voice_stream:
+            await ctx.voice_stream.cancel()
+        return None
+
+    if use_reply_cache and is_cacheable(ctx, parsed):
+        with stage_span("reply_cache_store"):
+            await asyncio.to_thread(store_cached_reply, db, ctx, incoming_text, query_embedding, reply_text, action)
+    return reply_text, action, "llm"
+
+
+async def _prepare_reply(
+    db: Session,
+    org_id: UUID,
+    contact_id: UUID,
+    inbound: List[Dict[str, Any]],
+    priority: Optional[str] = None,
+    stream_voice: bool = False,
+    defer_transcription: bool = False
+) -> Optional[Tuple[AgentContext, str, str, Dict[str, Any], str]]:
+    """
+    Steps 1-4, shared by auto-replies and suggest-mode drafts: load context, then a
+    fast-path template or the agent's reply. Writes nothing but transcripts and reply
+    cache entries. Returns (ctx, incoming_text, reply_text, action, source), or None
+    when there is nothing to send. stream_voice: see _compose_reply. With
+    defer_transcription, a long voice note raises TranscriptionDeferred (see
+    transcription_job_service).
+    """
+    # 1. Load org settings (AI key, delivery config)
+    with stage_span("db_load_org"):
+        ctx = await asyncio.to_thread(_load_org_context, db, org_id, contact_id, inbound)
+    if not ctx:
+        return None
+    ctx.defer_transcription = defer_transcription
+
+    # 2. Gather context concurrently: contact/history/session/media in one DB unit on a
+    #    worker thread, overlapped with voice-note transcription and the query embedding.
+    #    Trivial text turns (greetings, thanks, "ok") are classified locally first and
+    #    skip the embedding unless they fall back to the agent.
+    gather_start = time.monotonic()
+    quick_intent = None
+    if ctx.fast_path_enabled and not any(entry.get("audio_media_id") for entry in ctx.inbound):
+        quick_intent = classify_trivial_intent(_inbound_text(ctx))
+    query_task = None if quick_intent else asyncio.create_task(_prepare_query(ctx))
+    try:
+        with stage_span("db_load_contact"):
+            contact_ok = await asyncio.to_thread(_load_contact_context, db, ctx)
+    except BaseException:
+        if query_task:
+            query_task.cancel()
+        raise
+    if not contact_ok:
+        if query_task:
+            query_task.cancel()
+        return None
+
+    # 3. Fast path: templated reply, after the pause check and only outside escalations and flows
+    quick_reply = fast_path_reply(ctx, quick_intent)
+    if quick_reply is not None:
+        incoming_text = _inbound_text(ctx)
+        if not quick_reply:
+            logger.info(f"🤫 No reply to '{quick_intent}' from {ctx.contact_name} (silenced in org quick replies)")
+            return None
+        logger.info(f"⚡ Fast-path '{quick_intent}' reply to {ctx.contact_name}, LLM skipped")
+        reply_text, action, source = quick_reply, {"type": "NONE"}, "fast_path"
+    else:
+        # 4. Everything else goes to the agent (reply cache, RAG, LLM)
+        if query_task is None:
+            query_task = asyncio.create_task(_prepare_query(ctx))
+        transcripts, incoming_text, query_embedding = await query_task
+        composed = await _compose_reply(db, ctx, transcripts, incoming_text, query_embedding, gather_start, priority, stream_voice)
+        if not composed:
+            return None
+        reply_text, action, source = composed
+    return ctx, incoming_text, reply_text, action, source
+
+
+async def trigger_ai_agent_reply(
+    contact_id: UUID,
+    incoming_text: str,
+    org_id: UUID,
+    db: Session,
+    audio_media_id: Optional[str] = None,
+    audio_mime_type: str = "audio/ogg",
+    raise_errors: bool = False,
+    inbound_messages: Optional[List[Dict[str, Any]]] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Main 24/7 backend agent orchestrator.
+    Called on every incoming message (or once per coalesced burst via inbound_messages).
+    If audio_media_id is provided, downloads and transcribes the voice note
+    using the org's API key (guaranteed available here via ORM).
+
+    Work is split into short DB units (load context, persist results) around the
+    external calls; the session's connection is released before every slow call.
+    Context DB reads run on a worker thread, concurrently with transcription and the
+    query embedding. Greetings, thanks and "ok" get a templated reply without the LLM
+    (intent_router_service); for orgs with the semantic reply cache on, a near-identical
+    generic question is answered from the cache without the KB search or an LLM call.
+    With raise_errors=True (agent job queue), failures before any side effect (booking,
+    escalation, send) are re-raised so the job can be retried; later failures are not.
+    Every reply is traced stage by stage (app/utils/tracing.py).
+    """
+    with reply_trace(org_id, contact_id) as trace:
+        result = await _run_agent_reply(
+            contact_id, incoming_text, org_id, db,
+            audio_media_id=audio_media_id,
+            audio_mime_type=audio_mime_type,
+            raise_errors=raise_errors,
+            inbound_messages=inbound_messages
+        )
+        if result is None:
+            if trace.outcome == "ok":
+                trace.outcome = "no_reply"
+        else:
+            annotate_reply(source=result.get("source"), voice=bool(result.get("is_voice")))
+        return result
 
-        # 10. Deliver reply to customer via WhatsApp
-        from app.api.whatsapp import get_organization_whatsapp_config
-        from app.services.meta_whatsapp_service import get_meta_whatsapp_service
-        import base64
 
-        config = get_organization_whatsapp_config(db, org_id)
+async def _run_agent_reply(
+    contact_id: UUID,
+    incoming_text: str,
+    org_id: UUID,
+    db: Session,
+    audio_media_id: Optional[str] = None,
+    audio_mime_type: str = "audio/ogg",
+    raise_errors: bool = False,
+    inbound_messages: Optional[List[Dict[str, Any]]] = None
+) -> Optional[Dict[str, Any]]:
+    """Reply pipeline behind trigger_ai_agent_reply."""
+    side_effects_started = False
+    ctx = None
+    inbound = [dict(entry) for entry in inbound_messages] if inbound_messages else [{
+        "message_id": None,
+        "content": incoming_text,
+        "audio_media_id": audio_media_id,
+        "audio_mime_type": audio_mime_type
+    }]
+    try:
+        # Queued replies (raise_errors) can park on a long voice note: the queue resumes them
+        prepared = await _prepare_reply(db, org_id, contact_id, inbound, stream_voice=True, defer_transcription=raise_errors)
+        if not prepared:
+            return None
+        ctx, incoming_text, reply_text, action, source = prepared
+
+        # 5. Process Intent Actions (side effects start here; never retried past this point)
+        side_effects_started = True
+        with stage_span("apply_action", action=action.get("type", "NONE")):
+            reply_text = _apply_intent_action(db, ctx, action, reply_text)
+            _release_connection(db)
 
-        # Check voice reply settings
-        voice_reply_mode = getattr(org, "ai_voice_reply_mode", "text") or "text"
-        voice_name = getattr(org, "ai_voice_name", "en-NG-EzinneNeural") or "en-NG-EzinneNeural"
+        # 6. Deliver reply to customer via WhatsApp
+        from app.services.meta_whatsapp_service import get_meta_whatsapp_service
 
-        is_inbound_voice = incoming_text.startswith("[Voice Note") or incoming_text.startswith("[Voice message")
-        should_send_voice = (voice_reply_mode == "voice") or (voice_reply_mode == "match_input" and is_inbound_voice)
+        config = ctx.wa_config
 
-        if should_send_voice and config["delivery_method"] == "meta":
-            logger.info(f"🎙️ Synthesizing voice note response using voice: {voice_name}")
-            voice_bytes = await synthesize_voice_note(reply_text, voice_name)
+        if _should_send_voice(ctx, incoming_text):
+            if ctx.voice_stream is not None:
+                # Sentences were synthesized while the LLM streamed; usually only the tail is left
+                voice_bytes = await ctx.voice_stream.finish(reply_text)
+            else:
+                logger.info(f"🎙️ Synthesizing voice note response using voice: {ctx.voice_name}")
+                voice_bytes = await synthesize_voice_note(reply_text, ctx.voice_name)
             if voice_bytes:
                 meta_service = get_meta_whatsapp_service(
                     config["phone_number_id"],
                     config["access_token"]
                 )
                 # Use send_voice_note to get native green WhatsApp voice bubble (OGG/OPUS)
-                send_result = await meta_service.send_voice_note(
-                    to_phone=contact.phone,
-                    audio_bytes=voice_bytes,
-                    mime_type="audio/ogg; codecs=opus"
-                )
-                out_msg = Message(
-                    organization_id=org_id,
-                    contact_id=contact.id,
-                    content=reply_text,
-                    attachment_url="voice_note_response",
-                    attachment_type="audio",
-                    type="Outbound",
-                    status="Sent" if send_result.get("success") else "Failed",
-                    sent_at=now,
-                    whatsapp_message_id=send_result.get("messageId")
-                )
-                db.add(out_msg)
-                db.commit()
-                logger.info(f"🎙️ AI Voice Note auto-reply sent to {contact.phone} via Meta Cloud API")
+                with stage_span("meta_send", bytes=len(voice_bytes), voice=True):
+                    send_result = await meta_service.send_voice_note(
+                        to_phone=ctx.contact_phone,
+                        audio_bytes=voice_bytes,
+                        mime_type="audio/ogg; codecs=opus"
+                    )
+                with stage_span("db_save_message"):
+                    out_msg_id = _save_outbound_message(
+                        db, ctx, reply_text,
+                        attachment_url="voice_note_response",
+                        attachment_type="audio",
+                        status="Sent" if send_result.get("success") else "Failed",
+                        sent_at=ctx.now,
+                        whatsapp_message_id=send_result.get("messageId")
+                    )
+                logger.info(f"🎙️ AI Voice Note auto-reply sent to {ctx.contact_phone} via Meta Cloud API")
                 return {
                     "reply": reply_text,
                     "action": action,
-                    "message_id": str(out_msg.id),
-                    "is_voice": True
+                    "message_id": out_msg_id,
+                    "is_voice": True,
+                    "source": source
                 }
 
         if config["delivery_method"] == "meta":
@@ -679,44 +1135,72 @@ ACTION TYPE GUIDE:
                 config["phone_number_id"],
                 config["access_token"]
             )
-            send_result = await meta_service.send_message(
-                to_phone=contact.phone,
-                message=reply_text
-            )
-            out_msg = Message(
-                organization_id=org_id,
-                contact_id=contact.id,
-                content=reply_text,
-                type="Outbound",
-                status="Sent" if send_result.get("success") else "Failed",
-                sent_at=now,
-                whatsapp_message_id=send_result.get("messageId")
-            )
-            db.add(out_msg)
-            db.commit()
-            logger.info(f"🚀 AI Auto-reply sent to {contact.phone} via Meta Cloud API")
+            with stage_span("meta_send"):
+                send_result = await meta_service.send_message(
+                    to_phone=ctx.contact_phone,
+                    message=reply_text
+                )
+            with stage_span("db_save_message"):
+                out_msg_id = _save_outbound_message(
+                    db, ctx, reply_text,
+                    status="Sent" if send_result.get("success") else "Failed",
+                    sent_at=ctx.now,
+                    whatsapp_message_id=send_result.get("messageId")
+                )
+            logger.info(f"🚀 AI Auto-reply sent to {ctx.contact_phone} via Meta Cloud API")
 
         else:
             # WPPConnect: Queue pending outbound message for bridge polling
-            out_msg = Message(
-                organization_id=org_id,
-                contact_id=contact.id,
-                content=reply_text,
-                type="Outbound",
-                status="Pending",
-                created_at=now
-            )
-            db.add(out_msg)
-            db.commit()
-            logger.info(f"📬 AI Auto-reply queued for WPPConnect bridge to send to {contact.phone}")
+            with stage_span("db_save_message"):
+                out_msg_id = _save_outbound_message(
+                    db, ctx, reply_text,
+                    status="Pending",
+                    created_at=ctx.now
+                )
+            logger.info(f"📬 AI Auto-reply queued for WPPConnect bridge to send to {ctx.contact_phone}")
 
         return {
             "reply": reply_text,
             "action": action,
-            "message_id": str(out_msg.id)
+            "message_id": out_msg_id,
+            "source": source
         }
 
+    except TranscriptionDeferred:
+        # Nothing was sent; a 'transcription' job re-queues this mailbox with the transcript
+        annotate_reply(outcome="deferred")
+        return None
     except Exception as e:
         logger.error(f"❌ Error in trigger_ai_agent_reply: {str(e)}", exc_info=True)
+        annotate_reply(outcome="error")
         db.rollback()
+        if raise_errors and not side_effects_started:
+            raise
         return None
+    finally:
+        if ctx is not None and ctx.voice_stream is not None:
+            await ctx.voice_stream.cancel()
+
+
+async def generate_reply_draft(
+    contact_id: UUID,
+    org_id: UUID,
+    db: Session,
+    inbound_messages: List[Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    """
+    Suggest mode: the reply and action the agent would send for this mailbox, without
+    sending it or running the action (the operator reviews both). Uses bulk LLM priority
+    so drafts never hold up auto-replies. Errors propagate so the draft job is retried.
+    """
+    from app.services.ai_rate_limiter import PRIORITY_BULK
+    with reply_trace(org_id, contact_id) as trace:
+        annotate_reply(mode="draft")
+        prepared = await _prepare_reply(db, org_id, contact_id, [dict(entry) for entry in inbound_messages], PRIORITY_BULK)
+        if not prepared:
+            trace.outcome = "no_reply"
+            return None
+        ctx, _, reply_text, action, source = prepared
+        annotate_reply(source=source)
+        logger.info(f"📝 Drafted {source} reply for {ctx.contact_name}")
+        return {"reply": reply_text, "action": action, "source": source}
@@ -3,11 +3,11 @@ AI Provider Service
 Tests and validates AI API keys before saving
 """
 
-import httpx
-import google.generativeai as genai
 from typing import Dict, Any
 import logging
 
+from app.services.http_client_service import get_http_client
+
 logger = logging.getLogger(__name__)
 
 
@@ -17,15 +17,14 @@ class AIProviderService:
     async def test_gemini(self, api_key: str, model: str = "gemini-pro") -> Dict[str, Any]:
         """Test Google Gemini API key"""
         try:
-            genai.configure(api_key=api_key)
-            model_instance = genai.GenerativeModel(model)
-            response = model_instance.generate_content("Respond with exactly: OK")
+            from app.services.gemini_service import gemini_generate_text
+            response_text = await gemini_generate_text(api_key, model, "Respond with exactly: OK", timeout=15.0)
             
             return {
                 "success": True,
                 "provider": "gemini",
                 "message": "API key is valid",
-                "response": response.text[:100]
+                "response": response_text[:100]
             }
         except Exception as e:
             logger.error(f"Gemini API test failed: {str(e)}")
@@ -38,33 +37,33 @@ class AIProviderService:
     async def test_openai(self, api_key: str, model: str = "gpt-3.5-turbo") -> Dict[str, Any]:
         """Test OpenAI API key"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": model,
-                        "messages": [{"role": "user", "content": "Respond with exactly: OK"}],
-                        "max_tokens": 10
-                    },
-                    timeout=15.0
-                )
+            client = get_http_client("https://api.openai.com")
+            response = await client.post(
+                "https://api.openai.com/v1/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "model": model,
+                    "messages": [{"role": "user", "content": "Respond with exactly: OK"}],
+                    "max_tokens": 10
+                },
+                timeout=15.0
+            )
                 
-                if response.status_code == 200:
-                    return {
-                        "success": True,
-                        "provider": "openai",
-                        "message": "API key is valid"
-                    }
-                else:
-                    return {
-                        "success": False,
-                        "provider": "openai",
-                        "error": f"HTTP {response.status_code}: {response.text}"
-                    }
+            if response.status_code == 200:
+                return {
+                    "success": True,
+                    "provider": "openai",
+                    "message": "API key is valid"
+                }
+            else:
+                return {
+                    "success": False,
+                    "provider": "openai",
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
         except Exception as e:
             logger.error(f"OpenAI API test failed: {str(e)}")
             return {
@@ -76,33 +75,33 @@ class AIProviderService:
     async def test_deepseek(self, api_key: str, base_url: str = "https://api.deepseek.com/v1") -> Dict[str, Any]:
         """Test DeepSeek API key"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "deepseek-chat",
-                        "messages": [{"role": "user", "content": "Respond with exactly: OK"}],
-                        "max_tokens": 10
-                    },
-                    timeout=15.0
-                )
+            client = get_http_client(base_url)
+            response = await client.post(
+                f"{base_url}/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "model": "deepseek-chat",
+                    "messages": [{"role": "user", "content": "Respond with exactly: OK"}],
+                    "max_tokens": 10
+                },
+                timeout=15.0
+            )
                 
-                if response.status_code == 200:
-                    return {
-                        "success": True,
-                        "provider": "deepseek",
-                        "message": "API key is valid"
-                    }
-                else:
-                    return {
-                        "success": False,
-                        "provider": "deepseek",
-                        "error": f"HTTP {response.status_code}: {response.text}"
-                    }
+            if response.status_code == 200:
+                return {
+                    "success": True,
+                    "provider": "deepseek",
+                    "message": "API key is valid"
+                }
+            else:
+                return {
+                    "success": False,
+                    "provider": "deepseek",
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
         except Exception as e:
             logger.error(f"DeepSeek API test failed: {str(e)}")
             return {
@@ -114,33 +113,33 @@ class AIProviderService:
     async def test_groq(self, api_key: str) -> Dict[str, Any]:
         """Test Groq API key"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.groq.com/openai/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "llama2-70b-4096",
-                        "messages": [{"role": "user", "content": "Respond with exactly: OK"}],
-                        "max_tokens": 10
-                    },
-                    timeout=15.0
-                )
+            client = get_http_client("https://api.groq.com")
+            response = await client.post(
+                "https://api.groq.com/openai/v1/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "model": "llama2-70b-4096",
+                    "messages": [{"role": "user", "content": "Respond with exactly: OK"}],
+                    "max_tokens": 10
+                },
+                timeout=15.0
+            )
                 
-                if response.status_code == 200:
-                    return {
-                        "success": True,
-                        "provider": "groq",
-                        "message": "API key is valid"
-                    }
-                else:
-                    return {
-                        "success": False,
-                        "provider": "groq",
-                        "error": f"HTTP {response.status_code}: {response.text}"
-                    }
+            if response.status_code == 200:
+                return {
+                    "success": True,
+                    "provider": "groq",
+                    "message": "API key is valid"
+                }
+            else:
+                return {
+                    "success": False,
+                    "provider": "groq",
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
         except Exception as e:
             logger.error(f"Groq API test failed: {str(e)}")
             return {
@@ -152,33 +151,33 @@ class AIProviderService:
     async def test_custom(self, api_key: str, base_url: str) -> Dict[str, Any]:
         """Test custom OpenAI-compatible API"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "default",
-                        "messages": [{"role": "user", "content": "Respond with exactly: OK"}],
-                        "max_tokens": 10
-                    },
-                    timeout=15.0
-                )
+            client = get_http_client(base_url)
+            response = await client.post(
+                f"{base_url}/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "model": "default",
+                    "messages": [{"role": "user", "content": "Respond with exactly: OK"}],
+                    "max_tokens": 10
+                },
+                timeout=15.0
+            )
                 
-                if response.status_code == 200:
-                    return {
-                        "success": True,
-                        "provider": "custom",
-                        "message": "API key is valid"
-                    }
-                else:
-                    return {
-                        "success": False,
-                        "provider": "custom",
-                        "error": f"HTTP {response.status_code}: {response.text}"
-                    }
+            if response.status_code == 200:
+                return {
+                    "success": True,
+                    "provider": "custom",
+                    "message": "API key is valid"
+                }
+            else:
+                return {
+                    "success": False,
+                    "provider": "custom",
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
         except Exception as e:
             logger.error(f"Custom API test failed: {str(e)}")
             return {
@@ -0,0 +1,180 @@
+"""
+AI Rate Limiter
+Per-API-key token buckets (requests/min, tokens/min) and a concurrency cap.
+
+A broadcast reply storm or the morning workflow run can push one org's key past
+its provider quota, and the resulting 429s surface as failed replies. Every LLM
+call now takes a slot from the key's limiter first. Callers wait a short, bounded
+time for capacity; interactive agent replies are always served ahead of bulk
+generation (workflows, dashboard drafts, summaries). Limits come from the org's
+AI config and apply per app process.
+"""
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+_PRIORITY_RANK = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 1}
+
+# Completion allowance added to the prompt estimate when debiting the tokens/min bucket
+COMPLETION_TOKEN_ALLOWANCE = 300
+
+
+@dataclass(frozen=True)
+class RateLimits:
+    """Limits for one API key (per app process)."""
+    requests_per_minute: int
+    tokens_per_minute: int
+    max_concurrency: int
+
+    @classmethod
+    def default(cls) -> "RateLimits":
+        return cls(
+            requests_per_minute=settings.ai_rate_limit_rpm,
+            tokens_per_minute=settings.ai_rate_limit_tpm,
+            max_concurrency=settings.ai_max_concurrency,
+        )
+
+
+class AIRateLimitExceeded(Exception):
+    """No capacity freed up within the caller's wait budget."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"AI rate limit reached; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class _KeyLimiter:
+    """Buckets, in-flight count and priority wait queue for one key on one event loop."""
+
+    def __init__(self, limits: RateLimits):
+        self.limits = limits
+        self.request_budget = float(limits.requests_per_minute)
+        self.token_budget = float(limits.tokens_per_minute)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int]] = []
+        self._seq = itertools.count()
+        self._cond = asyncio.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_budget = min(self.limits.requests_per_minute, self.request_budget + elapsed * self.limits.requests_per_minute / 60.0)
+        self.token_budget = min(self.limits.tokens_per_minute, self.token_budget + elapsed * self.limits.tokens_per_minute / 60.0)
+
+    def _seconds_until(self, tokens: float) -> float:
+        """Time until both buckets hold enough for one request of this size."""
+        request_wait = max(0.0, 1 - self.request_budget) * 60.0 / max(1, self.limits.requests_per_minute)
+        token_wait = max(0.0, tokens - self.token_budget) * 60.0 / max(1, self.limits.tokens_per_minute)
+        return max(request_wait, token_wait)
+
+    def update_limits(self, limits: RateLimits):
+        if limits != self.limits:
+            self.limits = limits
+            self.request_budget = min(self.request_budget, limits.requests_per_minute)
+            self.token_budget = min(self.token_budget, limits.tokens_per_minute)
+
+    async def acquire(self, tokens: int, rank: int, max_wait: float):
+        entry = (rank, next(self._seq))
+        deadline = time.monotonic() + max_wait
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    self._refill()
+                    need = min(tokens, self.limits.tokens_per_minute)
+                    delay = max_wait
+                    if self._waiters[0] == entry:
+                        if self.in_flight < self.limits.max_concurrency and self.request_budget >= 1 and self.token_budget >= need:
+                            self.in_flight += 1
+                            self.request_budget -= 1
+                            self.token_budget -= need
+                            return
+                        if self.in_flight < self.limits.max_concurrency:
+                            delay = self._seconds_until(need)
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AIRateLimitExceeded(max(1.0, self._seconds_until(need)))
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=min(delay, remaining))
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                # The next waiter may now be at the head of the queue
+                self._cond.notify_all()
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+
+class AIRateLimiter:
+    """Registry of per-key limiters (keyed by key fingerprint and event loop)."""
+
+    def __init__(self):
+        self._limiters: Dict[Tuple[str, int], _KeyLimiter] = {}
+
+    def _get(self, api_key: str, limits: RateLimits) -> _KeyLimiter:
+        fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        cache_key = (fingerprint, id(asyncio.get_running_loop()))
+        limiter = self._limiters.get(cache_key)
+        if limiter is None:
+            limiter = self._limiters[cache_key] = _KeyLimiter(limits)
+        else:
+            limiter.update_limits(limits)
+        return limiter
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        api_key: str,
+        limits: Optional[RateLimits] = None,
+        prompt_tokens: int = 0,
+        priority: str = PRIORITY_INTERACTIVE
+    ):
+        """
+        Hold one request slot for this key while the block runs.
+        Raises AIRateLimitExceeded if none frees up within the priority's wait budget.
+        """
+        if not api_key:
+            yield
+            return
+        limiter = self._get(api_key, limits or RateLimits.default())
+        max_wait = (
+            settings.ai_rate_limit_interactive_wait_seconds if priority == PRIORITY_INTERACTIVE
+            else settings.ai_rate_limit_bulk_wait_seconds
+        )
+        started = time.monotonic()
+        try:
+            await limiter.acquire(prompt_tokens + COMPLETION_TOKEN_ALLOWANCE, _PRIORITY_RANK.get(priority, 1), max_wait)
+        except AIRateLimitExceeded:
+            metrics.incr("ai_rate_limited", priority=priority)
+            raise
+        metrics.observe("ai_rate_limit_wait_seconds", time.monotonic() - started, priority=priority)
+        try:
+            yield
+        finally:
+            await limiter.release()
+
+
+# Singleton instance
+ai_rate_limiter = AIRateLimiter()
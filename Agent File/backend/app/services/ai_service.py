@@ -1,8 +1,9 @@
 """AI Service for generating content using multiple AI providers."""
-import google.generativeai as genai
 from app.config import settings
+from app.services.gemini_service import gemini_generate_text, gemini_embed_text
+from app.services.http_client_service import get_http_client
+from app.services.ai_rate_limiter import ai_rate_limiter, AIRateLimitExceeded, RateLimits, PRIORITY_BULK
 from typing import Optional, List
-import httpx
 
 
 async def generate_message(
@@ -15,7 +16,9 @@ async def generate_message(
     ai_provider: str = "gemini",
     ai_api_key: Optional[str] = None,
     ai_model: str = "gemini-2.0-flash",
-    ai_base_url: Optional[str] = None
+    ai_base_url: Optional[str] = None,
+    rate_limits: Optional[RateLimits] = None,
+    priority: str = PRIORITY_BULK
 ) -> str:
     """
     Generate a personalized message for a contact using configured AI provider.
@@ -31,9 +34,14 @@ async def generate_message(
         ai_api_key: API key for the AI provider
         ai_model: Model name to use
         ai_base_url: Base URL for custom providers
+        rate_limits: Limits for this key (server defaults if None)
+        priority: Rate limiter priority (bulk generation yields to agent replies)
         
     Returns:
         Generated message text
+        
+    Raises:
+        AIRateLimitExceeded: the key had no capacity within the bulk wait budget
     """
     
     # Fallback to environment variable if no API key provided
@@ -59,55 +67,65 @@ async def generate_message(
     """
     
     try:
-        if ai_provider == "gemini":
-            # Use Google Gemini
-            genai.configure(api_key=ai_api_key)
-            model = genai.GenerativeModel(ai_model)
-            response = model.generate_content(prompt)
-            return response.text.strip()
-        else:
-            # Use OpenAI-compatible API (OpenAI, DeepSeek, Groq, Custom)
-            base_url = ai_base_url
-            if not base_url:
-                if ai_provider == "openai":
-                    base_url = "https://api.openai.com/v1"
-                elif ai_provider == "deepseek":
-                    base_url = "https://api.deepseek.com"
-                elif ai_provider == "groq":
-                    base_url = "https://api.groq.com/openai/v1"
-                else:
-                    raise ValueError(f"Unknown provider: {ai_provider}")
-            
-            base_url = base_url.rstrip('/')
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{base_url}/chat/completions",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {ai_api_key}"
-                    },
-                    json={
-                        "model": ai_model,
-                        "messages": [
-                            {"role": "user", "content": prompt}
-                        ],
-                        "temperature": 0.7
-                    },
-                    timeout=30.0
-                )
-                
-                if not response.is_success:
-                    raise Exception(f"AI API Error: {response.text}")
-                
-                data = response.json()
-                return data["choices"][0]["message"]["content"].strip()
-                
+        async with ai_rate_limiter.slot(ai_api_key, rate_limits, len(prompt) // 4, priority):
+            return await _generate_with_provider(prompt, ai_provider, ai_api_key, ai_model, ai_base_url)
+    except AIRateLimitExceeded:
+        raise
     except Exception as e:
         print(f"Error generating message: {e}")
         return f"Hi {contact_name}, thinking of you today! - {sender_name}"
 
 
+async def _generate_with_provider(
+    prompt: str,
+    ai_provider: str,
+    ai_api_key: str,
+    ai_model: str,
+    ai_base_url: Optional[str]
+) -> str:
+    """Single-prompt completion with the configured provider."""
+    if ai_provider == "gemini":
+        # Use Google Gemini (async client per API key)
+        return await gemini_generate_text(ai_api_key, ai_model, prompt, timeout=30.0)
+    else:
+        # Use OpenAI-compatible API (OpenAI, DeepSeek, Groq, Custom)
+        base_url = ai_base_url
+        if not base_url:
+            if ai_provider == "openai":
+                base_url = "https://api.openai.com/v1"
+            elif ai_provider == "deepseek":
+                base_url = "https://api.deepseek.com"
+            elif ai_provider == "groq":
+                base_url = "https://api.groq.com/openai/v1"
+            else:
+                raise ValueError(f"Unknown provider: {ai_provider}")
+        
+        base_url = base_url.rstrip('/')
+        
+        client = get_http_client(base_url)
+        response = await client.post(
+            f"{base_url}/chat/completions",
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {ai_api_key}"
+            },
+            json={
+                "model": ai_model,
+                "messages": [
+                    {"role": "user", "content": prompt}
+                ],
+                "temperature": 0.7
+            },
+            timeout=30.0
+        )
+            
+        if not response.is_success:
+            raise Exception(f"AI API Error: {response.text}")
+            
+        data = response.json()
+        return data["choices"][0]["message"]["content"].strip()
+
+
 async def generate_embedding(text: str, api_key: Optional[str] = None) -> List[float]:
     """
     Generate vector embedding for text using Gemini.
@@ -127,15 +145,14 @@ async def generate_embedding(text: str, api_key: Optional[str] = None) -> List[f
         return []
         
     try:
-        genai.configure(api_key=api_key)
         # Use the embedding model
-        result = genai.embed_content(
+        return await gemini_embed_text(
+            api_key,
+            text,
             model="models/embedding-001",
-            content=text,
             task_type="retrieval_document",
             title="Shepherd AI Knowledge"
         )
-        return result['embedding']
     except Exception as e:
         print(f"Error generating embedding: {e}")
         return []
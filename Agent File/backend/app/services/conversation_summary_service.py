@@ -0,0 +1,180 @@
+"""
+Conversation Summary Service
+Rolling per-contact summary and profile card, maintained off the reply path.
+
+The agent prompt carries only the last few (truncated) turns plus this summary,
+so its size stays flat however long a conversation runs. After each reply the
+worker queues a 'summarize' job; it rebuilds the profile card (bookings, notes)
+from the database and, once enough messages have aged out of the recent-turn
+window, folds them into the summary with one short LLM call.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models.booking import Booking
+from app.models.contact import Contact
+from app.models.conversation_summary import ConversationSummary
+from app.models.message import Message
+from app.services.org_config_service import get_org_config
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = """You maintain a running summary of a WhatsApp conversation between an organization's AI assistant and one contact.
+You receive the current summary (possibly empty) and the next batch of older messages, oldest first.
+Return an updated summary that keeps: who the contact is, what they asked for or care about, decisions and commitments made,
+bookings or payments discussed, open questions, and anything the assistant promised to follow up on.
+Drop greetings, small talk and repeated information. Write plain third-person notes, no emojis.
+
+Return ONLY a JSON object: {"summary": "..."}"""
+
+
+def truncate_turn(content: Optional[str], max_chars: Optional[int] = None) -> str:
+    """Single-line, length-capped message text for prompts."""
+    limit = max_chars or settings.agent_history_turn_max_chars
+    flat = " ".join((content or "").split())
+    return flat if len(flat) <= limit else flat[:limit - 1].rstrip() + "…"
+
+
+def build_profile_card(db: Session, contact: Contact) -> str:
+    """Compact card of the contact's category, notes and most recent bookings."""
+    lines = []
+    if contact.category:
+        lines.append(f"- Category: {contact.category}")
+    if contact.notes:
+        lines.append(f"- Notes: {truncate_turn(contact.notes, 300)}")
+
+    bookings = db.query(Booking).filter(
+        Booking.contact_id == contact.id
+    ).order_by(Booking.created_at.desc()).limit(5).all()
+    for booking in bookings:
+        when = " at ".join(part for part in (booking.date, booking.time) if part) or "date not set"
+        lines.append(f"- Booking: {booking.purpose} on {when} ({booking.status})")
+
+    return "\n".join(lines)
+
+
+def _pending_messages(db: Session, contact_id: UUID, summarized_until) -> List[Message]:
+    """Messages that have left the recent-turn window but are not in the summary yet, oldest first."""
+    recent_ids = db.query(Message.id).filter(
+        Message.contact_id == contact_id
+    ).order_by(Message.created_at.desc()).limit(settings.agent_history_recent_turns)
+
+    query = db.query(Message).filter(
+        Message.contact_id == contact_id,
+        ~Message.id.in_(recent_ids.scalar_subquery())
+    )
+    if summarized_until is not None:
+        query = query.filter(Message.created_at > summarized_until)
+    return query.order_by(Message.created_at.asc()).limit(50).all()
+
+
+def _upsert_summary(db: Session, org_id: UUID, contact_id: UUID, fields: Dict[str, Any]):
+    columns = ", ".join(fields)
+    values = ", ".join(f":{name}" for name in fields)
+    updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in fields)
+    db.execute(
+        text(f"""
+            INSERT INTO conversation_summaries (contact_id, organization_id, {columns}, updated_at)
+            VALUES (:contact_id, :org_id, {values}, NOW())
+            ON CONFLICT (contact_id) DO UPDATE SET {updates}, updated_at = NOW()
+        """),
+        {"contact_id": str(contact_id), "org_id": str(org_id), **fields}
+    )
+
+
+def _load_summary_work(db: Session, org_id: UUID, contact_id: UUID) -> Optional[Dict[str, Any]]:
+    """
+    DB phase: refresh the profile card and collect the messages to fold into the summary.
+    Returns None when there is nothing for the LLM to do.
+    """
+    try:
+        contact = db.query(Contact).filter(Contact.id == contact_id).first()
+        if not contact:
+            return None
+        config = get_org_config(db, org_id)
+        existing = db.query(ConversationSummary).filter(ConversationSummary.contact_id == contact_id).first()
+
+        _upsert_summary(db, org_id, contact_id, {"profile_card": build_profile_card(db, contact)})
+
+        pending = _pending_messages(db, contact_id, existing.summarized_until if existing else None)
+        if len(pending) < settings.agent_summary_min_new_messages or not config or not config.ai_api_key:
+            return None
+
+        ai_name = config.ai_name
+        lines = [
+            f"{ai_name if m.type == 'Outbound' else contact.name}: {truncate_turn(m.content)}"
+            for m in pending
+        ]
+        return {
+            "config": config,
+            "summary": existing.summary if existing and existing.summary else "",
+            "lines": lines,
+            "summarized_until": pending[-1].created_at,
+            "count": len(pending),
+            "summarized_messages": (existing.summarized_messages or 0) if existing else 0,
+        }
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        # Hand the pooled connection back before the LLM call (no-op after a rollback)
+        db.commit()
+
+
+async def update_conversation_summary(db: Session, org_id: UUID, contact_id: UUID) -> bool:
+    """Refresh the contact's profile card and roll aged-out messages into the summary. Returns True if the summary changed."""
+    from app.services.llm_router_service import llm_router
+    from app.services.ai_rate_limiter import PRIORITY_BULK
+
+    work = await asyncio.to_thread(_load_summary_work, db, org_id, contact_id)
+    if not work:
+        return False
+
+    config = work["config"]
+    user_turn = (
+        f"CURRENT SUMMARY:\n{work['summary'] or '(none yet)'}\n\n"
+        f"NEXT MESSAGES:\n" + "\n".join(work["lines"]) + "\n\n"
+        f"Keep the updated summary under {settings.agent_summary_max_chars} characters."
+    )
+    raw = await llm_router.complete(
+        config.llm_targets(),
+        system_prompt=SUMMARY_SYSTEM_PROMPT,
+        user_turn=user_turn,
+        limits=config.rate_limits(),
+        priority=PRIORITY_BULK
+    )
+    try:
+        summary = json.loads(raw[raw.find("{"):raw.rfind("}") + 1]).get("summary", "")
+    except (ValueError, AttributeError):
+        summary = raw
+    summary = (summary or "").strip()[:settings.agent_summary_max_chars]
+    if not summary:
+        logger.warning(f"Summarizer returned nothing for contact {contact_id}; keeping previous summary.")
+        return False
+
+    def _save():
+        try:
+            _upsert_summary(db, org_id, contact_id, {
+                "summary": summary,
+                "summarized_until": work["summarized_until"],
+                "summarized_messages": work["summarized_messages"] + work["count"],
+            })
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    await asyncio.to_thread(_save)
+    metrics.incr("conversation_summaries_updated")
+    metrics.incr("conversation_summary_messages_folded", work["count"])
+    logger.info(f"📝 Folded {work['count']} messages into the summary for contact {contact_id}")
+    return True
@@ -0,0 +1,372 @@
+"""
+Gemini Client Service
+Native-async Gemini calls with one client instance per API key.
+
+The google.generativeai helpers (genai.configure + generate_content/embed_content)
+are synchronous and configure a process-global key, so they block the event loop
+for the whole LLM round trip and race when orgs with different keys reply at once.
+Here every org key gets its own async gRPC client, cached by a hash of the key.
+
+Static system-prompt prefixes can be registered with Gemini's context cache
+(CachedContent) so repeated replies only send the volatile suffix.
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Tuple, Callable
+
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as core_exceptions
+from google.api_core import retry_async
+from google.protobuf import duration_pb2
+
+from app.config import settings
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GENERATION_MODEL = "gemini-2.0-flash"
+DEFAULT_EMBEDDING_MODEL = "models/embedding-001"
+
+_TASK_TYPES = {
+    "retrieval_document": glm.TaskType.RETRIEVAL_DOCUMENT,
+    "retrieval_query": glm.TaskType.RETRIEVAL_QUERY,
+    "semantic_similarity": glm.TaskType.SEMANTIC_SIMILARITY,
+}
+
+
+def _model_path(model: Optional[str], default: str = DEFAULT_GENERATION_MODEL) -> str:
+    name = model or default
+    return name if name.startswith(("models/", "tunedModels/")) else f"models/{name}"
+
+
+def _bounded_retry(timeout: float) -> retry_async.AsyncRetry:
+    """Retry transient errors, but never past the caller's overall deadline."""
+    return retry_async.AsyncRetry(
+        initial=0.5,
+        maximum=4.0,
+        multiplier=2.0,
+        timeout=timeout,
+        predicate=retry_async.if_exception_type(
+            core_exceptions.ServiceUnavailable,
+            core_exceptions.DeadlineExceeded,
+        ),
+    )
+
+
+def _key_fingerprint(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class GeminiClient:
+    """Async Gemini client bound to one API key and the event loop that created it."""
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.fingerprint = _key_fingerprint(api_key)
+        self.generative = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+        self._cache_service: Optional[glm.CacheServiceAsyncClient] = None
+
+    @property
+    def cache_service(self) -> glm.CacheServiceAsyncClient:
+        if self._cache_service is None:
+            self._cache_service = glm.CacheServiceAsyncClient(client_options={"api_key": self.api_key})
+        return self._cache_service
+
+    async def generate(
+        self,
+        model: Optional[str],
+        contents: List[glm.Content],
+        system_instruction: Optional[str] = None,
+        temperature: float = 0.7,
+        timeout: float = 45.0,
+        cached_content: Optional[str] = None
+    ) -> glm.GenerateContentResponse:
+        request = glm.GenerateContentRequest(
+            model=_model_path(model),
+            contents=contents,
+            generation_config=glm.GenerationConfig(temperature=temperature),
+        )
+        if cached_content:
+            # The cached content already carries the system instruction
+            request.cached_content = cached_content
+        elif system_instruction:
+            request.system_instruction = glm.Content(parts=[glm.Part(text=system_instruction)])
+        async with _get_semaphore():
+            return await self.generative.generate_content(
+                request=request, retry=_bounded_retry(timeout), timeout=timeout
+            )
+
+    async def generate_stream(
+        self,
+        model: Optional[str],
+        contents: List[glm.Content],
+        on_text: Callable[[str], None],
+        system_instruction: Optional[str] = None,
+        temperature: float = 0.7,
+        timeout: float = 45.0,
+        cached_content: Optional[str] = None
+    ) -> Tuple[str, Dict[str, int]]:
+        """Like generate(), but hands each text chunk to on_text as it arrives. Returns (text, usage counts)."""
+        request = glm.GenerateContentRequest(
+            model=_model_path(model),
+            contents=contents,
+            generation_config=glm.GenerationConfig(temperature=temperature),
+        )
+        if cached_content:
+            request.cached_content = cached_content
+        elif system_instruction:
+            request.system_instruction = glm.Content(parts=[glm.Part(text=system_instruction)])
+        parts: List[str] = []
+        usage = usage_counts(None)
+        async with _get_semaphore():
+            stream = await self.generative.stream_generate_content(
+                request=request, retry=_bounded_retry(timeout), timeout=timeout
+            )
+            async for chunk in stream:
+                text = response_text(chunk, strip=False)
+                if text:
+                    parts.append(text)
+                    on_text(text)
+                if getattr(chunk, "usage_metadata", None) is not None:
+                    usage = usage_counts(chunk)
+        return "".join(parts).strip(), usage
+
+    async def embed(
+        self,
+        text: str,
+        model: str = DEFAULT_EMBEDDING_MODEL,
+        task_type: str = "retrieval_document",
+        title: Optional[str] = None,
+        timeout: float = 20.0
+    ) -> List[float]:
+        request = glm.EmbedContentRequest(
+            model=_model_path(model, DEFAULT_EMBEDDING_MODEL),
+            content=glm.Content(parts=[glm.Part(text=text)]),
+            task_type=_TASK_TYPES.get(task_type, glm.TaskType.RETRIEVAL_DOCUMENT),
+        )
+        if title and task_type == "retrieval_document":
+            request.title = title
+        async with _get_semaphore():
+            response = await self.generative.embed_content(
+                request=request, retry=_bounded_retry(timeout), timeout=timeout
+            )
+        return list(response.embedding.values)
+
+    async def create_cached_prefix(self, model: Optional[str], system_instruction: str, ttl_seconds: int) -> str:
+        """Register a system instruction with the context cache; returns the cachedContents/... name."""
+        request = glm.CreateCachedContentRequest(
+            cached_content=glm.CachedContent(
+                model=_model_path(model),
+                system_instruction=glm.Content(parts=[glm.Part(text=system_instruction)]),
+                ttl=duration_pb2.Duration(seconds=ttl_seconds),
+            )
+        )
+        async with _get_semaphore():
+            cached = await self.cache_service.create_cached_content(request=request, timeout=20.0)
+        return cached.name
+
+    async def close(self):
+        for service in (self.generative, self._cache_service):
+            if service is None:
+                continue
+            try:
+                await service.transport.close()
+            except Exception:
+                pass
+
+
+# (key fingerprint, event loop id) -> client; bounded so rotated keys don't accumulate
+_clients: "OrderedDict[Tuple[str, int], GeminiClient]" = OrderedDict()
+_MAX_CLIENTS = 128
+_semaphores: Dict[int, asyncio.Semaphore] = {}
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    """Per-loop cap on concurrent Gemini calls from this process."""
+    loop_id = id(asyncio.get_running_loop())
+    semaphore = _semaphores.get(loop_id)
+    if semaphore is None:
+        semaphore = _semaphores[loop_id] = asyncio.Semaphore(settings.gemini_max_concurrency)
+    return semaphore
+
+
+def get_gemini_client(api_key: str) -> GeminiClient:
+    """Return the cached async client for this API key, creating it on first use."""
+    if not api_key:
+        raise ValueError("Gemini API key is missing.")
+    cache_key = (_key_fingerprint(api_key), id(asyncio.get_running_loop()))
+    client = _clients.get(cache_key)
+    if client is not None:
+        _clients.move_to_end(cache_key)
+        return client
+
+    client = GeminiClient(api_key)
+    _clients[cache_key] = client
+    metrics.set_gauge("gemini_clients", len(_clients))
+    while len(_clients) > _MAX_CLIENTS:
+        _, evicted = _clients.popitem(last=False)
+        asyncio.get_running_loop().create_task(evicted.close())
+    return client
+
+
+# (key fingerprint, model, prefix hash) -> (cachedContents name or None if unavailable, valid until);
+# LRU-bounded, evicted entries simply expire server-side at their TTL
+_prefix_caches: "OrderedDict[Tuple[str, str, str], Tuple[Optional[str], float]]" = OrderedDict()
+
+
+def _remember_prefix(key: Tuple[str, str, str], entry: Tuple[Optional[str], float]):
+    _prefix_caches[key] = entry
+    _prefix_caches.move_to_end(key)
+    while len(_prefix_caches) > settings.gemini_context_cache_max_entries:
+        _prefix_caches.popitem(last=False)
+
+
+async def get_cached_prefix(client: GeminiClient, model: Optional[str], system_instruction: str) -> Optional[str]:
+    """
+    Cached-content name for this static prefix, creating it on first use.
+    Explicit caching is opt-in (GEMINI_CONTEXT_CACHE_ENABLED) because stored content is
+    billed; without it requests still benefit from Gemini's implicit prefix caching.
+    Returns None when the prefix is too short for the cache or the model/key does not
+    support it; that outcome is remembered so we do not retry on every reply.
+    """
+    if not settings.gemini_context_cache_enabled:
+        return None
+    # Rough 4 chars/token estimate; the API rejects caches below the model's minimum size
+    if len(system_instruction) // 4 < settings.gemini_context_cache_min_tokens:
+        return None
+
+    model_path = _model_path(model)
+    key = (client.fingerprint, model_path, hashlib.sha256(system_instruction.encode("utf-8")).hexdigest())
+    now = time.monotonic()
+    entry = _prefix_caches.get(key)
+    if entry and entry[1] > now:
+        _prefix_caches.move_to_end(key)
+        return entry[0]
+
+    ttl = settings.gemini_context_cache_ttl_seconds
+    try:
+        name = await client.create_cached_prefix(model_path, system_instruction, ttl)
+        # Refresh a little before the server-side TTL runs out
+        _remember_prefix(key, (name, now + ttl * 0.9))
+        metrics.incr("gemini_context_caches_created")
+        logger.info(f"🧊 Registered Gemini context cache {name} for {model_path}")
+        return name
+    except Exception as e:
+        _remember_prefix(key, (None, now + ttl))
+        logger.info(f"Gemini context cache unavailable for {model_path}: {e}")
+        return None
+
+
+def usage_counts(response: Any) -> Dict[str, int]:
+    """Prompt / cached / completion token counts from a response's usage_metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    return {
+        "prompt_tokens": usage.prompt_token_count,
+        "cached_tokens": usage.cached_content_token_count,
+        "completion_tokens": usage.candidates_token_count,
+    }
+
+
+def response_text(response: Any, strip: bool = True) -> str:
+    """Concatenate the text parts of the first candidate (empty if blocked or missing)."""
+    try:
+        parts = response.candidates[0].content.parts
+        text = "".join(part.text for part in parts)
+        return text.strip() if strip else text
+    except (IndexError, AttributeError):
+        return ""
+
+
+async def gemini_generate_text(
+    api_key: str,
+    model: Optional[str],
+    prompt: str,
+    system_instruction: Optional[str] = None,
+    temperature: float = 0.7,
+    timeout: float = 45.0
+) -> str:
+    """Single-turn text generation without blocking the event loop."""
+    client = get_gemini_client(api_key)
+    response = await client.generate(
+        model=model,
+        contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])],
+        system_instruction=system_instruction,
+        temperature=temperature,
+        timeout=timeout
+    )
+    return response_text(response)
+
+
+async def gemini_generate_reply(
+    api_key: str,
+    model: Optional[str],
+    prompt: str,
+    system_instruction: str,
+    temperature: float = 0.7,
+    timeout: float = 45.0,
+    on_text: Optional[Callable[[str], None]] = None
+) -> Tuple[str, Dict[str, int]]:
+    """
+    Generation for a stable system prefix + volatile prompt. The prefix goes through the
+    context cache when possible. With on_text the response is streamed and each chunk
+    is passed to it as it arrives. Returns (text, usage counts).
+    """
+    client = get_gemini_client(api_key)
+    cached_content = await get_cached_prefix(client, model, system_instruction)
+    contents = [glm.Content(role="user", parts=[glm.Part(text=prompt)])]
+
+    async def generate(cached: Optional[str]) -> Tuple[str, Dict[str, int]]:
+        if on_text:
+            return await client.generate_stream(
+                model=model,
+                contents=contents,
+                on_text=on_text,
+                system_instruction=system_instruction,
+                temperature=temperature,
+                timeout=timeout,
+                cached_content=cached
+            )
+        response = await client.generate(
+            model=model,
+            contents=contents,
+            system_instruction=system_instruction,
+            temperature=temperature,
+            timeout=timeout,
+            cached_content=cached
+        )
+        return response_text(response), usage_counts(response)
+
+    try:
+        return await generate(cached_content)
+    except (core_exceptions.NotFound, core_exceptions.PermissionDenied):
+        if not cached_content:
+            raise
+        # Cache expired or was deleted server-side: forget it and send the prefix inline
+        _prefix_caches.pop(next((k for k, v in _prefix_caches.items() if v[0] == cached_content), None), None)
+        return await generate(None)
+
+
+async def gemini_embed_text(
+    api_key: str,
+    text: str,
+    model: str = DEFAULT_EMBEDDING_MODEL,
+    task_type: str = "retrieval_document",
+    title: Optional[str] = None
+) -> List[float]:
+    """Embed text with the org's key without blocking the event loop."""
+    client = get_gemini_client(api_key)
+    return await client.embed(text, model=model, task_type=task_type, title=title)
+
+
+async def close_gemini_clients():
+    """Close all cached clients (app shutdown)."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.close()
@@ -0,0 +1,153 @@
+"""
+Shared HTTP Client Service
+App-lifetime pooled httpx clients, one per upstream host.
+
+Building an httpx.AsyncClient per call pays a fresh TCP + TLS handshake to
+graph.facebook.com or the LLM host on every message. Here each host gets one
+long-lived client with keep-alive, HTTP/2 when the h2 package is installed,
+bounded connection limits and a per-host default timeout. Callers may still
+pass timeout= on individual requests.
+
+Only known upstreams get a client of their own: the hosts in HOST_TIMEOUTS (Meta,
+the AI providers) and hosts the operator configured (register_upstream(), e.g. the
+transcription service). Every other host (browsed pages, org-supplied custom AI base
+URLs and bridge URLs) shares one generic client, so user input never grows the registry.
+
+Offline runs (benchmarks/) can route hosts through an in-process httpx transport
+with override_transport() instead of patching call sites.
+"""
+
+import asyncio
+import importlib.util
+import logging
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from app.config import settings
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Registry key of the client shared by arbitrary hosts
+GENERIC_HOST = "*generic*"
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+DEFAULT_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+
+# Per-host default timeouts (connect kept short so a dead upstream fails fast)
+HOST_TIMEOUTS: Dict[str, httpx.Timeout] = {
+    "graph.facebook.com": httpx.Timeout(30.0, connect=5.0),
+    "lookaside.fbsbx.com": httpx.Timeout(60.0, connect=5.0),
+    "api.openai.com": httpx.Timeout(60.0, connect=5.0),
+    "api.deepseek.com": httpx.Timeout(60.0, connect=5.0),
+    "api.groq.com": httpx.Timeout(60.0, connect=5.0),
+    "generativelanguage.googleapis.com": httpx.Timeout(60.0, connect=5.0),
+}
+
+
+def _host_key(url: str) -> str:
+    """scheme://host[:port] for a full URL or bare host."""
+    parts = urlsplit(url if "://" in url else f"https://{url}")
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class HttpClientRegistry:
+    """Lazily created pooled clients keyed by (host, event loop)."""
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, int], httpx.AsyncClient] = {}
+        # host key (or "*" for every host) -> transport used instead of the network
+        self._transports: Dict[str, httpx.AsyncBaseTransport] = {}
+        # Operator-configured upstreams (host keys) that get a client of their own
+        self._upstreams: Set[str] = set()
+
+    def register_upstream(self, url: str):
+        """Give this configured (not user-supplied) host its own pooled client."""
+        self._upstreams.add(_host_key(url))
+
+    def _is_upstream(self, host: str) -> bool:
+        return urlsplit(host).hostname in HOST_TIMEOUTS or host in self._upstreams or host in self._transports
+
+    def _build_client(self, host: str) -> httpx.AsyncClient:
+        netloc = urlsplit(host).hostname or ""
+        limits = httpx.Limits(
+            max_connections=settings.http_max_connections,
+            max_keepalive_connections=settings.http_max_keepalive_connections,
+            keepalive_expiry=settings.http_keepalive_expiry_seconds,
+        )
+        transport = self._transports.get(host) or self._transports.get("*")
+        if transport is not None:
+            return httpx.AsyncClient(timeout=HOST_TIMEOUTS.get(netloc, DEFAULT_TIMEOUT), transport=transport)
+        return httpx.AsyncClient(
+            timeout=HOST_TIMEOUTS.get(netloc, DEFAULT_TIMEOUT),
+            limits=limits,
+            http2=settings.http2_enabled and HTTP2_AVAILABLE and host.startswith("https://"),
+        )
+
+    def override_transport(self, url: str, transport: Optional[httpx.AsyncBaseTransport]):
+        """
+        Serve requests to this URL's host from an in-process transport ("*" = every host;
+        None removes the override). Clients already built for the host are dropped so the
+        next get() picks the override up. For offline benchmarks, not production use.
+        """
+        host = url if url == "*" else _host_key(url)
+        if transport is None:
+            self._transports.pop(host, None)
+        else:
+            self._transports[host] = transport
+        for cache_key in [key for key in self._clients if host == "*" or key[0] == host]:
+            self._clients.pop(cache_key)
+        metrics.set_gauge("http_clients", len(self._clients))
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        """Return the shared client for the host of this URL (the generic one for hosts that are not known upstreams)."""
+        host = _host_key(url)
+        return self._get(host if self._is_upstream(host) else GENERIC_HOST)
+
+    def generic(self) -> httpx.AsyncClient:
+        """Return the one client shared by requests to arbitrary (user-supplied) hosts."""
+        return self._get(GENERIC_HOST)
+
+    def _get(self, host: str) -> httpx.AsyncClient:
+        cache_key = (host, id(asyncio.get_running_loop()))
+        client = self._clients.get(cache_key)
+        if client is None or client.is_closed:
+            client = self._clients[cache_key] = self._build_client(host)
+            metrics.set_gauge("http_clients", len(self._clients))
+            logger.debug(f"🌐 Created pooled HTTP client for {host}")
+        return client
+
+    async def start(self):
+        """App startup hook."""
+        logger.info(
+            f"🌐 HTTP client registry ready (http2={'on' if settings.http2_enabled and HTTP2_AVAILABLE else 'off'}, "
+            f"max_connections={settings.http_max_connections})"
+        )
+
+    async def close(self):
+        """Close every pooled client owned by the running loop (app shutdown)."""
+        loop_id = id(asyncio.get_running_loop())
+        for cache_key in [key for key in self._clients if key[1] == loop_id]:
+            client = self._clients.pop(cache_key)
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f"Error closing HTTP client for {cache_key[0]}: {e}")
+        metrics.set_gauge("http_clients", len(self._clients))
+
+
+# Singleton instance
+http_clients = HttpClientRegistry()
+
+
+def get_http_client(url: str) -> httpx.AsyncClient:
+    """Shared pooled client for the host of this URL (generic for unknown hosts)."""
+    return http_clients.get(url)
+
+
+def get_generic_http_client() -> httpx.AsyncClient:
+    """Shared pooled client for hosts that are not known upstreams (e.g. pages the user asks to browse)."""
+    return http_clients.generic()
@@ -0,0 +1,206 @@
+"""
+Intent Router Service
+Local fast path that answers trivial turns without calling the LLM.
+
+Greetings, "are you there", "thanks" and "ok" make up a large share of inbound
+traffic and used to go through the full prompt and a provider round trip. A
+whole-message regex classifier picks these out. After the usual pause and handover
+checks, they are answered from per-org templates (organizations.ai_quick_replies,
+JSON) or from the defaults below. Anything with more content than the trivial
+phrase still goes to the agent, as do messages sent mid-flow, in escalated chats,
+and acknowledgements of a question the assistant just asked ("ok" may mean "yes").
+Emoji only count as an acknowledgement when every one is on a short positive list
+(a thumbs up, not a crying face or folded hands), and orgs whose tone asks for formal
+language get the formal default templates.
+"""
+
+import json
+import logging
+import random
+import re
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from app.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from app.services.agent_service import AgentContext
+
+logger = logging.getLogger(__name__)
+
+INTENT_GREETING = "greeting"
+INTENT_PRESENCE = "presence_check"
+INTENT_THANKS = "thanks"
+INTENT_ACKNOWLEDGEMENT = "acknowledgement"
+
+# Longer messages almost always carry a real question
+MAX_TRIVIAL_CHARS = 60
+
+_GREETING = (
+    r"(?:hi+|hello+|hel+o|hey+|hiya|howdy|greetings|yo|sup|what'?s up|how far|"
+    r"good (?:morning|afternoon|evening|day)|morning|evening|"
+    r"how are you(?: doing)?(?: today)?|how (?:are|r) u|how is it going|hope you'?re (?:well|good))"
+)
+_ADDRESS = r"(?: (?:there|sir|ma|madam|all|everyone|team|pastor|friend|dear))?"
+_ACK = r"(?:ok+|okay|oki|k+|alright|alrighty|cool|noted|got it|sure|fine|great|nice|perfect|understood|no problem)"
+_THANKS = (
+    r"(?:thanks?(?: a lot| so much| very much| again)?|thank (?:you|u)(?: so much| very much| again)?|"
+    r"thx|tnx|tanx|ty|much appreciated|appreciate it|god bless(?: you)?)"
+)
+
+# Emoji that acknowledge; any other emoji ("😭", "💔", "🙏") may carry distress or a request
+ACK_EMOJI = frozenset("👍👌🙂😊😀😃😄😁☺👏🙌✅✔🆗💯🤝😉")
+# Skin tones, variation selectors and joiners do not change what an emoji means here
+_EMOJI_MODIFIERS = re.compile("[\U0001F3FB-\U0001F3FF\uFE0E\uFE0F\u200D]")
+_FORMAL_TONE = re.compile(r"\b(?:formal|corporate|reserved)\b", re.IGNORECASE)
+
+# Checked in order; each must match the whole normalized message
+INTENT_PATTERNS: Tuple[Tuple[str, "re.Pattern[str]"], ...] = (
+    (INTENT_PRESENCE, re.compile(
+        rf"^(?:{_GREETING}{_ADDRESS} )?(?:are you there|you there|are you (?:online|available|around)|"
+        rf"is (?:any|some)(?:one|body) there|any(?:one|body) there)$"
+    )),
+    (INTENT_THANKS, re.compile(rf"^(?:{_ACK} )?{_THANKS}(?: {_THANKS})?{_ADDRESS}$")),
+    (INTENT_GREETING, re.compile(rf"^{_GREETING}{_ADDRESS}(?: {_GREETING}{_ADDRESS}){{0,2}}$")),
+    (INTENT_ACKNOWLEDGEMENT, re.compile(rf"^(?:{_ACK})(?: {_ACK})?$")),
+)
+
+DEFAULT_QUICK_REPLIES: Dict[str, Tuple[str, ...]] = {
+    INTENT_GREETING: (
+        "Hello {name}! How can I help you today?",
+        "Hi {name}! What can I do for you today?",
+    ),
+    INTENT_PRESENCE: (
+        "Yes {name}, I'm here. How can I help?",
+    ),
+    INTENT_THANKS: (
+        "You're welcome, {name}! Let me know if there's anything else you need.",
+        "Anytime, {name}! I'm here if you need anything else.",
+    ),
+    INTENT_ACKNOWLEDGEMENT: (
+        "Alright! Let me know if there's anything else I can help with.",
+    ),
+}
+
+# Defaults for orgs whose configured tone asks for formal language
+FORMAL_QUICK_REPLIES: Dict[str, Tuple[str, ...]] = {
+    INTENT_GREETING: (
+        "Good day {name}. How may I assist you?",
+    ),
+    INTENT_PRESENCE: (
+        "Yes {name}, I am here. How may I assist you?",
+    ),
+    INTENT_THANKS: (
+        "You are welcome, {name}. Please let me know if you need anything further.",
+    ),
+    INTENT_ACKNOWLEDGEMENT: (
+        "Noted. Please let me know if there is anything else I can assist with.",
+    ),
+}
+
+
+class _TemplateValues(dict):
+    """Leaves unknown {placeholders} in templates untouched instead of raising."""
+
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+def normalize_message(text: str) -> str:
+    """Lowercase words only: punctuation and emojis dropped, whitespace collapsed."""
+    words = re.sub(r"[^\w\s']", " ", (text or "").lower().replace("’", "'"))
+    return " ".join(words.replace("_", " ").split())
+
+
+def _only_ack_emoji(text: str) -> bool:
+    """True when every emoji/symbol in the text is on the acknowledgement list."""
+    symbols = (char for char in _EMOJI_MODIFIERS.sub("", text) if not (char.isascii() or char.isalnum() or char.isspace()))
+    return all(char in ACK_EMOJI or char == "’" for char in symbols)
+
+
+def classify_trivial_intent(text: str) -> Optional[str]:
+    """Trivial intent of the whole message, or None when it needs the agent."""
+    if not text or len(text) > MAX_TRIVIAL_CHARS:
+        return None
+    if not _only_ack_emoji(text):
+        # "😭", "ok 💔": a feeling the agent should read
+        return None
+    normalized = normalize_message(text)
+    if not normalized:
+        # Acknowledging emoji only (a thumbs up)
+        return INTENT_ACKNOWLEDGEMENT if any(char in ACK_EMOJI for char in text) else None
+    for intent, pattern in INTENT_PATTERNS:
+        if pattern.match(normalized):
+            return intent
+    return None
+
+
+def parse_quick_replies(raw: Optional[str]) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+    """
+    Org template overrides from organizations.ai_quick_replies:
+    {"greeting": "Hi {name}!" | ["...", "..."], ...}. An empty string or list
+    means "do not reply" for that intent.
+    """
+    try:
+        data = json.loads(raw) if raw else {}
+    except (TypeError, ValueError):
+        logger.warning("Ignoring malformed ai_quick_replies")
+        return ()
+    overrides = []
+    for intent, templates in (data.items() if isinstance(data, dict) else []):
+        if intent not in DEFAULT_QUICK_REPLIES:
+            continue
+        if isinstance(templates, str):
+            templates = [templates]
+        if isinstance(templates, list):
+            overrides.append((intent, tuple(t.strip() for t in templates if isinstance(t, str) and t.strip())))
+    return tuple(overrides)
+
+
+def render_quick_reply(ctx: "AgentContext", intent: str) -> str:
+    """A template for the intent filled with the contact's first name and the org/assistant names ("" = stay silent)."""
+    defaults = FORMAL_QUICK_REPLIES if _FORMAL_TONE.search(ctx.tone or "") else DEFAULT_QUICK_REPLIES
+    templates = dict(ctx.quick_replies).get(intent, defaults[intent])
+    if not templates:
+        return ""
+    first_name = (ctx.contact_name or "").split(" ")[0].strip()
+    if not first_name.isalpha():
+        # No usable name on file (empty, or the phone number)
+        first_name = ""
+    values = _TemplateValues(name=first_name, ai_name=ctx.ai_name, org_name=ctx.org_name)
+    template = random.choice(templates)
+    try:
+        reply = template.format_map(values)
+    except (ValueError, IndexError):
+        reply = random.choice(defaults[intent]).format_map(values)
+    # Tidy "Hello !" / "Yes , I'm here" left by an empty name
+    return re.sub(r"\s+([,!.?])", r"\1", " ".join(reply.split()))
+
+
+def fast_path_reply(ctx: "AgentContext", intent: Optional[str]) -> Optional[str]:
+    """
+    Templated reply for a trivial intent, "" when the org silences that intent, or None
+    when this turn must go to the agent. Call after the contact's pause check.
+    """
+    if not intent:
+        return None
+    if ctx.conversation_status == "escalated":
+        metrics.incr("fast_path_skipped", reason="escalated")
+        return None
+    if ctx.session_id is not None:
+        metrics.incr("fast_path_skipped", reason="active_flow")
+        return None
+    if intent in (INTENT_ACKNOWLEDGEMENT, INTENT_THANKS) and _last_outbound_asked_question(ctx):
+        metrics.incr("fast_path_skipped", reason="answering_question")
+        return None
+
+    reply = render_quick_reply(ctx, intent)
+    metrics.incr("fast_path_replies", intent=intent)
+    metrics.incr("llm_calls_avoided", reason="fast_path")
+    return reply
+
+
+def _last_outbound_asked_question(ctx: "AgentContext") -> bool:
+    for _, msg_type, content in reversed(ctx.history):
+        if msg_type == "Outbound":
+            return (content or "").rstrip().endswith("?")
+    return False
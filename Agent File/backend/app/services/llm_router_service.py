@@ -0,0 +1,314 @@
+"""
+LLM Router Service
+Per-org provider fallback chain with rolling latency/error stats and optional hedging.
+
+Each org has a primary provider (ai_provider/ai_api_key/ai_model/ai_base_url) and
+an optional ordered fallback chain (organizations.ai_fallback_chain, JSON). The
+router tries targets in order, moving providers with a high recent error rate to
+the back. With hedging enabled, a second request goes to the next target once the
+primary has been running longer than its rolling p95; the first valid JSON
+response wins and the other request is cancelled. Every attempt first takes a slot
+from the key's rate limiter (see ai_rate_limiter); a target whose key has no capacity
+within the wait budget is skipped like a failed one. Voice replies stream the first
+attempt (on_text) so TTS can start before the response is complete.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from app.config import settings
+from app.services.ai_rate_limiter import PRIORITY_INTERACTIVE, RateLimits, ai_rate_limiter
+from app.services.prompt_builder import estimate_tokens
+from app.utils.metrics import metrics, percentile
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class LLMTarget:
+    """One provider/model/key combination the router can send a request to."""
+    provider: str
+    api_key: str
+    model: str
+    base_url: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return f"{self.provider}/{self.model or 'default'}"
+
+    @property
+    def stats_key(self) -> Tuple[str, str, str]:
+        """Health and latency are tracked per credential: one org's revoked or throttled key must not mark the provider down for everyone."""
+        fingerprint = hashlib.sha256((self.api_key or "").encode("utf-8")).hexdigest()[:16]
+        return self.label, self.base_url or "", fingerprint
+
+
+def parse_fallback_chain(raw: Optional[str]) -> Tuple[LLMTarget, ...]:
+    """Fallback targets from the org's ai_fallback_chain JSON (entries without a key are skipped)."""
+    try:
+        entries = json.loads(raw) if raw else []
+    except (TypeError, ValueError):
+        logger.warning("Ignoring malformed ai_fallback_chain")
+        return ()
+    targets = []
+    for entry in entries if isinstance(entries, list) else []:
+        if isinstance(entry, dict) and entry.get("provider") and entry.get("api_key"):
+            targets.append(LLMTarget(
+                provider=entry["provider"],
+                api_key=entry["api_key"],
+                model=entry.get("model") or "",
+                base_url=entry.get("base_url") or None,
+            ))
+    return tuple(targets)
+
+
+class InvalidJSONResponse(ValueError):
+    """A provider answered, but without a JSON object; kept as a last resort."""
+
+    def __init__(self, label: str, raw: str):
+        super().__init__(f"{label} returned no valid JSON object")
+        self.raw = raw
+
+
+def _summarize(recent: List[Tuple[float, float, bool]]) -> Dict[str, Any]:
+    latencies = [latency for _, latency, ok in recent if ok]
+    errors = sum(1 for _, _, ok in recent if not ok)
+    return {
+        "samples": len(recent),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "error_rate": round(errors / len(recent), 3) if recent else 0.0,
+    }
+
+
+class ProviderStats:
+    """Rolling window of (timestamp, latency, ok) samples for one target (provider, model, base URL, key)."""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[Tuple[float, float, bool]] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            self._samples.append((time.monotonic(), latency, ok))
+
+    def _recent(self) -> List[Tuple[float, float, bool]]:
+        cutoff = time.monotonic() - settings.llm_stats_window_seconds
+        with self._lock:
+            return [sample for sample in self._samples if sample[0] >= cutoff]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return _summarize(self._recent())
+
+
+class LLMRouter:
+    """Routes agent completions across an org's provider chain."""
+
+    def __init__(self):
+        self._stats: Dict[Tuple[str, str, str], ProviderStats] = {}
+        self._lock = threading.Lock()
+
+    def stats_for(self, target: LLMTarget) -> ProviderStats:
+        key = target.stats_key
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = ProviderStats()
+            return stats
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Overview per provider/model label, pooled across keys (no per-org detail)."""
+        with self._lock:
+            entries = list(self._stats.items())
+        pooled: Dict[str, List[Tuple[float, float, bool]]] = {}
+        for (label, _, _), stats in entries:
+            pooled.setdefault(label, []).extend(stats._recent())
+        return {label: _summarize(samples) for label, samples in pooled.items()}
+
+    def _is_unhealthy(self, target: LLMTarget) -> bool:
+        snap = self.stats_for(target).snapshot()
+        return snap["samples"] >= settings.llm_unhealthy_min_samples and snap["error_rate"] >= settings.llm_unhealthy_error_rate
+
+    def order_targets(self, targets: Sequence[LLMTarget]) -> List[LLMTarget]:
+        """Configured order, with currently unhealthy providers moved to the back."""
+        healthy = [t for t in targets if not self._is_unhealthy(t)]
+        return healthy + [t for t in targets if t not in healthy]
+
+    def hedge_delay(self, target: LLMTarget) -> float:
+        """How long to wait on a target before hedging: its rolling p95, or the default until enough samples exist."""
+        snap = self.stats_for(target).snapshot()
+        if snap["p95"] is None or snap["samples"] < settings.llm_unhealthy_min_samples:
+            return settings.llm_hedge_default_delay_seconds
+        return max(settings.llm_hedge_min_delay_seconds, snap["p95"])
+
+    async def _attempt(
+        self,
+        target: LLMTarget,
+        system_prompt: str,
+        user_turn: str,
+        timeout: float,
+        limits: Optional[RateLimits] = None,
+        priority: str = PRIORITY_INTERACTIVE,
+        on_text: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """One request; raises on rate limiting, transport errors, timeouts and responses without a JSON object."""
+        from app.services.agent_service import call_ai_provider
+        prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_turn)
+        async with ai_rate_limiter.slot(target.api_key, limits, prompt_tokens, priority):
+            return await self._call(call_ai_provider, target, system_prompt, user_turn, timeout, on_text)
+
+    async def _call(
+        self,
+        call_ai_provider,
+        target: LLMTarget,
+        system_prompt: str,
+        user_turn: str,
+        timeout: float,
+        on_text: Optional[Callable[[str], None]] = None
+    ) -> str:
+        started = time.monotonic()
+        streaming = {"on_text": on_text} if on_text else {}
+        try:
+            raw = await asyncio.wait_for(
+                call_ai_provider(
+                    provider=target.provider,
+                    api_key=target.api_key,
+                    model=target.model,
+                    system_prompt=system_prompt,
+                    user_turn=user_turn,
+                    base_url=target.base_url,
+                    timeout=timeout,
+                    **streaming
+                ),
+                timeout=timeout
+            )
+            if not is_valid_json_response(raw):
+                raise InvalidJSONResponse(target.label, raw)
+        except asyncio.CancelledError:
+            # Lost a hedge race; not a provider failure
+            raise
+        except Exception:
+            elapsed = time.monotonic() - started
+            self.stats_for(target).record(elapsed, ok=False)
+            metrics.incr("llm_requests", provider=target.label, outcome="error")
+            raise
+        elapsed = time.monotonic() - started
+        self.stats_for(target).record(elapsed, ok=True)
+        metrics.observe("llm_latency_seconds", elapsed, provider=target.label)
+        metrics.incr("llm_requests", provider=target.label, outcome="ok")
+        return raw
+
+    async def complete(
+        self,
+        targets: Sequence[LLMTarget],
+        system_prompt: str,
+        user_turn: str,
+        hedge: bool = False,
+        limits: Optional[RateLimits] = None,
+        priority: str = PRIORITY_INTERACTIVE,
+        on_text: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """
+        Raw text of the first valid JSON response from the chain. If no target returns JSON
+        but one answered in plain text, that text is returned (the agent treats it as the reply).
+        Raises the last error when every target fails or the overall deadline
+        (llm_total_timeout_seconds) passes.
+        on_text streams the first attempt only; fallbacks and hedges run unstreamed, so
+        the listener sees at most one (possibly partial) response and must check it
+        against the returned text.
+        """
+        ordered = self.order_targets([t for t in targets if t.api_key])
+        if not ordered:
+            raise ValueError("AI API key is missing.")
+
+        deadline = time.monotonic() + settings.llm_total_timeout_seconds
+        pending: Dict[asyncio.Task, LLMTarget] = {}
+        next_index = 0
+        last_error: Optional[BaseException] = None
+        plain_text: Optional[str] = None
+
+        def launch() -> bool:
+            nonlocal next_index
+            remaining = deadline - time.monotonic()
+            if next_index >= len(ordered) or remaining <= 0:
+                return False
+            target = ordered[next_index]
+            next_index += 1
+            timeout = min(settings.llm_request_timeout_seconds, remaining)
+            pending[asyncio.create_task(
+                self._attempt(target, system_prompt, user_turn, timeout, limits, priority, on_text if next_index == 1 else None)
+            )] = target
+            if next_index > 1:
+                metrics.incr("llm_fallbacks", provider=target.label)
+            return True
+
+        launch()
+        try:
+            while pending:
+                wait_for = deadline - time.monotonic()
+                can_hedge = hedge and next_index < len(ordered) and len(pending) == 1
+                if can_hedge:
+                    primary = next(iter(pending.values()))
+                    wait_for = min(wait_for, self.hedge_delay(primary))
+                done, _ = await asyncio.wait(pending, timeout=max(0.0, wait_for), return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    if not can_hedge or time.monotonic() >= deadline:
+                        raise asyncio.TimeoutError(f"LLM chain exceeded {settings.llm_total_timeout_seconds}s")
+                    # Primary is past its p95: hedge with the next target
+                    logger.info(f"⏱️ {primary.label} slower than its p95, hedging with next provider")
+                    metrics.incr("llm_hedged_requests", provider=primary.label)
+                    launch()
+                    continue
+
+                for task in done:
+                    target = pending.pop(task)
+                    try:
+                        raw = task.result()
+                    except Exception as e:
+                        last_error = e
+                        if isinstance(e, InvalidJSONResponse) and e.raw.strip():
+                            plain_text = plain_text or e.raw
+                        logger.warning(f"LLM provider {target.label} failed: {type(e).__name__}: {e}")
+                        continue
+                    if target is not ordered[0]:
+                        logger.info(f"🔀 Reply served by {target.label}")
+                    metrics.incr("llm_responses_served", provider=target.label)
+                    return raw
+
+                if not pending and not launch():
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        if plain_text is not None:
+            return plain_text
+        raise last_error or RuntimeError("No LLM provider produced a response")
+
+
+def is_valid_json_response(raw: Optional[str]) -> bool:
+    """True when the text contains a parseable JSON object (the agent's response contract)."""
+    if not raw:
+        return False
+    match = re.search(r"\{[\s\S]*\}", raw)
+    if not match:
+        return False
+    try:
+        return isinstance(json.loads(match.group(0)), dict)
+    except ValueError:
+        return False
+
+
+# Singleton instance
+llm_router = LLMRouter()
@@ -8,6 +8,8 @@ from typing import Optional, Dict, Any
 import logging
 import base64
 
+from app.services.http_client_service import get_http_client
+
 logger = logging.getLogger(__name__)
 
 
@@ -44,39 +46,40 @@ class MetaWhatsAppService:
         to_phone = to_phone.replace("+", "").replace(" ", "").replace("-", "")
         
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/{self.phone_number_id}/messages",
-                    headers={
-                        "Authorization": f"Bearer {self.access_token}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "messaging_product": "whatsapp",
-                        "to": to_phone,
-                        "type": "text",
-                        "text": {
-                            "preview_url": True,
-                            "body": message
-                        }
+            client = get_http_client(self.base_url)
+            response = await client.post(
+                f"{self.base_url}/{self.phone_number_id}/messages",
+                headers={
+                    "Authorization": f"Bearer {self.access_token}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "messaging_product": "whatsapp",
+                    "to": to_phone,
+                    "type": "text",
+                    "text": {
+                        "preview_url": True,
+                        "body": message
                     }
-                )
+                },
+                timeout=30.0
+            )
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    return {
-                        "success": True,
-                        "messageId": data.get("messages", [{}])[0].get("id"),
-                        "provider": "meta"
-                    }
-                else:
-                    error_data = response.json()
-                    logger.error(f"Meta API returned {response.status_code}: {error_data}")
-                    return {
-                        "success": False,
-                        "error": error_data.get("error", {}).get("message", f"HTTP {response.status_code}"),
-                        "provider": "meta"
-                    }
+            if response.status_code == 200:
+                data = response.json()
+                return {
+                    "success": True,
+                    "messageId": data.get("messages", [{}])[0].get("id"),
+                    "provider": "meta"
+                }
+            else:
+                error_data = response.json()
+                logger.error(f"Meta API returned {response.status_code}: {error_data}")
+                return {
+                    "success": False,
+                    "error": error_data.get("error", {}).get("message", f"HTTP {response.status_code}"),
+                    "provider": "meta"
+                }
                     
         except httpx.TimeoutException:
             logger.error("Timeout connecting to Meta WhatsApp API")
@@ -161,32 +164,33 @@ class MetaWhatsAppService:
                     )
                 )
 
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    upload_response = await client.post(
-                        f"{self.base_url}/{self.phone_number_id}/media",
-                        headers={
-                            "Authorization": f"Bearer {self.access_token}"
-                        },
-                        data={
-                            "messaging_product": "whatsapp",
-                            "type": content_type
-                        },
-                        files={
-                            "file": (upload_filename, file_bytes, content_type)
-                        }
-                    )
+                client = get_http_client(self.base_url)
+                upload_response = await client.post(
+                    f"{self.base_url}/{self.phone_number_id}/media",
+                    headers={
+                        "Authorization": f"Bearer {self.access_token}"
+                    },
+                    data={
+                        "messaging_product": "whatsapp",
+                        "type": content_type
+                    },
+                    files={
+                        "file": (upload_filename, file_bytes, content_type)
+                    },
+                    timeout=60.0
+                )
 
-                    if upload_response.status_code != 200:
-                        err_json = upload_response.json()
-                        logger.error(f"Meta Media Upload failed: {err_json}")
-                        return {
-                            "success": False,
-                            "error": err_json.get("error", {}).get("message", f"Media upload failed (HTTP {upload_response.status_code})"),
-                            "provider": "meta"
-                        }
+                if upload_response.status_code != 200:
+                    err_json = upload_response.json()
+                    logger.error(f"Meta Media Upload failed: {err_json}")
+                    return {
+                        "success": False,
+                        "error": err_json.get("error", {}).get("message", f"Media upload failed (HTTP {upload_response.status_code})"),
+                        "provider": "meta"
+                    }
 
-                    media_id = upload_response.json().get("id")
-                    media_payload = {"id": media_id}
+                media_id = upload_response.json().get("id")
+                media_payload = {"id": media_id}
             
             # Build message payload
             message_payload = {
@@ -205,31 +209,32 @@ class MetaWhatsAppService:
             if meta_media_type == "document" and filename:
                 message_payload[meta_media_type]["filename"] = filename
             
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/{self.phone_number_id}/messages",
-                    headers={
-                        "Authorization": f"Bearer {self.access_token}",
-                        "Content-Type": "application/json"
-                    },
-                    json=message_payload
-                )
+            client = get_http_client(self.base_url)
+            response = await client.post(
+                f"{self.base_url}/{self.phone_number_id}/messages",
+                headers={
+                    "Authorization": f"Bearer {self.access_token}",
+                    "Content-Type": "application/json"
+                },
+                json=message_payload,
+                timeout=60.0
+            )
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    return {
-                        "success": True,
-                        "messageId": data.get("messages", [{}])[0].get("id"),
-                        "provider": "meta"
-                    }
-                else:
-                    error_data = response.json()
-                    logger.error(f"Meta API returned {response.status_code}: {error_data}")
-                    return {
-                        "success": False,
-                        "error": error_data.get("error", {}).get("message", f"HTTP {response.status_code}"),
-                        "provider": "meta"
-                    }
+            if response.status_code == 200:
+                data = response.json()
+                return {
+                    "success": True,
+                    "messageId": data.get("messages", [{}])[0].get("id"),
+                    "provider": "meta"
+                }
+            else:
+                error_data = response.json()
+                logger.error(f"Meta API returned {response.status_code}: {error_data}")
+                return {
+                    "success": False,
+                    "error": error_data.get("error", {}).get("message", f"HTTP {response.status_code}"),
+                    "provider": "meta"
+                }
                     
         except httpx.TimeoutException:
             logger.error("Timeout sending media to Meta WhatsApp API")
@@ -252,50 +257,52 @@ class MetaWhatsAppService:
         to_phone = to_phone.replace("+", "").replace(" ", "").replace("-", "")
         try:
             # Step 1: Upload the audio binary to Meta's /media endpoint
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                upload_response = await client.post(
-                    f"{self.base_url}/{self.phone_number_id}/media",
-                    headers={"Authorization": f"Bearer {self.access_token}"},
-                    data={"messaging_product": "whatsapp", "type": mime_type},
-                    files={"file": ("voice_note.ogg", audio_bytes, mime_type)}
-                )
+            client = get_http_client(self.base_url)
+            upload_response = await client.post(
+                f"{self.base_url}/{self.phone_number_id}/media",
+                headers={"Authorization": f"Bearer {self.access_token}"},
+                data={"messaging_product": "whatsapp", "type": mime_type},
+                files={"file": ("voice_note.ogg", audio_bytes, mime_type)},
+                timeout=60.0
+            )
 
-                if upload_response.status_code != 200:
-                    err = upload_response.json()
-                    logger.error(f"Voice note media upload failed: {err}")
-                    return {"success": False, "error": err.get("error", {}).get("message", "Upload failed"), "provider": "meta"}
+            if upload_response.status_code != 200:
+                err = upload_response.json()
+                logger.error(f"Voice note media upload failed: {err}")
+                return {"success": False, "error": err.get("error", {}).get("message", "Upload failed"), "provider": "meta"}
 
-                media_id = upload_response.json().get("id")
-                logger.info(f"🎙️ Voice note uploaded to Meta, media_id={media_id}")
+            media_id = upload_response.json().get("id")
+            logger.info(f"🎙️ Voice note uploaded to Meta, media_id={media_id}")
 
             # Step 2: Send as native audio/voice note (NOT document)
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                message_payload = {
-                    "messaging_product": "whatsapp",
-                    "recipient_type": "individual",
-                    "to": to_phone,
-                    "type": "audio",
-                    "audio": {"id": media_id}
+            client = get_http_client(self.base_url)
+            message_payload = {
+                "messaging_product": "whatsapp",
+                "recipient_type": "individual",
+                "to": to_phone,
+                "type": "audio",
+                "audio": {"id": media_id}
+            }
+            response = await client.post(
+                f"{self.base_url}/{self.phone_number_id}/messages",
+                headers={
+                    "Authorization": f"Bearer {self.access_token}",
+                    "Content-Type": "application/json"
+                },
+                json=message_payload,
+                timeout=30.0
+            )
+            if response.status_code == 200:
+                data = response.json()
+                return {
+                    "success": True,
+                    "messageId": data.get("messages", [{}])[0].get("id"),
+                    "provider": "meta"
                 }
-                response = await client.post(
-                    f"{self.base_url}/{self.phone_number_id}/messages",
-                    headers={
-                        "Authorization": f"Bearer {self.access_token}",
-                        "Content-Type": "application/json"
-                    },
-                    json=message_payload
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    return {
-                        "success": True,
-                        "messageId": data.get("messages", [{}])[0].get("id"),
-                        "provider": "meta"
-                    }
-                else:
-                    error_data = response.json()
-                    logger.error(f"Voice note send failed: {error_data}")
-                    return {"success": False, "error": error_data.get("error", {}).get("message", f"HTTP {response.status_code}"), "provider": "meta"}
+            else:
+                error_data = response.json()
+                logger.error(f"Voice note send failed: {error_data}")
+                return {"success": False, "error": error_data.get("error", {}).get("message", f"HTTP {response.status_code}"), "provider": "meta"}
 
         except Exception as e:
             logger.error(f"Error sending voice note via Meta: {str(e)}")
@@ -309,28 +316,29 @@ class MetaWhatsAppService:
             dict: {"status": "connected" | "disconnected" | "error", ...}
         """
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                # Try to get phone number details to verify connection
-                response = await client.get(
-                    f"{self.base_url}/{self.phone_number_id}",
-                    headers={"Authorization": f"Bearer {self.access_token}"},
-                    params={"fields": "id,verified_name"}
-                )
+            client = get_http_client(self.base_url)
+            # Try to get phone number details to verify connection
+            response = await client.get(
+                f"{self.base_url}/{self.phone_number_id}",
+                headers={"Authorization": f"Bearer {self.access_token}"},
+                params={"fields": "id,verified_name"},
+                timeout=5.0
+            )
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    return {
-                        "status": "connected",
-                        "provider": "meta",
-                        "verified_name": data.get("verified_name"),
-                        "phone_number_id": self.phone_number_id
-                    }
-                else:
-                    return {
-                        "status": "error",
-                        "provider": "meta",
-                        "message": f"Meta API returned {response.status_code}"
-                    }
+            if response.status_code == 200:
+                data = response.json()
+                return {
+                    "status": "connected",
+                    "provider": "meta",
+                    "verified_name": data.get("verified_name"),
+                    "phone_number_id": self.phone_number_id
+                }
+            else:
+                return {
+                    "status": "error",
+                    "provider": "meta",
+                    "message": f"Meta API returned {response.status_code}"
+                }
                     
         except httpx.TimeoutException:
             return {"status": "disconnected", "provider": "meta", "message": "API timeout"}
@@ -0,0 +1,293 @@
+"""
+Organization Config Service
+Typed, per-org config snapshots cached in-process with a TTL.
+
+The agent, the scheduler and the WhatsApp send/status endpoints all need the same
+handful of organization columns (AI provider/key/model, autopilot settings,
+delivery method and Meta credentials). Instead of re-reading the row on every
+call, a frozen OrgConfig snapshot is cached per org. Writes through
+/api/settings (and bridge registration) invalidate the entry locally and
+broadcast a Postgres NOTIFY so every other gunicorn worker drops it too.
+"""
+
+import logging
+import select
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import engine
+from app.services.llm_router_service import LLMTarget, parse_fallback_chain
+from app.services.ai_rate_limiter import RateLimits
+from app.services.intent_router_service import parse_quick_replies
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "org_config_invalidate"
+DEFAULT_BRIDGE_URL = "http://localhost:3001"
+
+
+@dataclass(frozen=True)
+class OrgConfig:
+    """Snapshot of the organization settings used on the message hot path."""
+    org_id: str
+    name: str
+    ai_name: str
+    ai_provider: str
+    ai_api_key: Optional[str]
+    ai_model: str
+    ai_base_url: Optional[str]
+    ai_auto_reply_enabled: bool
+    ai_reply_mode: str
+    ai_reply_delay_seconds: int
+    ai_tone: Optional[str]
+    ai_payment_link: Optional[str]
+    ai_business_type: Optional[str]
+    ai_voice_reply_mode: str
+    ai_voice_name: str
+    whatsapp_phone_id: Optional[str]
+    whatsapp_business_account_id: Optional[str]
+    whatsapp_access_token: Optional[str]
+    wppconnect_bridge_url: Optional[str]
+    ai_prompt_token_budget: Optional[int] = None  # None = settings.agent_prompt_token_budget
+    ai_fallback_chain: Tuple[LLMTarget, ...] = ()
+    ai_hedge_enabled: bool = False
+    ai_rate_limit_rpm: Optional[int] = None  # None = settings defaults
+    ai_rate_limit_tpm: Optional[int] = None
+    ai_max_concurrency: Optional[int] = None
+    ai_reply_cache_enabled: bool = False
+    ai_reply_cache_threshold: Optional[float] = None  # None = settings.reply_cache_similarity_threshold
+    knowledge_version: int = 0
+    ai_fast_path_enabled: bool = True
+    ai_quick_replies: Tuple[Tuple[str, Tuple[str, ...]], ...] = ()  # per-intent template overrides
+    ai_transcription_language: Optional[str] = None  # voice note language hint; None = detect
+    ai_reply_drafts_enabled: bool = False  # opt-in: suggest mode drafts replies instead of auto-sending
+
+    def llm_targets(self) -> List[LLMTarget]:
+        """Primary provider followed by the fallback chain, for the LLM router."""
+        primary = LLMTarget(self.ai_provider, self.ai_api_key or "", self.ai_model, self.ai_base_url)
+        return [primary, *self.ai_fallback_chain]
+
+    def rate_limits(self) -> RateLimits:
+        """Limits for this org's API keys, falling back to the server defaults."""
+        defaults = RateLimits.default()
+        return RateLimits(
+            requests_per_minute=self.ai_rate_limit_rpm or defaults.requests_per_minute,
+            tokens_per_minute=self.ai_rate_limit_tpm or defaults.tokens_per_minute,
+            max_concurrency=self.ai_max_concurrency or defaults.max_concurrency,
+        )
+
+    @property
+    def delivery_method(self) -> str:
+        return "meta" if self.whatsapp_phone_id and self.whatsapp_access_token else "wppconnect"
+
+    def whatsapp_config(self) -> dict:
+        """Delivery method and credentials, in the shape get_organization_whatsapp_config returns."""
+        if self.delivery_method == "meta":
+            return {
+                "delivery_method": "meta",
+                "phone_number_id": self.whatsapp_phone_id,
+                "access_token": self.whatsapp_access_token
+            }
+        return {
+            "delivery_method": "wppconnect",
+            "bridge_url": self.wppconnect_bridge_url or DEFAULT_BRIDGE_URL
+        }
+
+
+def _parse_int(raw) -> int:
+    try:
+        return max(0, int(float(raw))) if raw not in (None, "") else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def _parse_float(raw) -> Optional[float]:
+    try:
+        return float(raw) if raw not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _load_org_config(db: Session, org_id: str) -> Optional[OrgConfig]:
+    row = db.execute(
+        text("""
+            SELECT name, ai_name, ai_provider, ai_api_key, ai_model, ai_base_url,
+                   ai_auto_reply_enabled, ai_reply_mode, ai_reply_delay_seconds,
+                   ai_tone, ai_payment_link, ai_business_type, ai_voice_reply_mode, ai_voice_name,
+                   whatsapp_phone_id, whatsapp_business_account_id, whatsapp_access_token,
+                   wppconnect_bridge_url, ai_prompt_token_budget, ai_fallback_chain, ai_hedge_enabled,
+                   ai_rate_limit_rpm, ai_rate_limit_tpm, ai_max_concurrency,
+                   ai_reply_cache_enabled, ai_reply_cache_threshold, knowledge_version,
+                   ai_fast_path_enabled, ai_quick_replies, ai_transcription_language,
+                   ai_reply_drafts_enabled
+            FROM organizations
+            WHERE id = :org_id
+        """),
+        {"org_id": org_id}
+    ).fetchone()
+    if not row:
+        return None
+    return OrgConfig(
+        org_id=org_id,
+        name=row[0] or "",
+        ai_name=row[1] or "Shepherd AI",
+        ai_provider=row[2] or "gemini",
+        ai_api_key=row[3],
+        ai_model=row[4] or "gemini-2.0-flash",
+        ai_base_url=row[5],
+        ai_auto_reply_enabled=str(row[6]).lower() == "true",
+        ai_reply_mode=row[7] or "suggest",
+        ai_reply_delay_seconds=_parse_int(row[8]),
+        ai_tone=row[9],
+        ai_payment_link=row[10],
+        ai_business_type=row[11],
+        ai_voice_reply_mode=row[12] or "text",
+        ai_voice_name=row[13] or "en-NG-EzinneNeural",
+        whatsapp_phone_id=row[14],
+        whatsapp_business_account_id=row[15],
+        whatsapp_access_token=row[16],
+        wppconnect_bridge_url=row[17],
+        ai_prompt_token_budget=_parse_int(row[18]) or None,
+        ai_fallback_chain=parse_fallback_chain(row[19]),
+        ai_hedge_enabled=str(row[20]).lower() == "true",
+        ai_rate_limit_rpm=_parse_int(row[21]) or None,
+        ai_rate_limit_tpm=_parse_int(row[22]) or None,
+        ai_max_concurrency=_parse_int(row[23]) or None,
+        ai_reply_cache_enabled=str(row[24]).lower() == "true",
+        ai_reply_cache_threshold=_parse_float(row[25]),
+        knowledge_version=row[26] or 0,
+        ai_fast_path_enabled=str(row[27]).lower() != "false",
+        ai_quick_replies=parse_quick_replies(row[28]),
+        ai_transcription_language=(row[29] or "").strip().lower() or None,
+        ai_reply_drafts_enabled=str(row[30]).lower() == "true",
+    )
+
+
+class OrgConfigCache:
+    """TTL cache of OrgConfig snapshots, shared by the event loop and worker threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[OrgConfig, float]] = {}
+
+    def get(self, db: Session, org_id) -> Optional[OrgConfig]:
+        key = str(org_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[1] > now:
+            metrics.incr("org_config_cache", result="hit")
+            return entry[0]
+
+        metrics.incr("org_config_cache", result="miss")
+        config = _load_org_config(db, key)
+        if config is not None:
+            with self._lock:
+                self._entries[key] = (config, now + settings.org_config_cache_ttl_seconds)
+        return config
+
+    def invalidate(self, org_id=None):
+        """Drop one org (or everything when org_id is None) from this process."""
+        with self._lock:
+            if org_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(org_id), None)
+
+
+# Singleton instance
+org_config_cache = OrgConfigCache()
+
+
+def get_org_config(db: Session, org_id) -> Optional[OrgConfig]:
+    """Cached config snapshot for an organization (None if it does not exist)."""
+    return org_config_cache.get(db, org_id)
+
+
+def invalidate_org_config(db: Session, org_id):
+    """
+    Call after committing a write to the organization's settings.
+    Drops the local entry and notifies the other workers via Postgres NOTIFY.
+    """
+    org_config_cache.invalidate(org_id)
+    try:
+        db.execute(
+            text("SELECT pg_notify(:channel, :org_id)"),
+            {"channel": INVALIDATION_CHANNEL, "org_id": str(org_id)}
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Could not broadcast org config invalidation for {org_id}: {e}")
+
+
+class OrgConfigInvalidationListener:
+    """Background thread that LISTENs for invalidations published by other workers."""
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if engine.dialect.name != "postgresql":
+            logger.info("Org config invalidation listener disabled (not PostgreSQL); relying on TTL.")
+            return
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="org-config-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            connection = None
+            try:
+                # Dedicated connection, detached so it never counts against the request pool
+                connection = engine.raw_connection()
+                connection.detach()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.autocommit = True
+                cursor = dbapi_connection.cursor()
+                cursor.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+                logger.info("🔔 Listening for org config invalidations")
+                # Anything may have changed while we were not listening
+                org_config_cache.invalidate()
+                backoff = 1.0
+
+                while not self._stop.is_set():
+                    readable, _, _ = select.select([dbapi_connection], [], [], 5.0)
+                    if not readable:
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        org_config_cache.invalidate(notify.payload or None)
+                        metrics.incr("org_config_invalidations_received")
+            except Exception as e:
+                logger.warning(f"Org config listener error: {e}; reconnecting in {backoff:.0f}s")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+
+# Singleton instance
+org_config_listener = OrgConfigInvalidationListener()
@@ -0,0 +1,278 @@
+"""
+Agent Prompt Builder
+Splits the auto-reply prompt into a stable per-org prefix and a volatile suffix.
+
+The prefix (persona, tone, files, payment link, rules, response format, action
+guide) is identical for every reply of an organization until its settings or
+media library change, so it is sent as the system prompt where OpenAI/DeepSeek
+prefix caching and Gemini cached content can reuse it. Everything that changes
+per message (clock, contact, flow state, knowledge hits, profile card, rolling
+summary, recent history, the new message) goes into the user turn after it.
+
+Prompts are kept within a per-org token budget (fast local estimate): each volatile
+section has a cap and a priority, and the lowest-priority sections are truncated or
+dropped first when the total would exceed the budget.
+"""
+
+import hashlib
+import logging
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.utils.metrics import TOKEN_BUCKETS, metrics
+
+if TYPE_CHECKING:
+    from app.services.agent_service import AgentContext
+
+logger = logging.getLogger(__name__)
+
+
+CHARS_PER_TOKEN = 4
+
+# Sections dropped instead of truncated when less than this would remain
+MIN_SECTION_TOKENS = 32
+
+# name -> (priority, max_tokens). Higher priority survives longer when the prompt is
+# over budget; None means no cap. Required sections are never cut.
+SECTION_LIMITS: Dict[str, Tuple[int, Optional[int]]] = {
+    "message": (100, None),
+    "instruction": (100, None),
+    "calendar": (100, None),
+    "contact": (90, 200),
+    "flow": (85, 300),
+    "history": (80, 1200),
+    "knowledge_base": (70, 1500),
+    "profile": (60, 200),
+    "summary": (50, 500),
+}
+REQUIRED_SECTIONS = {"message", "instruction", "calendar"}
+
+# Cap on the file list in the static prefix (the prefix stays deterministic per org)
+FILES_MAX_TOKENS = 300
+
+# Sections whose most recent lines matter most are cut from the front
+KEEP_TAIL = {"history"}
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Fast local token estimate: ~4 characters per token, never below the word count."""
+    if not text:
+        return 0
+    return max((len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN, len(text.split()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """Cut text to roughly max_tokens on a line boundary where possible, marking the cut with an ellipsis."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN - 1)
+    if keep == "tail":
+        cut = text[-max_chars:] if max_chars else ""
+        newline = cut.find("\n")
+        if 0 <= newline < len(cut) // 2:
+            cut = cut[newline + 1:]
+        return "…" + cut
+    cut = text[:max_chars]
+    newline = cut.rfind("\n")
+    if newline > len(cut) // 2:
+        cut = cut[:newline]
+    return cut.rstrip() + "…"
+
+
+@dataclass
+class PromptSection:
+    """One titled block of the volatile prompt with its budget rules."""
+    name: str
+    title: Optional[str]
+    body: str
+    priority: int
+    max_tokens: Optional[int] = None
+    required: bool = False
+    keep: str = "head"
+
+    def render(self) -> str:
+        return f"{self.title}:\n{self.body}" if self.title else self.body
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.render()) if self.body else 0
+
+
+def _section(name: str, title: Optional[str], body: str) -> PromptSection:
+    priority, max_tokens = SECTION_LIMITS[name]
+    return PromptSection(
+        name=name,
+        title=title,
+        body=body,
+        priority=priority,
+        max_tokens=max_tokens,
+        required=name in REQUIRED_SECTIONS,
+        keep="tail" if name in KEEP_TAIL else "head",
+    )
+
+
+def assemble_sections(sections: List[PromptSection], budget: int) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Apply per-section caps, then cut the lowest-priority sections until the total fits the
+    budget. Returns the rendered blocks (original order) and the final token count per section,
+    which are also recorded as metrics.
+    """
+    for section in sections:
+        if section.max_tokens and not section.required and section.tokens > section.max_tokens:
+            section.body = truncate_to_tokens(section.body, section.max_tokens, section.keep)
+            metrics.incr("prompt_sections_truncated", section=section.name, reason="cap")
+
+    overflow = sum(section.tokens for section in sections) - budget
+    for section in sorted((s for s in sections if not s.required), key=lambda s: s.priority):
+        if overflow <= 0:
+            break
+        current = section.tokens
+        if current - overflow >= MIN_SECTION_TOKENS:
+            section.body = truncate_to_tokens(section.body, current - overflow - estimate_tokens(section.title), section.keep)
+            metrics.incr("prompt_sections_truncated", section=section.name, reason="budget")
+        else:
+            section.body = ""
+            metrics.incr("prompt_sections_dropped", section=section.name)
+        overflow -= current - section.tokens
+
+    section_tokens = {}
+    for section in sections:
+        section_tokens[section.name] = section.tokens
+        metrics.observe("prompt_section_tokens", section.tokens, buckets=TOKEN_BUCKETS, section=section.name)
+    return [section.render() for section in sections if section.body], section_tokens
+
+
+# Only for orgs with the semantic reply cache on (see reply_cache_service)
+REUSABLE_ANSWER_RULES = """
+REUSABLE ANSWERS:
+Also include "generic": true in the JSON object when your reply would be exactly right for ANY contact sending the same message: a general fact about the organization (service times, location, how to pay, opening hours) that does not use the contact's name, their history, bookings or earlier messages, and does not depend on today's date or time. Otherwise include "generic": false.
+"""
+
+
+def build_static_prefix(ctx: "AgentContext") -> str:
+    """Per-org instructions that do not change between messages."""
+    return f"""You are {ctx.ai_name}, the AI representative for {ctx.org_name} ({ctx.biz_type}).
+
+TONE & STYLE:
+{ctx.tone}
+Write WhatsApp-appropriate messages (concise, warm, attentive, helpful, natural). Never sound like an emotionless robot. Always answer greetings, check-ins ("are you there", "hello"), and continue conversations seamlessly.
+
+AVAILABLE FILES TO DELIVER:
+{truncate_to_tokens(ctx.available_files_str, FILES_MAX_TOKENS)}
+
+PAYMENT LINK:
+{ctx.payment_link}
+
+APPOINTMENT & BOOKING RULES:
+1. When a contact wants to book, find out: (1) Purpose/Topic, (2) Date, (3) Time.
+2. When the contact gives relative dates like "tomorrow", "this time tomorrow", "Friday at 2pm", ALWAYS convert them using the CURRENT CALENDAR & CLOCK CONTEXT in the message:
+   - "preferredDate": Exact ISO date format (YYYY-MM-DD). NEVER return relative words.
+   - "preferredTime": Standard 12-hour format (e.g. "10:30 PM", "03:00 PM").
+3. When confirming an appointment or when the contact says "yes", "correct", or confirms details:
+   - Set "type": "CREATE_BOOKING" with finalized "purpose", "preferredDate" (YYYY-MM-DD), and "preferredTime" (HH:MM AM/PM).
+   - Your "reply" MUST explicitly confirm the booking to the contact (e.g. "Awesome, [Name]! Your appointment for [Topic] is booked for tomorrow, [Month Day, Year] at [Time]. Looking forward to speaking with you!").
+
+NO EMOJIS RULE:
+- NEVER use emojis, smileys, or emoticons in your replies (do NOT use emojis like 😊, 🙌, 🎉, etc.).
+- Keep all responses completely free of emojis in both text and voice notes.
+
+VOICE NOTE RULES:
+- When a customer sends a voice message that was successfully transcribed, it appears as "[Voice Note]: <transcription>". Answer their message directly, warmly, and helpfully as if they spoke to you.
+- If the message is exactly "[Voice message]" (NOT "[Voice Note]: ..."), it means the audio could NOT be transcribed. In this case, politely let them know you heard their voice message but couldn't make it out clearly, and ask them to send it again or type it out. Example: "Hey, I got your voice message but couldn't quite make it out! Could you type it out or try sending it again?"
+- NEVER say "Thanks for your voice message, I'm here and ready to listen. What's on your mind?" — this sounds robotic.
+- NEVER say "I cannot listen to voice notes" — you CAN listen to them most of the time.
+
+RESPONSE FORMAT — You must return ONLY a JSON object:
+{{
+  "reply": "Your WhatsApp response text to the contact",
+  "action": {{
+    "type": "NONE",
+    "documentName": "",
+    "imageName": "",
+    "purpose": "",
+    "preferredDate": "",
+    "preferredTime": "",
+    "query": "",
+    "reason": ""
+  }}
+}}
+
+ACTION TYPE GUIDE:
+- NONE: standard conversational reply / answering greetings and questions
+- CREATE_BOOKING: customer wants to book/schedule an appointment (include purpose, preferredDate YYYY-MM-DD, preferredTime HH:MM AM/PM)
+- SEND_DOCUMENT: customer asks for a document, price list, menu, PDF, or form
+- SEND_IMAGE: customer asks for a photo, map, or picture
+- SEND_PAYMENT_LINK: customer asks how to pay, fees, pricing, or purchase
+- WEB_SEARCH: customer asks factual/timely question not in knowledge base
+- FLAG_FOR_HUMAN: customer is in crisis, angry, or asks for a human manager
+""" + (REUSABLE_ANSWER_RULES if ctx.reply_cache_enabled else "")
+
+
+def build_volatile_context(ctx: "AgentContext", kb_context: str, history_text: str) -> List[PromptSection]:
+    """Per-message context sections, in prompt order."""
+    now = ctx.now
+    tomorrow_dt = now + timedelta(days=1)
+    current_time_str = now.strftime("%I:%M %p").lstrip("0")
+
+    contact_lines = [
+        f"- Name: {ctx.contact_name}",
+        f"- Category: {ctx.contact_category}",
+        f"- Phone: {ctx.contact_phone}",
+    ]
+    if ctx.contact_notes:
+        contact_lines.append(f"- Notes: {ctx.contact_notes}")
+
+    sections = [
+        _section("calendar", "CURRENT CALENDAR & CLOCK CONTEXT", "\n".join([
+            f"- Today is: {now.strftime('%A')}, {now.strftime('%B %d, %Y')} ({now.strftime('%Y-%m-%d')})",
+            f"- Current Time: {current_time_str}",
+            f"- Tomorrow is: {tomorrow_dt.strftime('%A')}, {tomorrow_dt.strftime('%B %d, %Y')} ({tomorrow_dt.strftime('%Y-%m-%d')})",
+        ])),
+        _section("contact", "CONTACT DETAILS", "\n".join(contact_lines)),
+    ]
+    if ctx.session_prompt.strip():
+        sections.append(_section("flow", None, ctx.session_prompt.strip()))
+    sections.append(_section("knowledge_base", "KNOWLEDGE BASE", kb_context))
+    if ctx.profile_card:
+        sections.append(_section("profile", "CONTACT PROFILE", ctx.profile_card))
+    if ctx.conversation_summary:
+        sections.append(_section("summary", "EARLIER CONVERSATION (summary)", ctx.conversation_summary))
+    sections.append(_section("history", "CONVERSATION HISTORY (most recent)", history_text))
+    return sections
+
+
+def build_user_turn(ctx: "AgentContext", kb_context: str, history_text: str, incoming_text: str, budget: Optional[int] = None) -> str:
+    """
+    Volatile suffix: per-message context followed by the new message(s), fitted to the
+    token budget left after the static prefix.
+    """
+    sections = build_volatile_context(ctx, kb_context, history_text)
+    if len(ctx.inbound) > 1:
+        sections.append(_section("message", None, f"New messages from {ctx.contact_name} (sent in quick succession, reply to them together):\n\"{incoming_text}\""))
+    else:
+        sections.append(_section("message", None, f"New message from {ctx.contact_name}:\n\"{incoming_text}\""))
+    sections.append(_section("instruction", None, "Generate your JSON response."))
+
+    if budget is None:
+        budget = ctx.prompt_token_budget or settings.agent_prompt_token_budget
+    blocks, section_tokens = assemble_sections(sections, budget)
+    logger.debug(f"Prompt section tokens: {section_tokens}")
+    return "\n\n".join(blocks)
+
+
+def build_agent_prompt(ctx: "AgentContext", kb_context: str, history_text: str, incoming_text: str) -> Tuple[str, str]:
+    """(system_prompt, user_turn) with the cacheable prefix first, together within the org's token budget."""
+    system_prompt = build_static_prefix(ctx)
+    prefix_tokens = estimate_tokens(system_prompt)
+    metrics.observe("prompt_section_tokens", prefix_tokens, buckets=TOKEN_BUCKETS, section="static_prefix")
+    budget = ctx.prompt_token_budget or settings.agent_prompt_token_budget
+    user_turn = build_user_turn(ctx, kb_context, history_text, incoming_text, budget=max(0, budget - prefix_tokens))
+    metrics.observe("prompt_tokens_estimated", prefix_tokens + estimate_tokens(user_turn), buckets=TOKEN_BUCKETS)
+    return system_prompt, user_turn
+
+
+def prefix_fingerprint(prefix: str) -> str:
+    """Short hash of a prefix, for logs (changes only when org settings or files change)."""
+    return hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:12]
@@ -11,7 +11,8 @@ async def search_knowledge_base(
     organization_id: str,
     query: str,
     limit: int = 3,
-    api_key: Optional[str] = None
+    api_key: Optional[str] = None,
+    query_embedding: Optional[List[float]] = None
 ) -> List[Tuple[KnowledgeResource, float]]:
     """
     Search the knowledge base using vector similarity with full text keyword fallback.
@@ -22,15 +23,28 @@ async def search_knowledge_base(
         query: Search query
         limit: Number of results to return
         api_key: Optional AI API key for generating embedding
+        query_embedding: Precomputed query embedding (skips the embedding call)
         
     Returns:
         List of (KnowledgeResource, similarity_score) tuples
     """
+    # 1. Generate embedding for query
+    if query_embedding is None:
+        query_embedding = await generate_embedding(query, api_key=api_key)
+    return search_knowledge_base_sync(db, organization_id, query, limit, query_embedding)
+
+
+def search_knowledge_base_sync(
+    db: Session,
+    organization_id: str,
+    query: str,
+    limit: int = 3,
+    query_embedding: Optional[List[float]] = None
+) -> List[Tuple[KnowledgeResource, float]]:
+    """DB part of search_knowledge_base, for callers that already have the query embedding (runs in a worker thread)."""
     resources = []
     seen_ids = set()
 
-    # 1. Generate embedding for query
-    query_embedding = await generate_embedding(query, api_key=api_key)
     if query_embedding:
         try:
             sql = text("""
@@ -60,6 +74,7 @@ async def search_knowledge_base(
                         seen_ids.add(resource_id)
         except Exception as vec_err:
             print(f"Vector search failed, falling back to keyword search: {vec_err}")
+            db.rollback()
 
     # 2. Text/Keyword fallback search if vector search returned no results
     if not resources and query:
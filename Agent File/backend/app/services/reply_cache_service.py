@@ -0,0 +1,220 @@
+"""
+Reply Cache Service
+Opt-in per-org semantic cache of non-personalized agent replies.
+
+Many inbound messages are the same handful of questions (service times, location,
+how to pay). When an org turns the cache on, the agent asks the model to flag
+replies that would be right for any contact ("generic"); those are stored with the
+embedding of the question that produced them. The next message whose embedding is
+within the org's similarity threshold gets the stored reply and action without the
+KB search or an LLM call.
+
+An entry is only served while both of these still match what it was answered with:
+- organizations.knowledge_version, bumped on every knowledge base edit
+- the fingerprint of the org's static prompt prefix (persona, tone, payment link, files)
+Settings and KB edits also delete the org's entries outright; the version and
+fingerprint checks cover replies that were in flight during the edit.
+"""
+
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from uuid import uuid4
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.services.prompt_builder import build_static_prefix, prefix_fingerprint
+from app.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from app.services.agent_service import AgentContext
+
+logger = logging.getLogger(__name__)
+
+# Dimension of the Gemini embeddings stored in reply_cache.embedding
+EMBEDDING_DIMENSIONS = 768
+
+# Actions with no per-contact side effects (bookings and escalations are never cached)
+CACHEABLE_ACTIONS = {"NONE", "SEND_DOCUMENT", "SEND_IMAGE", "SEND_PAYMENT_LINK"}
+
+
+@dataclass(frozen=True)
+class CachedReply:
+    entry_id: str
+    reply: str
+    action: Dict[str, Any]
+    similarity: float
+
+
+def should_lookup(ctx: "AgentContext", incoming_text: str, query_embedding: List[float]) -> bool:
+    """Cache applies to short standalone questions from orgs that opted in (never mid-flow)."""
+    return bool(
+        ctx.reply_cache_enabled
+        and ctx.session_id is None
+        and incoming_text
+        and len(incoming_text) <= settings.reply_cache_max_question_chars
+        and query_embedding
+        and len(query_embedding) == EMBEDDING_DIMENSIONS
+    )
+
+
+def is_cacheable(ctx: "AgentContext", parsed: Dict[str, Any]) -> bool:
+    """A fresh reply may be stored if the model marked it generic and it carries nothing contact-specific."""
+    action = parsed.get("action") or {}
+    if not parsed.get("generic") or action.get("type", "NONE") not in CACHEABLE_ACTIONS:
+        return False
+    first_name = (ctx.contact_name or "").split(" ")[0].strip()
+    if len(first_name) >= 3 and first_name.lower() in (parsed.get("reply") or "").lower():
+        return False
+    return True
+
+
+def _threshold(ctx: "AgentContext") -> float:
+    return ctx.reply_cache_threshold or settings.reply_cache_similarity_threshold
+
+
+def lookup_cached_reply(db: Session, ctx: "AgentContext", query_embedding: List[float]) -> Optional[CachedReply]:
+    """DB phase: nearest cached reply for the current KB version and prompt prefix, if similar enough."""
+    started = time.monotonic()
+    try:
+        row = db.execute(
+            text("""
+                SELECT id, reply, action, 1 - (embedding <=> :embedding) AS similarity
+                FROM reply_cache
+                WHERE organization_id = :org_id
+                  AND knowledge_version = :knowledge_version
+                  AND prefix_fingerprint = :fingerprint
+                  AND created_at > NOW() - make_interval(hours => :ttl_hours)
+                ORDER BY embedding <=> :embedding
+                LIMIT 1
+            """),
+            {
+                "embedding": str(query_embedding),
+                "org_id": str(ctx.org_id),
+                "knowledge_version": ctx.knowledge_version,
+                "fingerprint": prefix_fingerprint(build_static_prefix(ctx)),
+                "ttl_hours": settings.reply_cache_ttl_hours,
+            }
+        ).fetchone()
+
+        if not row or row[3] is None or row[3] < _threshold(ctx):
+            metrics.incr("reply_cache", result="miss")
+            return None
+
+        db.execute(
+            text("UPDATE reply_cache SET hits = hits + 1, last_hit_at = NOW() WHERE id = :id"),
+            {"id": str(row[0])}
+        )
+        db.commit()
+        try:
+            action = json.loads(row[2] or "{}")
+        except ValueError:
+            action = {"type": "NONE"}
+        metrics.incr("reply_cache", result="hit")
+        metrics.incr("llm_calls_avoided", reason="reply_cache")
+        metrics.observe("reply_cache_similarity", float(row[3]))
+        return CachedReply(entry_id=str(row[0]), reply=row[1], action=action, similarity=float(row[3]))
+    except Exception as e:
+        logger.warning(f"Reply cache lookup failed: {e}")
+        db.rollback()
+        metrics.incr("reply_cache", result="error")
+        return None
+    finally:
+        metrics.observe("reply_cache_lookup_seconds", time.monotonic() - started)
+        # Hand the pooled connection back (no-op after a commit or rollback)
+        db.commit()
+
+
+def store_cached_reply(
+    db: Session,
+    ctx: "AgentContext",
+    question: str,
+    query_embedding: List[float],
+    reply: str,
+    action: Dict[str, Any]
+):
+    """DB phase: remember a generic reply, then trim the org's cache to its size and age limits."""
+    try:
+        db.execute(
+            text("""
+                INSERT INTO reply_cache (id, organization_id, knowledge_version, prefix_fingerprint, question, embedding, reply, action, hits)
+                VALUES (:id, :org_id, :knowledge_version, :fingerprint, :question, :embedding, :reply, :action, 0)
+            """),
+            {
+                "id": str(uuid4()),
+                "org_id": str(ctx.org_id),
+                "knowledge_version": ctx.knowledge_version,
+                "fingerprint": prefix_fingerprint(build_static_prefix(ctx)),
+                "question": question,
+                "embedding": str(query_embedding),
+                "reply": reply,
+                "action": json.dumps(action or {"type": "NONE"}),
+            }
+        )
+        db.execute(
+            text("""
+                DELETE FROM reply_cache
+                WHERE organization_id = :org_id
+                  AND (created_at <= NOW() - make_interval(hours => :ttl_hours)
+                       OR id NOT IN (
+                           SELECT id FROM reply_cache
+                           WHERE organization_id = :org_id
+                           ORDER BY COALESCE(last_hit_at, created_at) DESC
+                           LIMIT :max_entries
+                       ))
+            """),
+            {
+                "org_id": str(ctx.org_id),
+                "ttl_hours": settings.reply_cache_ttl_hours,
+                "max_entries": settings.reply_cache_max_entries_per_org,
+            }
+        )
+        db.commit()
+        metrics.incr("reply_cache_stored")
+    except Exception as e:
+        logger.warning(f"Reply cache store failed: {e}")
+        db.rollback()
+
+
+def clear_reply_cache(db: Session, org_id):
+    """Drop every cached reply for the org. Runs in the caller's transaction; the caller commits."""
+    db.execute(text("DELETE FROM reply_cache WHERE organization_id = :org_id"), {"org_id": str(org_id)})
+
+
+def bump_knowledge_version(db: Session, org_id):
+    """
+    Mark the org's knowledge base as changed: cached replies answered against the
+    old version are dropped and can no longer be served. The caller commits, then
+    calls invalidate_org_config so every worker picks up the new version.
+    """
+    db.execute(
+        text("UPDATE organizations SET knowledge_version = COALESCE(knowledge_version, 0) + 1 WHERE id = :org_id"),
+        {"org_id": str(org_id)}
+    )
+    clear_reply_cache(db, org_id)
+
+
+def get_reply_cache_stats() -> Dict[str, Any]:
+    """Hit rate for this worker since startup, for /api/metrics."""
+    hits = metrics.get_counter("reply_cache", result="hit")
+    misses = metrics.get_counter("reply_cache", result="miss")
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / lookups, 3) if lookups else None,
+        "stored": metrics.get_counter("reply_cache_stored"),
+    }
+
+
+def get_org_reply_cache_summary(db: Session, org_id) -> Dict[str, Any]:
+    """Entry count and lifetime hits for one org's cache (shown with its AI settings)."""
+    row = db.execute(
+        text("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM reply_cache WHERE organization_id = :org_id"),
+        {"org_id": str(org_id)}
+    ).fetchone()
+    return {"entries": row[0] if row else 0, "hits": int(row[1]) if row else 0}
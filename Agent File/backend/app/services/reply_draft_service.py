@@ -0,0 +1,131 @@
+"""
+Reply Draft Service
+Precomputed suggestions for orgs in "suggest" reply mode that turned on reply
+drafts (organizations.ai_reply_drafts_enabled, off by default; other orgs keep
+auto-sending).
+
+With drafts on the agent never sends: an operator reviews every reply in Live
+Chats. Instead of generating a suggestion when the operator opens the chat, the
+webhook marks the contact's draft pending and queues a 'draft' job (in the same
+transaction that saves the message). The worker composes the reply and proposed
+action exactly as an auto-reply would, then stores them here.
+
+A draft answers one inbound message (based_on_message_id). A newer inbound message
+resets it to pending, a job that finishes after that is discarded, and a draft is
+only served while its message is still the latest in the conversation, so a chat
+the operator has already answered shows no stale suggestion.
+"""
+
+import json
+import logging
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def mark_draft_pending(db: Session, org_id: UUID, contact_id: UUID, message_id: UUID):
+    """Invalidate the contact's draft for a new inbound message. Runs in the caller's transaction."""
+    db.execute(
+        text("""
+            INSERT INTO reply_drafts (contact_id, organization_id, status, based_on_message_id, updated_at)
+            VALUES (:contact_id, :org_id, 'pending', :message_id, NOW())
+            ON CONFLICT (contact_id) DO UPDATE
+            SET status = 'pending', based_on_message_id = EXCLUDED.based_on_message_id,
+                reply = NULL, action = NULL, source = NULL, updated_at = NOW()
+        """),
+        {"contact_id": str(contact_id), "org_id": str(org_id), "message_id": str(message_id)}
+    )
+
+
+def save_reply_draft(db: Session, contact_id: UUID, message_id: Optional[str], draft: Optional[Dict[str, Any]]) -> bool:
+    """
+    Store the finished draft for message_id (None = nothing to suggest, e.g. a silenced
+    greeting). Returns False when a newer message has superseded it.
+    """
+    if not draft:
+        stored = discard_reply_draft(db, contact_id, message_id)
+    else:
+        try:
+            stored = db.execute(
+                text("""
+                    UPDATE reply_drafts
+                    SET status = 'ready', reply = :reply, action = :action, source = :source, updated_at = NOW()
+                    WHERE contact_id = :contact_id AND based_on_message_id = CAST(:message_id AS UUID)
+                """),
+                {
+                    "contact_id": str(contact_id),
+                    "message_id": message_id,
+                    "reply": draft["reply"],
+                    "action": json.dumps(draft.get("action") or {"type": "NONE"}),
+                    "source": draft.get("source"),
+                }
+            ).rowcount > 0
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    if not stored:
+        metrics.incr("reply_drafts", result="superseded")
+        logger.info(f"📝 Draft for contact {contact_id} superseded by a newer message; discarded")
+        return False
+    metrics.incr("reply_drafts", result="ready" if draft else "empty")
+    return True
+
+
+def discard_reply_draft(db: Session, contact_id: UUID, message_id: Optional[str]) -> bool:
+    """Drop the pending draft for message_id (no suggestion, or the draft job gave up)."""
+    try:
+        deleted = db.execute(
+            text("DELETE FROM reply_drafts WHERE contact_id = :contact_id AND based_on_message_id = CAST(:message_id AS UUID)"),
+            {"contact_id": str(contact_id), "message_id": message_id}
+        ).rowcount > 0
+        db.commit()
+        return deleted
+    except Exception:
+        db.rollback()
+        raise
+
+
+def get_reply_draft(db: Session, org_id: UUID, contact_id: UUID) -> Dict[str, Any]:
+    """
+    The contact's current suggestion: status "ready" (with reply and action), "pending"
+    while the worker drafts it, or "none". One indexed query.
+    """
+    row = db.execute(
+        text("""
+            SELECT d.status, d.reply, d.action, d.source, d.based_on_message_id, d.updated_at,
+                   (SELECT m.id FROM messages m WHERE m.contact_id = d.contact_id
+                    ORDER BY m.created_at DESC LIMIT 1) AS latest_message_id
+            FROM reply_drafts d
+            WHERE d.contact_id = :contact_id AND d.organization_id = :org_id
+        """),
+        {"contact_id": str(contact_id), "org_id": str(org_id)}
+    ).fetchone()
+
+    if not row or row[4] is None or row[4] != row[6]:
+        metrics.incr("reply_draft_fetch", status="none")
+        return {"status": "none"}
+    if row[0] != "ready":
+        metrics.incr("reply_draft_fetch", status="pending")
+        return {"status": "pending", "message_id": str(row[4])}
+
+    try:
+        action = json.loads(row[2] or "{}")
+    except ValueError:
+        action = {"type": "NONE"}
+    metrics.incr("reply_draft_fetch", status="ready")
+    return {
+        "status": "ready",
+        "reply": row[1],
+        "action": action,
+        "source": row[3],
+        "message_id": str(row[4]),
+        "generated_at": row[5].isoformat() if row[5] else None,
+    }
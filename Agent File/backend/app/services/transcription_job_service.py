@@ -0,0 +1,373 @@
+"""
+Transcription Job Service
+Long voice notes are transcribed through the transcription service's job API
+instead of inside the reply job.
+
+A synchronous POST /transcribe keeps the reply job, an HTTP connection and a
+worker slot busy for the whole inference, and long notes (sermons, testimonies)
+outlast the client timeout. With transcribe_async_enabled, a queued reply whose
+mailbox holds a single voice note of at least transcribe_async_min_bytes parks
+instead:
+
+1. a 'transcription' agent job holding the mailbox is queued, runnable only
+   after transcribe_poll_interval_seconds
+2. the audio is submitted to POST /jobs with that agent job's id as metadata and
+   transcribe_callback_url as the callback; the reply job ends without replying
+3. messages the contact sends meanwhile are added to the parked mailbox (not
+   answered on their own ahead of the voice note)
+4. the service's signed callback attaches the result to the agent job and makes
+   it runnable at once (without a callback the job polls GET /jobs/{id})
+5. the job stores the transcript on the message and puts the mailbox back on the
+   contact's reply queue, where the reply runs with the transcript in place
+
+If the service loses the job (restart, TTL) or it misses transcribe_async_timeout_seconds,
+the mailbox is re-queued for an inline transcription, so the contact is answered either way.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+import httpx
+from sqlalchemy import text, func
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import SessionLocal
+from app.services.http_client_service import get_http_client, http_clients
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SERVICE_URL = "https://shepherdai.duckdns.org"
+DEFAULT_SERVICE_KEY = "17f187c37b8164bc2f038779fa9ebe886ef771e3f721793e584bd816bf1a8ac5"
+TRANSCRIPTION_FAILED = "[Voice message — transcription failed]"
+
+# Language codes Whisper accepts as a hint (the tokenizer's LANGUAGES); anything else is a 400 from /transcribe
+WHISPER_LANGUAGES = frozenset((
+    "af am ar as az ba be bg bn bo br bs ca cs cy da de el en es et eu fa fi fo fr gl gu ha haw he hi "
+    "hr ht hu hy id is it ja jw ka kk km kn ko la lb ln lo lt lv mg mi mk ml mn mr ms mt my ne nl nn no "
+    "oc pa pl ps pt ro ru sa sd si sk sl sn so sq sr su sv sw ta te tg th tk tl tr tt uk ur uz vi yi yo "
+    "yue zh"
+).split())
+
+
+class TranscriptionDeferred(Exception):
+    """The reply's voice note went to the job API; the reply resumes from a 'transcription' job."""
+
+
+def transcribe_service_config() -> Tuple[str, str]:
+    """(base URL, API key) of the self-hosted transcription service."""
+    base_url = (os.getenv("TRANSCRIBE_SERVICE_URL", "").strip() or DEFAULT_SERVICE_URL).rstrip("/")
+    if base_url.endswith("/transcribe"):
+        base_url = base_url[:-len("/transcribe")]
+    api_key = os.getenv("TRANSCRIBE_SERVICE_KEY", "").strip() or DEFAULT_SERVICE_KEY
+    http_clients.register_upstream(base_url)
+    return base_url, api_key
+
+
+def should_defer(audio_size: int) -> bool:
+    return settings.transcribe_async_enabled and audio_size >= settings.transcribe_async_min_bytes
+
+
+def sign_callback(body: bytes) -> str:
+    return "sha256=" + hmac.new(transcribe_service_config()[1].encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def verify_callback_signature(body: bytes, signature: Optional[str]) -> bool:
+    """X-Transcribe-Signature is sha256=HMAC(service key, raw body)."""
+    return bool(signature) and hmac.compare_digest(signature, sign_callback(body))
+
+
+async def submit_transcription_job(
+    audio_bytes: bytes,
+    mime_type: str,
+    metadata: Dict[str, Any],
+    language: Optional[str] = None
+) -> Optional[str]:
+    """POST the audio to the service's job API. Returns the service job id, or None if it was not accepted."""
+    base_url, api_key = transcribe_service_config()
+    data = {"metadata": json.dumps(metadata)}
+    if language:
+        data["language"] = language
+    if settings.transcribe_callback_url:
+        data["callback_url"] = settings.transcribe_callback_url
+    try:
+        resp = await get_http_client(base_url).post(
+            f"{base_url}/jobs",
+            files={"file": ("voice.ogg", audio_bytes, mime_type or "audio/ogg")},
+            data=data,
+            headers={"X-Api-Key": api_key},
+            timeout=15.0
+        )
+    except httpx.HTTPError as e:
+        logger.warning(f"🎙️ Transcription job submit failed: {e}")
+        return None
+    if resp.status_code != 202:
+        logger.warning(f"🎙️ Transcription job submit rejected: HTTP {resp.status_code}: {resp.text[:200]}")
+        return None
+    return resp.json().get("job_id")
+
+
+async def fetch_transcription_job(service_job_id: str) -> Optional[Dict[str, Any]]:
+    """Poll one service job. None when the service no longer knows it (expired or restarted)."""
+    base_url, api_key = transcribe_service_config()
+    resp = await get_http_client(base_url).get(
+        f"{base_url}/jobs/{service_job_id}", headers={"X-Api-Key": api_key}, timeout=10.0
+    )
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()
+
+
+def _job_result(job: Dict[str, Any]) -> Dict[str, Any]:
+    """The part of a service job (poll response or callback body) the resume needs."""
+    return {
+        "status": job.get("status"),
+        "text": ((job.get("result") or {}).get("text") or "").strip(),
+        "error": job.get("error"),
+    }
+
+
+async def defer_transcription(
+    org_id: UUID,
+    contact_id: UUID,
+    messages: List[Dict[str, Any]],
+    audio_media_id: str,
+    audio_bytes: bytes,
+    mime_type: str,
+    language: Optional[str] = None
+) -> bool:
+    """
+    Park the mailbox on a 'transcription' agent job and submit the audio. The agent job
+    is committed first so a fast callback always finds it. False = transcribe inline.
+    """
+    agent_job_id = str(uuid4())
+    payload = {"messages": messages, "audio_media_id": audio_media_id, "submitted_at": time.time()}
+    try:
+        await asyncio.to_thread(_queue_transcription_job, org_id, contact_id, agent_job_id, payload)
+    except Exception as e:
+        logger.warning(f"🎙️ Could not park reply for contact {contact_id}, transcribing inline: {e}")
+        return False
+    service_job_id = await submit_transcription_job(audio_bytes, mime_type, {"agent_job_id": agent_job_id}, language)
+    if not service_job_id:
+        await asyncio.to_thread(_drop_transcription_job, contact_id, agent_job_id, len(messages))
+        metrics.incr("transcription_jobs", result="submit_failed")
+        return False
+    await asyncio.to_thread(_with_session, update_transcription_job, agent_job_id, {"service_job_id": service_job_id})
+    metrics.incr("transcription_jobs", result="submitted")
+    logger.info(f"🎙️ Voice note {audio_media_id} ({len(audio_bytes)} bytes) sent to transcription job {service_job_id}; reply parked")
+    return True
+
+
+def _queue_transcription_job(org_id: UUID, contact_id: UUID, agent_job_id: str, payload: Dict[str, Any]):
+    from app.models.agent_job import AgentJob
+    from app.services.agent_queue_service import enqueue_agent_job, lock_mailbox
+    db = SessionLocal()
+    try:
+        # Messages queued while this reply ran join the parked mailbox (the lock keeps
+        # new ones out until the job is visible; enqueue_inbound_message adds those)
+        lock_mailbox(db, contact_id, "reply")
+        newer = db.query(AgentJob).filter(
+            AgentJob.contact_id == contact_id,
+            AgentJob.job_type == "reply",
+            AgentJob.status == "queued"
+        ).with_for_update().all()
+        for reply_job in sorted(newer, key=lambda j: j.created_at):
+            payload["messages"] = list(payload["messages"]) + (json.loads(reply_job.payload or "{}").get("messages") or [])
+            db.delete(reply_job)
+        job = enqueue_agent_job(
+            db, org_id, contact_id, payload,
+            job_type="transcription",
+            run_after=func.now() + timedelta(seconds=settings.transcribe_poll_interval_seconds)
+        )
+        job.id = UUID(agent_job_id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _drop_transcription_job(contact_id: UUID, agent_job_id: str, parked_count: int):
+    """Undo a park whose submit failed. Messages that joined the mailbox meanwhile go back on the reply queue."""
+    from app.services.agent_queue_service import lock_mailbox, requeue_mailbox
+    db = SessionLocal()
+    try:
+        lock_mailbox(db, contact_id, "reply")
+        row = db.execute(
+            text("""
+                DELETE FROM agent_jobs WHERE id = CAST(:id AS UUID) AND status = 'queued'
+                RETURNING organization_id, payload
+            """),
+            {"id": agent_job_id}
+        ).fetchone()
+        newer = (json.loads(row[1] or "{}").get("messages") or [])[parked_count:] if row else []
+        if newer:
+            requeue_mailbox(db, row[0], contact_id, newer)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _with_session(fn, *args):
+    db = SessionLocal()
+    try:
+        return fn(db, *args)
+    finally:
+        db.close()
+
+
+def update_transcription_job(db: Session, agent_job_id: str, updates: Dict[str, Any], wake: bool = False) -> bool:
+    """
+    Merge updates into a queued 'transcription' job's payload (and make it runnable now
+    with wake). False when the job is unknown, already running or finished.
+    """
+    try:
+        UUID(str(agent_job_id))
+    except ValueError:
+        return False
+    try:
+        row = db.execute(
+            text("""
+                SELECT payload FROM agent_jobs
+                WHERE id = CAST(:id AS UUID) AND job_type = 'transcription' AND status = 'queued'
+                FOR UPDATE
+            """),
+            {"id": agent_job_id}
+        ).fetchone()
+        if not row:
+            db.rollback()
+            return False
+        payload = json.loads(row[0] or "{}")
+        payload.update(updates)
+        db.execute(
+            text(f"""
+                UPDATE agent_jobs SET payload = :payload{", run_after = NOW()" if wake else ""}
+                WHERE id = CAST(:id AS UUID)
+            """),
+            {"id": agent_job_id, "payload": json.dumps(payload)}
+        )
+        db.commit()
+        return True
+    except Exception:
+        db.rollback()
+        raise
+
+
+def record_transcription_callback(db: Session, body: Dict[str, Any]) -> bool:
+    """Attach a callback's result to its parked agent job and wake it. False = nothing waiting for it."""
+    agent_job_id = (body.get("metadata") or {}).get("agent_job_id")
+    if not agent_job_id:
+        return False
+    updates = {"result": _job_result(body)}
+    if body.get("job_id"):
+        updates["service_job_id"] = body["job_id"]
+    attached = update_transcription_job(db, agent_job_id, updates, wake=True)
+    metrics.incr("transcription_callbacks", result="attached" if attached else "ignored")
+    return attached
+
+
+def _overdue(payload: Dict[str, Any]) -> bool:
+    return time.time() - float(payload.get("submitted_at") or 0) > settings.transcribe_async_timeout_seconds
+
+
+async def resolve_transcription(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    The service's result for a parked mailbox ({"status": "done"|"failed", "text", "error"}),
+    or None when it is lost or overdue (transcribe inline instead). Raises RetryLater while
+    the service is still working on it or cannot be reached.
+    """
+    from app.services.agent_queue_service import RetryLater
+    if payload.get("result"):
+        metrics.incr("transcription_jobs", result="callback")
+        return payload["result"]
+    service_job_id = payload.get("service_job_id")
+    if not service_job_id:
+        metrics.incr("transcription_jobs", result="lost")
+        return None
+    try:
+        job = await fetch_transcription_job(service_job_id)
+    except httpx.HTTPError as e:
+        if _overdue(payload):
+            metrics.incr("transcription_jobs", result="timeout")
+            return None
+        logger.warning(f"🎙️ Polling transcription job {service_job_id} failed, retrying: {e}")
+        metrics.incr("transcription_jobs", result="poll_error")
+        raise RetryLater(settings.transcribe_poll_interval_seconds)
+    if job is None:
+        metrics.incr("transcription_jobs", result="lost")
+        return None
+    if job.get("status") in ("done", "failed"):
+        metrics.incr("transcription_jobs", result="polled")
+        return _job_result(job)
+    if _overdue(payload):
+        metrics.incr("transcription_jobs", result="timeout")
+        return None
+    raise RetryLater(settings.transcribe_poll_interval_seconds)
+
+
+def apply_transcription_result(
+    messages: List[Dict[str, Any]],
+    audio_media_id: Optional[str],
+    result: Optional[Dict[str, Any]]
+) -> Tuple[List[Dict[str, Any]], Optional[Tuple[Optional[str], str]]]:
+    """
+    Fill the parked voice note's entry from the result. Returns the mailbox and the
+    (message_id, transcript) to persist, if any. No result = transcribe it inline.
+    """
+    from app.services.agent_service import VOICE_PLACEHOLDERS
+    transcript = None
+    mailbox = [dict(entry) for entry in messages]
+    for entry in mailbox:
+        if entry.get("audio_media_id") != audio_media_id or (entry.get("content") or "") not in VOICE_PLACEHOLDERS:
+            continue
+        text_out = (result or {}).get("text") or ""
+        if result is None:
+            entry["transcribe_sync"] = True
+        elif result.get("status") == "done" and len(text_out) > 2:
+            entry["content"] = f"[Voice Note]: {text_out}"
+            transcript = (entry.get("message_id"), text_out)
+        else:
+            entry["content"] = TRANSCRIPTION_FAILED
+    return mailbox, transcript
+
+
+def resume_parked_reply(
+    db: Session,
+    org_id: UUID,
+    contact_id: UUID,
+    payload: Dict[str, Any],
+    result: Optional[Dict[str, Any]]
+):
+    """Store the transcript and put the parked mailbox back on the contact's reply queue."""
+    from app.services.agent_queue_service import requeue_mailbox
+    mailbox, transcript = apply_transcription_result(payload.get("messages") or [], payload.get("audio_media_id"), result)
+    try:
+        if transcript and transcript[0]:
+            db.execute(
+                text("""
+                    UPDATE messages SET content = :content
+                    WHERE id = CAST(:message_id AS UUID) AND content IN ('[Voice message]', '[voice message]')
+                """),
+                {"content": f"🎙️ {transcript[1]}", "message_id": transcript[0]}
+            )
+        requeue_mailbox(db, org_id, contact_id, mailbox)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    outcome = "transcribed" if transcript else ("inline" if result is None else "failed")
+    logger.info(f"🎙️ Parked reply for contact {contact_id} resumed ({outcome})")
@@ -0,0 +1,191 @@
+"""
+TTS Cache Service
+Content-addressed cache of finished voice notes (OGG/Opus bytes).
+
+Many voice replies repeat word for word: greetings and thanks from the fast path,
+booking confirmations, escalation notices, answers served from the reply cache.
+Each note is keyed by sha256(text, voice, codec parameters), so a repeat skips
+edge-tts and ffmpeg entirely and a change to the encoder settings never serves
+stale audio.
+
+Two tiers:
+- memory: per-process LRU bounded by total bytes
+- disk: one directory shared by every worker on the host, bounded by total bytes.
+  Files are written to a temp name and renamed into place, so readers never see a
+  partial note; hits refresh the file's mtime and the oldest files are evicted first.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.config import settings
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bump when the synthesis pipeline changes in a way the key does not capture
+CACHE_VERSION = "1"
+
+
+def tts_cache_key(text: str, voice: str, codec: str) -> str:
+    """Content address of one voice note."""
+    material = "\x00".join((CACHE_VERSION, voice, codec, text))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """Memory LRU in front of a size-capped, host-wide disk directory."""
+
+    def __init__(self):
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        # Bytes this process believes are on disk; reconciled by a directory scan on eviction
+        self._disk_bytes: Optional[int] = None
+
+    @property
+    def directory(self) -> str:
+        return settings.tts_cache_dir or os.path.join(tempfile.gettempdir(), "shepherd-tts-cache")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.ogg")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Cached audio for key, or None. Blocking (disk); call via asyncio.to_thread."""
+        if not settings.tts_cache_enabled:
+            return None
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+        if audio is not None:
+            metrics.incr("tts_cache", tier="memory", result="hit")
+            return audio
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+        except FileNotFoundError:
+            metrics.incr("tts_cache", tier="none", result="miss")
+            return None
+        except OSError as e:
+            logger.warning(f"TTS cache read failed for {key[:12]}: {e}")
+            metrics.incr("tts_cache", tier="none", result="miss")
+            return None
+        if not audio:
+            metrics.incr("tts_cache", tier="none", result="miss")
+            return None
+        try:
+            # Recently used notes are evicted last
+            os.utime(path)
+        except OSError:
+            pass
+        metrics.incr("tts_cache", tier="disk", result="hit")
+        self._remember(key, audio)
+        return audio
+
+    def put(self, key: str, audio: bytes):
+        """Store audio in both tiers. Blocking (disk); call via asyncio.to_thread."""
+        if not settings.tts_cache_enabled or not audio:
+            return
+        self._remember(key, audio)
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(audio)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"TTS cache write failed for {key[:12]}: {e}")
+            return
+        metrics.incr("tts_cache_writes")
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(audio)
+            over = self._disk_bytes is None or self._disk_bytes > settings.tts_cache_disk_mb * 1024 * 1024
+        if over:
+            self.evict_disk()
+
+    def _remember(self, key: str, audio: bytes):
+        limit = settings.tts_cache_memory_mb * 1024 * 1024
+        if len(audio) > limit:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = audio
+            self._memory_bytes += len(audio)
+            while self._memory_bytes > limit:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+            metrics.set_gauge("tts_cache_memory_bytes", self._memory_bytes)
+
+    def evict_disk(self):
+        """Scan the directory and delete least recently used notes down to 90% of the cap."""
+        limit = settings.tts_cache_disk_mb * 1024 * 1024
+        entries = []
+        total = 0
+        now = time.time()
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith(".tmp"):
+                    # Orphaned by a crashed writer
+                    if now - stat.st_mtime > 3600:
+                        self._unlink(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        evicted = 0
+        if total > limit:
+            entries.sort()
+            target = int(limit * 0.9)
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                if self._unlink(path):
+                    total -= size
+                    evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+        metrics.set_gauge("tts_cache_disk_bytes", total)
+        if evicted:
+            metrics.incr("tts_cache_evictions", evicted, tier="disk")
+            logger.info(f"🧹 Evicted {evicted} cached voice notes ({total // 1024} KiB left on disk)")
+
+    @staticmethod
+    def _unlink(path: str) -> bool:
+        try:
+            os.unlink(path)
+            return True
+        except OSError:
+            return False
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+
+# Singleton instance
+tts_cache = TTSCache()
@@ -0,0 +1,521 @@
+"""
+Voice Pipeline
+Sentence-streamed voice notes: LLM text -> edge-tts per sentence -> ffmpeg (Opus).
+
+For voice replies the agent's LLM call streams its JSON. VoiceNoteStream pulls the
+"reply" string out of the partial JSON as it arrives, cuts it at sentence
+boundaries and starts edge-tts for each sentence straight away (a couple of
+sentences ahead of the encoder). MP3 chunks are written to one long-running ffmpeg
+process over stdin and the OGG/Opus note is read back from stdout, so synthesis and
+transcoding overlap generation and only the last sentence is left when the LLM
+finishes.
+
+The audio is only used if the text it was made from is exactly the reply the agent
+ends up sending; otherwise (plain-text or fallback response, stream cut off) the
+final text is synthesized through the same pipeline in one go.
+
+Finished notes are stored in the content-addressed TTS cache (tts_cache_service);
+a reply whose note is already cached is served from there without TTS or ffmpeg.
+
+Encoders come from a per-loop EncoderPool: a bounded number run at once and a
+spare ffmpeg is kept spawned, so process start-up is off the critical path. With
+VOICE_TTS_NATIVE_OPUS and an edge-tts that can request OGG/Opus output, complete
+texts skip ffmpeg altogether.
+"""
+
+import asyncio
+import inspect
+import json
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.services.tts_cache_service import tts_cache, tts_cache_key
+from app.utils.metrics import metrics
+from app.utils.tracing import stage_span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VOICE = "en-NG-EzinneNeural"
+
+# MP3 (edge-tts) in on stdin, OGG/Opus out on stdout: the WhatsApp voice note format
+FFMPEG_OPUS_ARGS = (
+    "-hide_banner", "-loglevel", "error",
+    "-f", "mp3", "-i", "pipe:0",
+    "-c:a", "libopus", "-b:a", "64k", "-vbr", "on",
+    "-f", "ogg", "pipe:1",
+)
+FFMPEG_CODEC = " ".join(FFMPEG_OPUS_ARGS)
+
+# edge-tts output format for notes that need no transcode
+EDGE_OPUS_FORMAT = "ogg-24khz-16bit-mono-opus"
+EDGE_OPUS_CODEC = f"edge-tts {EDGE_OPUS_FORMAT}"
+
+_REPLY_KEY = re.compile(r'"reply"\s*:\s*"')
+# Odd run of backslashes (optionally a partial \uXXXX) at the end: escape not complete yet
+_TRAILING_ESCAPE = re.compile(r"(\\+)(u[0-9a-fA-F]{0,3})?$")
+_TRAILING_HIGH_SURROGATE = re.compile(r"\\u[dD][89abAB][0-9a-fA-F]{2}$")
+
+_SENTENCE_END = re.compile(r"[.!?…]+[\"'”’)\]]*\s+|\s*\n\s*")
+_ABBREVIATIONS = {
+    "mr", "mrs", "ms", "dr", "st", "rev", "pst", "prof", "sr", "jr",
+    "vs", "etc", "no", "e.g", "i.e", "a.m", "p.m",
+}
+
+
+def voice_note_key(text: str, voice: str, native_opus: bool = False) -> str:
+    """TTS cache key: the text, the voice and the encoder settings that produced the note."""
+    return tts_cache_key(text, voice, EDGE_OPUS_CODEC if native_opus else FFMPEG_CODEC)
+
+
+async def cached_voice_note(text: str, voice: str, native_opus: bool = False) -> Optional[bytes]:
+    with stage_span("tts_cache") as span:
+        audio = await asyncio.to_thread(tts_cache.get, voice_note_key(text, voice, native_opus))
+        span.set(hit=audio is not None)
+    return audio
+
+
+async def store_voice_note(text: str, voice: str, audio: bytes, native_opus: bool = False):
+    # Only real OGG/Opus notes; an ffmpeg failure falls back to MP3, which is not cached
+    if audio.startswith(b"OggS"):
+        await asyncio.to_thread(tts_cache.put, voice_note_key(text, voice, native_opus), audio)
+
+
+@lru_cache(maxsize=1)
+def ffmpeg_exe() -> str:
+    """Path of the imageio-ffmpeg bundled binary (resolved once per process)."""
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+@lru_cache(maxsize=1)
+def _edge_tts_opus_supported() -> bool:
+    import edge_tts
+    supported = "output_format" in inspect.signature(edge_tts.Communicate).parameters
+    if not supported:
+        logger.warning("VOICE_TTS_NATIVE_OPUS is set but this edge-tts only produces MP3; transcoding with ffmpeg")
+    return supported
+
+
+def native_opus_enabled() -> bool:
+    """Ask edge-tts for OGG/Opus directly (complete texts only; see synthesize_text)."""
+    return settings.voice_tts_native_opus and _edge_tts_opus_supported()
+
+
+class EncoderPool:
+    """
+    Bounded ffmpeg MP3 -> OGG/Opus encoders for one event loop.
+    At most voice_encoder_pool_size notes are encoded at once (libopus is CPU-bound).
+    voice_encoder_spares processes are kept spawned and waiting on stdin; each one
+    encodes a single note (one OGG stream per ffmpeg run) and a replacement is
+    spawned in the background.
+    """
+
+    def __init__(self):
+        self._slots = asyncio.Semaphore(max(1, settings.voice_encoder_pool_size))
+        self._spares: List[asyncio.subprocess.Process] = []
+        self._refill: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @staticmethod
+    async def _spawn() -> asyncio.subprocess.Process:
+        return await asyncio.create_subprocess_exec(
+            ffmpeg_exe(), *FFMPEG_OPUS_ARGS,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+    def _take_spare(self) -> Optional[asyncio.subprocess.Process]:
+        while self._spares:
+            proc = self._spares.pop()
+            if proc.returncode is None:
+                return proc
+        return None
+
+    def _top_up(self):
+        if self._closed or settings.voice_encoder_spares <= 0:
+            return
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.create_task(self._fill())
+
+    async def _fill(self):
+        try:
+            while not self._closed and len(self._spares) < settings.voice_encoder_spares:
+                self._spares.append(await self._spawn())
+        except Exception as e:
+            logger.warning(f"Could not pre-spawn an ffmpeg encoder: {e}")
+
+    @asynccontextmanager
+    async def encoder(self) -> AsyncIterator[asyncio.subprocess.Process]:
+        """An ffmpeg process for one note; killed on exit if the caller did not finish it."""
+        started = time.monotonic()
+        async with self._slots:
+            metrics.observe("voice_encoder_wait_seconds", time.monotonic() - started)
+            proc = self._take_spare()
+            metrics.incr("voice_encoders", source="spare" if proc else "spawned")
+            if proc is None:
+                proc = await self._spawn()
+            self._top_up()
+            try:
+                yield proc
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+
+    async def close(self):
+        self._closed = True
+        if self._refill is not None:
+            self._refill.cancel()
+            await asyncio.gather(self._refill, return_exceptions=True)
+        spares, self._spares = self._spares, []
+        for proc in spares:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+
+_encoder_pools: Dict[int, EncoderPool] = {}
+
+
+def get_encoder_pool() -> EncoderPool:
+    """The encoder pool of the running event loop."""
+    loop_id = id(asyncio.get_running_loop())
+    pool = _encoder_pools.get(loop_id)
+    if pool is None:
+        pool = _encoder_pools[loop_id] = EncoderPool()
+    return pool
+
+
+async def close_encoder_pool():
+    """Kill spare encoders (app shutdown)."""
+    pool = _encoder_pools.pop(id(asyncio.get_running_loop()), None)
+    if pool is not None:
+        await pool.close()
+
+
+def clean_for_speech(text: str) -> str:
+    """Drop emoji, markdown marks and [bracketed] notes so TTS does not read them out."""
+    from app.services.agent_service import strip_emojis
+    clean = re.sub(r"[\*\_~`#]", "", strip_emojis(text))
+    return re.sub(r"\[.*?\]", "", clean).strip()
+
+
+class ReplyFieldDecoder:
+    """Incrementally decodes the "reply" string of a streamed agent JSON response."""
+
+    def __init__(self):
+        self.complete = False
+        self.failed = False
+        self._seek: Optional[str] = ""
+        self._raw = ""
+        self._scan = 0
+        self._decoded_upto = 0
+
+    def feed(self, delta: str) -> str:
+        """Newly available reply text for this chunk of raw model output."""
+        if self.complete or self.failed or not delta:
+            return ""
+        if self._seek is not None:
+            self._seek += delta
+            match = _REPLY_KEY.search(self._seek)
+            if not match:
+                # Keep a tail in case the key is split across chunks
+                self._seek = self._seek[-16:]
+                return ""
+            delta = self._seek[match.end():]
+            self._seek = None
+
+        self._raw += delta
+        end = None
+        i = self._scan
+        while i < len(self._raw):
+            char = self._raw[i]
+            if char == "\\":
+                i += 2
+                continue
+            if char == '"':
+                end = i
+                break
+            i += 1
+        self._scan = i
+
+        safe = self._raw[:end] if end is not None else self._raw
+        if end is None:
+            escape = _TRAILING_ESCAPE.search(safe)
+            if escape and len(escape.group(1)) % 2 == 1:
+                safe = safe[:escape.start() + len(escape.group(1)) - 1]
+            if _TRAILING_HIGH_SURROGATE.search(safe):
+                safe = safe[:-6]
+        else:
+            self.complete = True
+
+        segment = safe[self._decoded_upto:]
+        if not segment:
+            return ""
+        try:
+            text = json.loads(f'"{segment}"', strict=False)
+        except ValueError:
+            self.failed = True
+            return ""
+        self._decoded_upto = len(safe)
+        return text
+
+
+class SentenceSplitter:
+    """Cuts streamed text into sentences worth one TTS request each."""
+
+    def __init__(self, min_chars: Optional[int] = None, max_chars: Optional[int] = None):
+        self.min_chars = settings.voice_min_sentence_chars if min_chars is None else min_chars
+        self.max_chars = settings.voice_max_sentence_chars if max_chars is None else max_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            if not self._is_boundary(self._buffer[:match.start()], match.group(0)):
+                continue
+            candidate = self._buffer[start:match.end()].strip()
+            if len(candidate) >= self.min_chars:
+                sentences.append(candidate)
+                start = match.end()
+        self._buffer = self._buffer[start:]
+
+        while len(self._buffer) > self.max_chars:
+            cut = self._buffer.rfind(", ", 0, self.max_chars)
+            cut = cut + 1 if cut > 0 else self._buffer.rfind(" ", 0, self.max_chars)
+            if cut <= 0:
+                cut = self.max_chars
+            sentences.append(self._buffer[:cut].strip())
+            self._buffer = self._buffer[cut:]
+        return [s for s in sentences if s]
+
+    def flush(self) -> List[str]:
+        rest, self._buffer = self._buffer.strip(), ""
+        return [rest] if rest else []
+
+    @staticmethod
+    def _is_boundary(before: str, mark: str) -> bool:
+        if not mark.lstrip().startswith("."):
+            return True
+        word = before.rsplit(None, 1)[-1].lower() if before.strip() else ""
+        # "Dr. Ade", "9 a.m. service", "1. Sunday" are not sentence ends
+        return not (word.rstrip(".") in _ABBREVIATIONS or word.isdigit())
+
+
+class VoiceNoteStream:
+    """
+    One voice note synthesized while its text is still arriving.
+    Feed raw LLM output (feed_json) or plain text (feed_text), then finish(reply_text).
+    """
+
+    def __init__(self, voice: Optional[str] = None):
+        self.voice = voice or DEFAULT_VOICE
+        self.spoken = ""
+        self._decoder = ReplyFieldDecoder()
+        self._splitter = SentenceSplitter()
+        self._sentences: "asyncio.Queue[Optional[Tuple[asyncio.Task, asyncio.Queue]]]" = asyncio.Queue()
+        self._tts_slots = asyncio.Semaphore(max(1, settings.voice_tts_concurrency))
+        self._tts_tasks: List[asyncio.Task] = []
+        self._encoder: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def feed_json(self, delta: str):
+        """Callback for streamed LLM output (call_ai_provider on_text)."""
+        text = self._decoder.feed(delta)
+        if text:
+            self.feed_text(text)
+        if self._decoder.complete:
+            # The reply string is closed: speak the tail without waiting for the action JSON
+            self.close()
+
+    def feed_text(self, text: str):
+        if self._closed:
+            return
+        self.spoken += text
+        for sentence in self._splitter.feed(text):
+            self._queue_sentence(sentence)
+
+    def close(self):
+        """No more text: queue the last partial sentence and let the encoder finish."""
+        if self._closed:
+            return
+        self._closed = True
+        for sentence in self._splitter.flush():
+            self._queue_sentence(sentence)
+        if self._encoder is None and self.spoken.strip():
+            # Nothing speakable after cleaning (all [notes]); say the emoji-free text instead
+            from app.services.agent_service import strip_emojis
+            self._queue_sentence(strip_emojis(self.spoken), clean=False)
+        if self._encoder is not None:
+            self._sentences.put_nowait(None)
+
+    def _queue_sentence(self, sentence: str, clean: bool = True):
+        text = clean_for_speech(sentence) if clean else sentence.strip()
+        if not text:
+            return
+        if self._encoder is None:
+            self._encoder = asyncio.create_task(self._encode())
+        chunks: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(self._synthesize(text, len(self._tts_tasks), chunks))
+        self._tts_tasks.append(task)
+        self._sentences.put_nowait((task, chunks))
+
+    async def _synthesize(self, sentence: str, index: int, chunks: asyncio.Queue):
+        """edge-tts for one sentence; MP3 chunks go to the encoder as they arrive."""
+        import edge_tts
+        try:
+            async with self._tts_slots:
+                with stage_span("tts", chars=len(sentence), sentence=index) as span:
+                    total = 0
+                    async for chunk in edge_tts.Communicate(sentence, self.voice).stream():
+                        if chunk["type"] == "audio":
+                            chunks.put_nowait(chunk["data"])
+                            total += len(chunk["data"])
+                    span.set(bytes=total)
+        finally:
+            chunks.put_nowait(None)
+
+    async def _encode(self) -> bytes:
+        """Feed sentence audio, in order, through one pooled ffmpeg process; returns OGG/Opus bytes."""
+        async with get_encoder_pool().encoder() as proc:
+            return await self._transcode(proc)
+
+    async def _transcode(self, proc: asyncio.subprocess.Process) -> bytes:
+        # Drain stdout/stderr concurrently so a full pipe never stalls the writer
+        output = asyncio.create_task(proc.stdout.read())
+        errors = asyncio.create_task(proc.stderr.read())
+        mp3 = bytearray()
+        try:
+            with stage_span("ffmpeg") as span:
+                while True:
+                    item = await self._sentences.get()
+                    if item is None:
+                        break
+                    task, chunks = item
+                    while True:
+                        data = await chunks.get()
+                        if data is None:
+                            break
+                        mp3 += data
+                        proc.stdin.write(data)
+                        await proc.stdin.drain()
+                    await task
+                proc.stdin.close()
+                ogg, stderr = await output, await errors
+                await proc.wait()
+                span.set(input_bytes=len(mp3), bytes=len(ogg))
+        except BaseException:
+            output.cancel()
+            errors.cancel()
+            await asyncio.gather(output, errors, return_exceptions=True)
+            raise
+
+        if proc.returncode != 0 or not ogg:
+            logger.warning(f"ffmpeg OGG conversion failed ({stderr.decode(errors='ignore')[:200]}), falling back to raw MP3 bytes")
+            return bytes(mp3)
+        logger.info(f"🎙️ Synthesized {len(ogg)} bytes of OGG/OPUS audio for WhatsApp voice note")
+        return ogg
+
+    async def cancel(self):
+        """Abandon the note (reply changed or the caller failed); stops TTS and ffmpeg."""
+        self._closed = True
+        tasks = self._tts_tasks + ([self._encoder] if self._encoder else [])
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def wait(self) -> bytes:
+        """The finished note (empty if nothing was spoken or synthesis failed)."""
+        self.close()
+        if self._encoder is None:
+            return b""
+        try:
+            return await self._encoder
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Voice synthesis error: {e}")
+            await self.cancel()
+            return b""
+
+    async def finish(self, reply_text: str) -> bytes:
+        """
+        The voice note for reply_text: the streamed audio when it was made from exactly
+        this text, otherwise a fresh synthesis of reply_text.
+        """
+        from app.services.agent_service import strip_emojis
+        self.close()
+        cached = await cached_voice_note(reply_text, self.voice)
+        if cached:
+            metrics.incr("voice_notes", mode="cached")
+            await self.cancel()
+            return cached
+        if self._encoder is None or strip_emojis(self.spoken.strip()) != reply_text:
+            if self._encoder is not None:
+                logger.info("🎙️ Streamed voice text differs from the final reply; re-synthesizing")
+            metrics.incr("voice_notes", mode="resynthesized" if self._encoder is not None else "whole")
+            await self.cancel()
+            return await synthesize_text(reply_text, self.voice)
+
+        started = time.monotonic()
+        audio = await self.wait()
+        # Time the send waited on audio after the LLM finished: what streaming leaves on the critical path
+        metrics.observe("voice_note_tail_seconds", time.monotonic() - started)
+        metrics.incr("voice_notes", mode="streamed")
+        await store_voice_note(reply_text, self.voice, audio)
+        return audio
+
+
+async def _synthesize_native_opus(text: str, voice: str) -> bytes:
+    """One edge-tts request for OGG/Opus output: no transcode. Empty on failure."""
+    import edge_tts
+    from app.services.agent_service import strip_emojis
+    speech = clean_for_speech(text) or strip_emojis(text)
+    parts = []
+    try:
+        with stage_span("tts", chars=len(speech), native_opus=True) as span:
+            async for chunk in edge_tts.Communicate(speech, voice, output_format=EDGE_OPUS_FORMAT).stream():
+                if chunk["type"] == "audio":
+                    parts.append(chunk["data"])
+            audio = b"".join(parts)
+            span.set(bytes=len(audio))
+    except Exception as e:
+        logger.warning(f"Native Opus synthesis failed, transcoding instead: {e}")
+        return b""
+    if not audio.startswith(b"OggS"):
+        logger.warning("edge-tts did not return OGG audio, transcoding instead")
+        return b""
+    metrics.incr("voice_notes", mode="native_opus")
+    return audio
+
+
+async def synthesize_text(text: str, voice: Optional[str] = None) -> bytes:
+    """
+    Complete text through the sentence pipeline (sentences still overlap the encoder),
+    or straight from the TTS cache. With native Opus enabled, one edge-tts request
+    produces the note and ffmpeg is skipped.
+    """
+    voice = voice or DEFAULT_VOICE
+    native_opus = native_opus_enabled()
+    cached = await cached_voice_note(text, voice, native_opus)
+    if cached:
+        return cached
+    if native_opus:
+        audio = await _synthesize_native_opus(text, voice)
+        if audio:
+            await store_voice_note(text, voice, audio, native_opus=True)
+            return audio
+    stream = VoiceNoteStream(voice)
+    stream.feed_text(text)
+    audio = await stream.wait()
+    await store_voice_note(text, voice, audio)
+    return audio
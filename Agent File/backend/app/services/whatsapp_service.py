@@ -7,6 +7,8 @@ import httpx
 from typing import Optional, Dict, Any
 import logging
 
+from app.services.http_client_service import get_http_client
+
 logger = logging.getLogger(__name__)
 
 class WhatsAppService:
@@ -33,24 +35,25 @@ class WhatsAppService:
             dict: {"success": bool, "messageId": str (optional), "error": str (optional)}
         """
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.bridge_url}/api/send",
-                    json={
-                        "phone": phone,
-                        "message": message,
-                        "whatsappId": whatsapp_id
-                    }
-                )
+            client = get_http_client(self.bridge_url)
+            response = await client.post(
+                f"{self.bridge_url}/api/send",
+                json={
+                    "phone": phone,
+                    "message": message,
+                    "whatsappId": whatsapp_id
+                },
+                timeout=30.0
+            )
                 
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logger.error(f"Bridge returned {response.status_code}: {response.text}")
-                    return {
-                        "success": False,
-                        "error": f"Bridge error: {response.status_code}"
-                    }
+            if response.status_code == 200:
+                return response.json()
+            else:
+                logger.error(f"Bridge returned {response.status_code}: {response.text}")
+                return {
+                    "success": False,
+                    "error": f"Bridge error: {response.status_code}"
+                }
                     
         except httpx.TimeoutException:
             logger.error("Timeout connecting to WhatsApp bridge")
@@ -83,27 +86,28 @@ class WhatsAppService:
             dict: {"success": bool, "messageId": str (optional), "error": str (optional)}
         """
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{self.bridge_url}/api/sendMedia",
-                    json={
-                        "phone": phone,
-                        "whatsappId": whatsapp_id,
-                        "mediaType": media_type,
-                        "mediaData": media_data,
-                        "caption": caption,
-                        "filename": filename
-                    }
-                )
+            client = get_http_client(self.bridge_url)
+            response = await client.post(
+                f"{self.bridge_url}/api/sendMedia",
+                json={
+                    "phone": phone,
+                    "whatsappId": whatsapp_id,
+                    "mediaType": media_type,
+                    "mediaData": media_data,
+                    "caption": caption,
+                    "filename": filename
+                },
+                timeout=60.0
+            )
                 
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logger.error(f"Bridge returned {response.status_code}: {response.text}")
-                    return {
-                        "success": False,
-                        "error": f"Bridge error: {response.status_code}"
-                    }
+            if response.status_code == 200:
+                return response.json()
+            else:
+                logger.error(f"Bridge returned {response.status_code}: {response.text}")
+                return {
+                    "success": False,
+                    "error": f"Bridge error: {response.status_code}"
+                }
                     
         except httpx.TimeoutException:
             logger.error("Timeout sending media to WhatsApp bridge")
@@ -120,16 +124,16 @@ class WhatsAppService:
             dict: {"status": "connected" | "disconnected" | "error", ...}
         """
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.bridge_url}/api/status")
+            client = get_http_client(self.bridge_url)
+            response = await client.get(f"{self.bridge_url}/api/status", timeout=5.0)
                 
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    return {
-                        "status": "error",
-                        "message": f"Bridge returned {response.status_code}"
-                    }
+            if response.status_code == 200:
+                return response.json()
+            else:
+                return {
+                    "status": "error",
+                    "message": f"Bridge returned {response.status_code}"
+                }
                     
         except httpx.TimeoutException:
             return {"status": "disconnected", "message": "Bridge timeout"}
@@ -1,4 +1,5 @@
 """Workflow Service for automated follow-ups."""
+import logging
 from datetime import datetime
 from sqlalchemy.orm import Session
 from sqlalchemy import func
@@ -6,6 +7,9 @@ from app.models.contact import Contact
 from app.models.workflow import WorkflowStep
 from app.models.message import Message
 from app.services.ai_service import generate_message
+from app.services.ai_rate_limiter import AIRateLimitExceeded, PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
 
 
 async def process_daily_workflows(db: Session):
@@ -73,15 +77,21 @@ async def process_daily_workflows(db: Session):
             # Already sent a workflow message today, skip
             continue
         
-        # 6. Generate AI message for next workflow step
-        message_content = await generate_message(
-            contact_name=contact.name,
-            contact_category=contact.category,
-            context=f"Workflow Step: {step.title}\nPrompt: {step.prompt}",
-            tone="encouraging",
-            sender_name="Pastor", # Should fetch from org settings
-            organization_name="Church" # Should fetch from org
-        )
+        # 6. Generate AI message for next workflow step (bulk priority: yields to live agent replies)
+        try:
+            message_content = await generate_message(
+                contact_name=contact.name,
+                contact_category=contact.category,
+                context=f"Workflow Step: {step.title}\nPrompt: {step.prompt}",
+                tone="encouraging",
+                sender_name="Pastor", # Should fetch from org settings
+                organization_name="Church", # Should fetch from org
+                priority=PRIORITY_BULK
+            )
+        except AIRateLimitExceeded as e:
+            # Not sent today, so the catch-up logic picks this step up on the next run
+            logger.warning(f"Workflow generation rate limited for contact {contact.id}: {e}")
+            continue
         
         # 7. Create message with Pending status for bridge to deliver
         new_message = Message(
@@ -0,0 +1,163 @@
+"""
+In-process metrics registry.
+Counters, gauges and histograms for the agent pipeline, exposed via /api/metrics.
+"""
+
+import threading
+from collections import deque
+from typing import Dict, Any, Tuple, Optional
+
+# Latency buckets in seconds (upper bounds)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Token-count buckets (prompt sizes)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_key(key: Tuple[str, Tuple[Tuple[str, str], ...]]) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+    return f"{name}{{{label_str}}}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not float(value).is_integer() else str(int(value))
+
+
+def percentile(values, pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Histogram:
+    """Bucketed histogram that also keeps a window of recent samples for percentiles."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, window: int = 512):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def snapshot(self) -> Dict[str, Any]:
+        samples = list(self.recent)
+        return {
+            "count": self.count,
+            "sum": round(self.total, 4),
+            "avg": round(self.total / self.count, 4) if self.count else None,
+            "max": round(self.max, 4),
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+        }
+
+
+class MetricsRegistry:
+    """Thread-safe registry shared by API workers, job workers and executor threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple, float] = {}
+        self._gauges: Dict[Tuple, float] = {}
+        self._histograms: Dict[Tuple, Histogram] = {}
+
+    def incr(self, name: str, value: float = 1, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels):
+        """Record a sample. buckets only applies when the series is first created; keep it fixed per name."""
+        key = _metric_key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get_counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(_metric_key(name, labels), 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": {_format_key(k): v for k, v in self._counters.items()},
+                "gauges": {_format_key(k): v for k, v in self._gauges.items()},
+                "histograms": {_format_key(k): h.snapshot() for k, h in self._histograms.items()},
+            }
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format (counters get a _total suffix)."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(
+                ((key, (h.buckets, list(h.bucket_counts), h.count, h.total)) for key, h in self._histograms.items()),
+                key=lambda item: item[0]
+            )
+
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            metric = name if name.endswith("_total") else f"{name}_total"
+            declare(metric, "counter")
+            lines.append(f"{_format_key((metric, labels))} {_format_value(value)}")
+        for (name, labels), value in gauges:
+            declare(name, "gauge")
+            lines.append(f"{_format_key((name, labels))} {_format_value(value)}")
+        for (name, labels), (buckets, bucket_counts, count, total) in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{_format_key((name + '_bucket', labels + (('le', _format_value(bound)),)))} {cumulative}")
+            lines.append(f"{_format_key((name + '_bucket', labels + (('le', '+Inf'),)))} {count}")
+            lines.append(f"{_format_key((name + '_sum', labels))} {_format_value(total)}")
+            lines.append(f"{_format_key((name + '_count', labels))} {count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+# Singleton instance
+metrics = MetricsRegistry()
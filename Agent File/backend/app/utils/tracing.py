@@ -0,0 +1,201 @@
+"""
+Per-stage tracing for the autopilot reply pipeline.
+
+Each stage of a reply (Meta media fetch, transcription, embedding, pgvector,
+LLM, TTS, ffmpeg, Meta send, DB units) runs inside stage_span(). A span:
+- is emitted through the OpenTelemetry API when opentelemetry-api is installed
+  (no-op until the deployment configures an SDK/exporter)
+- is recorded in the agent_stage_seconds{stage} histogram (see /api/metrics/prometheus)
+- is added to the current reply's stage breakdown, kept for the slowest-replies
+  debug endpoint
+
+reply_trace() opens the trace for one reply. The current trace lives in a
+contextvar, so it follows the reply into tasks and asyncio.to_thread workers.
+"""
+
+import contextvars
+import importlib.util
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from app.config import settings
+from app.utils.metrics import metrics
+
+OTEL_AVAILABLE = importlib.util.find_spec("opentelemetry") is not None
+
+if OTEL_AVAILABLE:
+    from opentelemetry import trace as otel_trace
+    from opentelemetry.trace import Status, StatusCode
+    _tracer = otel_trace.get_tracer("shepherd_ai.agent")
+else:
+    _tracer = None
+
+
+class ReplyTrace:
+    """Stage timings for one agent reply."""
+
+    def __init__(self, org_id: str, contact_id: str):
+        self.org_id = org_id
+        self.contact_id = contact_id
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.monotonic()
+        self.duration: Optional[float] = None
+        self.outcome = "ok"
+        self.attributes: Dict[str, Any] = {}
+        self.stages: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, started: float, seconds: float, attributes: Dict[str, Any], error: Optional[str]):
+        entry = {
+            "stage": stage,
+            "offset_ms": round((started - self.started) * 1000, 1),
+            "duration_ms": round(seconds * 1000, 1),
+            **attributes,
+        }
+        if error:
+            entry["error"] = error
+        with self._lock:
+            self.stages.append(entry)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = sorted(self.stages, key=lambda s: s["offset_ms"])
+        return {
+            "org_id": self.org_id,
+            "contact_id": self.contact_id,
+            "started_at": self.started_at.isoformat().replace("+00:00", "Z"),
+            "duration_ms": round((self.duration or 0) * 1000, 1),
+            "outcome": self.outcome,
+            **self.attributes,
+            "stages": stages,
+        }
+
+
+class _RecentReplies:
+    """Bounded window of finished reply traces (per process)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._traces: Deque[ReplyTrace] = deque(maxlen=settings.trace_recent_replies)
+
+    def add(self, trace: ReplyTrace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def slowest(self, limit: int = 20, org_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Slowest finished replies, optionally only one organization's."""
+        with self._lock:
+            traces = [trace for trace in self._traces if org_id is None or trace.org_id == org_id]
+        traces.sort(key=lambda t: t.duration or 0, reverse=True)
+        return [trace.to_dict() for trace in traces[:limit]]
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+
+
+# Singleton instance
+recent_replies = _RecentReplies()
+
+_current_trace: contextvars.ContextVar[Optional[ReplyTrace]] = contextvars.ContextVar("agent_reply_trace", default=None)
+_current_stage: contextvars.ContextVar[Optional["StageSpan"]] = contextvars.ContextVar("agent_stage_span", default=None)
+
+
+class StageSpan:
+    """Handle for attributes learned while the stage runs (byte counts, tokens, provider)."""
+
+    def __init__(self, otel_span=None):
+        self.attributes: Dict[str, Any] = {}
+        self._otel_span = otel_span
+
+    def set(self, **attributes):
+        for key, value in attributes.items():
+            if value is None:
+                continue
+            self.attributes[key] = value
+            if self._otel_span is not None:
+                self._otel_span.set_attribute(f"agent.{key}", value)
+
+
+@contextmanager
+def reply_trace(org_id, contact_id) -> Iterator[ReplyTrace]:
+    """Open the trace (and OTel root span) for one agent reply."""
+    trace = ReplyTrace(str(org_id), str(contact_id))
+    token = _current_trace.set(trace)
+    otel_cm = _tracer.start_as_current_span(
+        "agent.reply",
+        attributes={"agent.org_id": trace.org_id, "agent.contact_id": trace.contact_id}
+    ) if _tracer else None
+    otel_span = otel_cm.__enter__() if otel_cm else None
+    try:
+        yield trace
+    except BaseException as e:
+        trace.outcome = "error"
+        if otel_span is not None:
+            otel_span.record_exception(e)
+            otel_span.set_status(Status(StatusCode.ERROR, str(e)))
+        raise
+    finally:
+        trace.duration = time.monotonic() - trace.started
+        if otel_span is not None:
+            otel_span.set_attribute("agent.outcome", trace.outcome)
+            for key, value in trace.attributes.items():
+                otel_span.set_attribute(f"agent.{key}", value)
+        if otel_cm:
+            otel_cm.__exit__(None, None, None)
+        _current_trace.reset(token)
+        metrics.observe("agent_reply_seconds", trace.duration, outcome=trace.outcome)
+        recent_replies.add(trace)
+
+
+@contextmanager
+def stage_span(stage: str, **attributes) -> Iterator[StageSpan]:
+    """Time one pipeline stage; works in coroutines and worker threads alike."""
+    trace = _current_trace.get()
+    otel_cm = _tracer.start_as_current_span(f"agent.{stage}") if _tracer else None
+    otel_span = otel_cm.__enter__() if otel_cm else None
+    span = StageSpan(otel_span)
+    if trace is not None:
+        span.set(org_id=trace.org_id, contact_id=trace.contact_id)
+    span.set(**attributes)
+    stage_token = _current_stage.set(span)
+    started = time.monotonic()
+    error = None
+    try:
+        yield span
+    except BaseException as e:
+        error = type(e).__name__
+        if otel_span is not None:
+            otel_span.record_exception(e)
+            otel_span.set_status(Status(StatusCode.ERROR, str(e)))
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        _current_stage.reset(stage_token)
+        if otel_cm:
+            otel_cm.__exit__(None, None, None)
+        metrics.observe("agent_stage_seconds", elapsed, stage=stage)
+        if trace is not None:
+            extra = {k: v for k, v in span.attributes.items() if k not in ("org_id", "contact_id")}
+            trace.add_stage(stage, started, elapsed, extra, error)
+
+
+def annotate_reply(outcome: Optional[str] = None, **attributes):
+    """Set the current reply's outcome and attributes (source, voice, ...), if a trace is open."""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    if outcome:
+        trace.outcome = outcome
+    trace.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+
+def annotate_stage(**attributes):
+    """Add attributes to the innermost open stage span (e.g. token usage reported deep in a provider call)."""
+    span = _current_stage.get()
+    if span is not None:
+        span.set(**attributes)
@@ -0,0 +1,4 @@
+"""
+Offline benchmarks for the agent pipeline.
+Stub upstreams (LLM, Meta Graph, whisper) run in-process; only Postgres is real.
+"""
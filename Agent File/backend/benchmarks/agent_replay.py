@@ -0,0 +1,493 @@
+"""
+Agent Replay Benchmark
+Replays recorded or synthetic conversations through trigger_ai_agent_reply
+against a local Postgres (with pgvector) and in-process stub upstreams.
+
+    python -m benchmarks.agent_replay run --conversations 40 --turns 4 --concurrency 8
+    python -m benchmarks.agent_replay run --replay conversations.jsonl --llm-ms 1200
+    python -m benchmarks.agent_replay export --org-id <uuid> --out conversations.jsonl
+
+Run from the backend directory with DATABASE_URL pointing at a scratch database:
+each run seeds its own organization (contacts, knowledge base) and deletes it at
+the end unless --keep-data is given. --init-schema creates missing tables first.
+
+Reported per run: replies/sec, p50/p95/p99 end-to-end latency, DB queries per
+reply (counted with a before_cursor_execute hook, only inside the reply), peak
+pooled connections, reply outcomes and sources, per-stage p50/p99 from the
+reply traces, and how many requests each stub upstream served.
+
+Conversation files are JSON lines: {"name": "Ada", "turns": ["Hi", {"voice": "..."}]}.
+A string or {"text": ...} turn is a text message; {"voice": ...} is a voice note
+whose transcript the stub whisper endpoint returns. TTS (edge-tts) is not stubbed,
+so runs always reply in text.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from sqlalchemy import event, text
+
+from app.database import SessionLocal, engine
+from app.services import agent_service
+from app.services.http_client_service import http_clients
+from app.utils.metrics import metrics, percentile
+from app.utils.tracing import recent_replies
+from benchmarks.stubs import LLM_BASE_URL, WHISPER_URL, Latency, StubConfig, StubUpstreams, fake_voice_note, stub_embedding
+
+logger = logging.getLogger("benchmarks.agent_replay")
+
+SYNTHETIC_TURNS = (
+    "Hi",
+    "Good morning!",
+    "What time is service on Sunday?",
+    "Where is the church located?",
+    "How can I pay my tithe online?",
+    "Do you have a midweek bible study?",
+    "I would like to speak with the pastor about counselling",
+    "Can I book a visit tomorrow at 10am?",
+    "Thank you so much",
+    "ok",
+)
+
+SYNTHETIC_VOICE_TURNS = (
+    "Please what time does the Sunday service start",
+    "I want to book counselling with the pastor tomorrow morning",
+)
+
+KNOWLEDGE_BASE = (
+    ("Service times", "Sunday service runs from 9am to 11:30am. Midweek bible study is on Wednesdays at 6pm."),
+    ("Location", "The church is at 12 Church Road, opposite the central market. Parking is available."),
+    ("Giving", "Tithes and offerings can be paid online through the payment link or by bank transfer."),
+    ("Counselling", "The pastor holds counselling sessions on weekdays. Bookings are confirmed by the church office."),
+)
+
+# Per-reply query counter; contextvars follow the reply into asyncio.to_thread workers
+_reply_queries: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("bench_reply_queries", default=None)
+
+
+class PoolProbe:
+    """Counts SQL statements per reply and tracks the peak number of checked-out connections."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.peak_connections = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        event.listen(engine, "checkout", self._on_checkout)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        counter = _reply_queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        checked_out = engine.pool.checkedout()
+        with self._lock:
+            self.peak_connections = max(self.peak_connections, checked_out)
+
+    def reset(self):
+        with self._lock:
+            self.peak_connections = engine.pool.checkedout()
+
+    def close(self):
+        event.remove(engine, "before_cursor_execute", self._on_execute)
+        event.remove(engine, "checkout", self._on_checkout)
+
+
+def synthetic_conversations(count: int, turns: int, voice_ratio: float, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    conversations = []
+    for i in range(count):
+        script = []
+        for _ in range(turns):
+            if rng.random() < voice_ratio:
+                script.append({"voice": rng.choice(SYNTHETIC_VOICE_TURNS)})
+            else:
+                script.append({"text": rng.choice(SYNTHETIC_TURNS)})
+        conversations.append({"name": f"Bench Contact {i + 1}", "turns": script})
+    return conversations
+
+
+def load_conversations(path: str) -> List[Dict[str, Any]]:
+    conversations = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            turns = [{"text": t} if isinstance(t, str) else t for t in entry.get("turns", [])]
+            conversations.append({"name": entry.get("name") or f"Replay Contact {len(conversations) + 1}", "turns": turns})
+    return conversations
+
+
+def export_conversations(org_id: str, out_path: str, limit: int) -> int:
+    """Write the inbound messages of an org's most recently active contacts as a replay file."""
+    db = SessionLocal()
+    try:
+        contacts = db.execute(
+            text("""
+                SELECT c.id, c.name FROM contacts c
+                JOIN messages m ON m.contact_id = c.id AND m.type = 'Inbound'
+                WHERE c.organization_id = :org_id
+                GROUP BY c.id, c.name
+                ORDER BY MAX(m.created_at) DESC
+                LIMIT :limit
+            """),
+            {"org_id": org_id, "limit": limit}
+        ).fetchall()
+        with open(out_path, "w", encoding="utf-8") as f:
+            for contact_id, name in contacts:
+                rows = db.execute(
+                    text("SELECT content FROM messages WHERE contact_id = :contact_id AND type = 'Inbound' ORDER BY created_at"),
+                    {"contact_id": str(contact_id)}
+                ).fetchall()
+                turns = []
+                for (content,) in rows:
+                    content = content or ""
+                    if content.startswith("🎙️ "):
+                        turns.append({"voice": content[len("🎙️ "):]})
+                    elif content and not content.startswith("[Voice"):
+                        turns.append({"text": content})
+                if turns:
+                    f.write(json.dumps({"name": name, "turns": turns}, ensure_ascii=False) + "\n")
+        return len(contacts)
+    finally:
+        db.close()
+
+
+def init_schema():
+    """Create missing tables (same steps as app startup)."""
+    import app.models  # noqa: F401  (registers every model on Base.metadata)
+    from app.database import Base
+    from app import init_db
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS vector")
+    Base.metadata.create_all(engine)
+    for step in (
+        init_db.init_groups_tables, init_db.init_bookings_table, init_db.init_chat_tables, init_db.init_media_table,
+        init_db.init_agent_jobs_table, init_db.init_conversation_summaries_table, init_db.init_reply_cache_table,
+        init_db.init_reply_drafts_table,
+    ):
+        step()
+
+
+def seed_organization(args, conversations: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """One org configured for the stub upstreams, a knowledge base and one contact per conversation."""
+    db = SessionLocal()
+    try:
+        org_id = str(uuid4())
+        unlimited = None if args.server_rate_limits else "1000000"
+        db.execute(
+            text("""
+                INSERT INTO organizations (
+                    id, name, ai_name, ai_provider, ai_api_key, ai_model, ai_base_url, ai_auto_reply_enabled,
+                    ai_voice_reply_mode, whatsapp_phone_id, whatsapp_access_token,
+                    ai_rate_limit_rpm, ai_rate_limit_tpm, ai_max_concurrency,
+                    ai_reply_cache_enabled, ai_fast_path_enabled
+                ) VALUES (
+                    :id, :name, 'Shepherd AI', 'openai', 'bench-key', 'bench-model', :base_url, 'true',
+                    'text', :phone_id, :token, :limit, :limit, :limit, :reply_cache, :fast_path
+                )
+            """),
+            {
+                "id": org_id,
+                "name": f"Benchmark {org_id[:8]}",
+                "base_url": LLM_BASE_URL,
+                "phone_id": "bench-phone" if args.delivery == "meta" else None,
+                "token": "bench-token" if args.delivery == "meta" else None,
+                "limit": unlimited,
+                "reply_cache": "true" if args.reply_cache else "false",
+                "fast_path": "false" if args.no_fast_path else "true",
+            }
+        )
+        for title, content in KNOWLEDGE_BASE:
+            resource_id = str(uuid4())
+            db.execute(
+                text("INSERT INTO knowledge_resources (id, organization_id, title, type, content) VALUES (:id, :org_id, :title, 'faq', :content)"),
+                {"id": resource_id, "org_id": org_id, "title": title, "content": content}
+            )
+            db.execute(
+                text("INSERT INTO knowledge_embeddings (id, resource_id, chunk_text, chunk_index, embedding) VALUES (:id, :resource_id, :chunk, 0, :embedding)"),
+                {"id": str(uuid4()), "resource_id": resource_id, "chunk": content, "embedding": str(stub_embedding(content))}
+            )
+        contact_ids = []
+        for i, conversation in enumerate(conversations):
+            contact_id = str(uuid4())
+            db.execute(
+                text("""
+                    INSERT INTO contacts (id, organization_id, name, phone, category, join_date, conversation_status)
+                    VALUES (:id, :org_id, :name, :phone, 'Member', NOW(), 'open')
+                """),
+                {"id": contact_id, "org_id": org_id, "name": conversation["name"], "phone": f"+999{org_id[:4]}{i:06d}"}
+            )
+            contact_ids.append(contact_id)
+        db.commit()
+        return {"org_id": org_id, "contact_ids": contact_ids}
+    finally:
+        db.close()
+
+
+def delete_organization(org_id: str):
+    db = SessionLocal()
+    try:
+        db.execute(text("DELETE FROM organizations WHERE id = :org_id"), {"org_id": org_id})
+        db.commit()
+    finally:
+        db.close()
+
+
+def _insert_inbound(db, org_id: str, contact_id: str, turn: Dict[str, Any], stubs: StubUpstreams) -> Dict[str, Any]:
+    """What the webhook stores for an inbound message; returns the agent mailbox entry."""
+    message_id = str(uuid4())
+    media_id = None
+    content = turn.get("text") or ""
+    if "voice" in turn:
+        media_id = f"bench-media-{message_id[:12]}"
+        stubs.media[media_id] = fake_voice_note(turn["voice"])
+        content = "[Voice message]"
+    db.execute(
+        text("""
+            INSERT INTO messages (id, organization_id, contact_id, type, content, status, sent_at, created_at, attachment_url, attachment_type)
+            VALUES (:id, :org_id, :contact_id, 'Inbound', :content, 'Received', NOW(), NOW(), :attachment_url, :attachment_type)
+        """),
+        {
+            "id": message_id, "org_id": org_id, "contact_id": contact_id, "content": content,
+            "attachment_url": f"meta_media_id:{media_id}" if media_id else None,
+            "attachment_type": "audio" if media_id else None,
+        }
+    )
+    db.commit()
+    return {"message_id": message_id, "content": content, "audio_media_id": media_id, "audio_mime_type": "audio/ogg"}
+
+
+class ReplayRun:
+    def __init__(self, args, stubs: StubUpstreams, probe: PoolProbe):
+        self.args = args
+        self.stubs = stubs
+        self.probe = probe
+        self.latencies: List[float] = []
+        self.queries: List[int] = []
+        self.sources: Dict[str, int] = {}
+        self.no_reply = 0
+
+    async def reply(self, db, org_id: str, contact_id: str, turn: Dict[str, Any], record: bool = True):
+        entry = await asyncio.to_thread(_insert_inbound, db, org_id, contact_id, turn, self.stubs)
+        counter = [0]
+        token = _reply_queries.set(counter)
+        started = time.perf_counter()
+        try:
+            result = await agent_service.trigger_ai_agent_reply(
+                contact_id=contact_id,
+                incoming_text=entry["content"],
+                org_id=org_id,
+                db=db,
+                inbound_messages=[entry]
+            )
+        finally:
+            elapsed = time.perf_counter() - started
+            _reply_queries.reset(token)
+        if not record:
+            return
+        self.latencies.append(elapsed)
+        self.queries.append(counter[0])
+        if result is None:
+            self.no_reply += 1
+        else:
+            source = result.get("source") or "unknown"
+            self.sources[source] = self.sources.get(source, 0) + 1
+
+    async def conversation(self, semaphore: asyncio.Semaphore, org_id: str, contact_id: str, turns: List[Dict[str, Any]]):
+        async with semaphore:
+            db = SessionLocal()
+            try:
+                for turn in turns:
+                    await self.reply(db, org_id, contact_id, turn)
+                    if self.args.think_ms:
+                        await asyncio.sleep(self.args.think_ms / 1000.0)
+            finally:
+                db.close()
+
+    async def run(self, org_id: str, contact_ids: List[str], conversations: List[Dict[str, Any]]) -> float:
+        # Warm-up: first DB connections, org config cache and HTTP clients (not measured)
+        db = SessionLocal()
+        try:
+            for _ in range(self.args.warmup):
+                await self.reply(db, org_id, contact_ids[0], {"text": SYNTHETIC_TURNS[2]}, record=False)
+        finally:
+            db.close()
+        metrics.reset()
+        recent_replies.clear()
+        self.stubs.requests.clear()
+        self.probe.reset()
+
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            self.conversation(semaphore, org_id, contact_id, conversation["turns"])
+            for contact_id, conversation in zip(contact_ids, conversations)
+        ])
+        return time.perf_counter() - started
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def build_report(run: ReplayRun, wall_seconds: float, concurrency: int) -> Dict[str, Any]:
+    histograms = metrics.snapshot()["histograms"]
+    stages = {}
+    for key, hist in sorted(histograms.items()):
+        if key.startswith('agent_stage_seconds{stage="'):
+            stage = key[len('agent_stage_seconds{stage="'):-2]
+            stages[stage] = {"count": hist["count"], "p50_ms": _ms(hist["p50"]), "p99_ms": _ms(hist["p99"])}
+    outcomes = {
+        key[len('agent_reply_seconds{outcome="'):-2]: hist["count"]
+        for key, hist in histograms.items() if key.startswith('agent_reply_seconds{outcome="')
+    }
+    replies = len(run.latencies)
+    return {
+        "replies": replies,
+        "concurrency": concurrency,
+        "wall_seconds": round(wall_seconds, 3),
+        "replies_per_second": round(replies / wall_seconds, 2) if wall_seconds else None,
+        "latency_ms": {
+            "p50": _ms(percentile(run.latencies, 50)),
+            "p95": _ms(percentile(run.latencies, 95)),
+            "p99": _ms(percentile(run.latencies, 99)),
+            "max": _ms(max(run.latencies)) if run.latencies else None,
+        },
+        "db_queries_per_reply": {
+            "mean": round(sum(run.queries) / replies, 2) if replies else None,
+            "p50": percentile(run.queries, 50),
+            "max": max(run.queries) if run.queries else None,
+        },
+        "db_peak_connections": run.probe.peak_connections,
+        "db_pool_max_connections": engine.pool.size() + getattr(engine.pool, "_max_overflow", 0),
+        "outcomes": outcomes,
+        "sources": run.sources,
+        "no_reply": run.no_reply,
+        "stages": stages,
+        "stub_requests": dict(run.stubs.requests),
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    latency = report["latency_ms"]
+    queries = report["db_queries_per_reply"]
+    print(f"\n📊 {report['replies']} replies in {report['wall_seconds']}s at concurrency {report['concurrency']}")
+    print(f"   replies/sec        {report['replies_per_second']}")
+    print(f"   latency p50/p95/p99 {latency['p50']} / {latency['p95']} / {latency['p99']} ms (max {latency['max']})")
+    print(f"   DB queries/reply   mean {queries['mean']}, p50 {queries['p50']}, max {queries['max']}")
+    print(f"   DB connections     peak {report['db_peak_connections']} of {report['db_pool_max_connections']}")
+    print(f"   outcomes           {report['outcomes']}  sources {report['sources']}")
+    print("   stage               count    p50 ms    p99 ms")
+    for stage, row in report["stages"].items():
+        print(f"   {stage:<18} {row['count']:>6} {row['p50_ms']:>9} {row['p99_ms']:>9}")
+    print(f"   stub requests      {report['stub_requests']}")
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    if args.replay:
+        conversations = load_conversations(args.replay)
+    else:
+        conversations = synthetic_conversations(args.conversations, args.turns, args.voice_ratio, args.seed)
+    if not conversations:
+        raise SystemExit("No conversations to replay.")
+
+    stubs = StubUpstreams(StubConfig(
+        llm=Latency(args.llm_ms, args.llm_ms * args.jitter),
+        meta=Latency(args.meta_ms, args.meta_ms * args.jitter),
+        whisper=Latency(args.whisper_ms, args.whisper_ms * args.jitter),
+        embedding=Latency(args.embed_ms, args.embed_ms * args.jitter),
+        seed=args.seed,
+    ))
+    if args.llm_replies:
+        with open(args.llm_replies, encoding="utf-8") as f:
+            stubs.config.llm_replies = json.load(f)
+
+    http_clients.override_transport("*", stubs.transport())
+    original_embedding = agent_service.generate_embedding
+    agent_service.generate_embedding = stubs.embed
+    os.environ["TRANSCRIBE_SERVICE_URL"] = WHISPER_URL
+
+    if args.init_schema:
+        init_schema()
+    seeded = seed_organization(args, conversations)
+    probe = PoolProbe()
+    run = ReplayRun(args, stubs, probe)
+    try:
+        wall = await run.run(seeded["org_id"], seeded["contact_ids"], conversations)
+        report = build_report(run, wall, args.concurrency)
+    finally:
+        probe.close()
+        agent_service.generate_embedding = original_embedding
+        await http_clients.close()
+        http_clients.override_transport("*", None)
+        if args.keep_data:
+            print(f"Kept benchmark organization {seeded['org_id']}")
+        else:
+            delete_organization(seeded["org_id"])
+    return report
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.agent_replay", description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_cmd = commands.add_parser("run", help="replay conversations and report throughput and latency")
+    run_cmd.add_argument("--replay", help="JSON-lines conversation file (default: synthetic conversations)")
+    run_cmd.add_argument("--conversations", type=int, default=20, help="synthetic conversations (one contact each)")
+    run_cmd.add_argument("--turns", type=int, default=4, help="inbound messages per synthetic conversation")
+    run_cmd.add_argument("--voice-ratio", type=float, default=0.2, help="share of synthetic turns sent as voice notes")
+    run_cmd.add_argument("--concurrency", type=int, default=8, help="conversations replayed at once")
+    run_cmd.add_argument("--think-ms", type=float, default=0.0, help="pause between a contact's turns")
+    run_cmd.add_argument("--warmup", type=int, default=3, help="unmeasured replies before the run")
+    run_cmd.add_argument("--llm-ms", type=float, default=800.0, help="stub LLM latency")
+    run_cmd.add_argument("--meta-ms", type=float, default=120.0, help="stub Meta Graph latency")
+    run_cmd.add_argument("--whisper-ms", type=float, default=600.0, help="stub whisper latency")
+    run_cmd.add_argument("--embed-ms", type=float, default=80.0, help="stub embedding latency")
+    run_cmd.add_argument("--jitter", type=float, default=0.25, help="latency jitter as a fraction of the mean")
+    run_cmd.add_argument("--llm-replies", help="JSON list of agent replies for the stub LLM to pick from")
+    run_cmd.add_argument("--delivery", choices=("meta", "wppconnect"), default="meta")
+    run_cmd.add_argument("--reply-cache", action="store_true", help="turn the semantic reply cache on for the org")
+    run_cmd.add_argument("--no-fast-path", action="store_true", help="send greetings and thanks to the LLM too")
+    run_cmd.add_argument("--server-rate-limits", action="store_true", help="keep the server's AI rate limits (default: unlimited)")
+    run_cmd.add_argument("--seed", type=int, default=7)
+    run_cmd.add_argument("--init-schema", action="store_true", help="create missing tables first")
+    run_cmd.add_argument("--keep-data", action="store_true", help="do not delete the seeded organization")
+    run_cmd.add_argument("--json", help="also write the report to this file")
+
+    export_cmd = commands.add_parser("export", help="write an org's inbound conversations as a replay file")
+    export_cmd.add_argument("--org-id", required=True)
+    export_cmd.add_argument("--out", required=True)
+    export_cmd.add_argument("--limit", type=int, default=100, help="most recently active contacts to export")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+
+    if args.command == "export":
+        count = export_conversations(args.org_id, args.out, args.limit)
+        print(f"Exported {count} conversations to {args.out}")
+        return
+
+    report = asyncio.run(run_benchmark(args))
+    report["generated_at"] = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+Stub upstreams for the offline agent benchmark.
+
+One httpx transport answers every outbound HTTP call the agent makes, with a
+configurable latency per upstream:
+- the LLM (OpenAI-compatible /chat/completions on LLM_BASE_URL), replying with
+  canned agent JSON
+- Meta Graph (media lookup, media download, message and voice-note sends)
+- the faster-whisper microservice on WHISPER_URL
+
+It is installed with http_clients.override_transport("*", ...), so a request to
+any other host fails instead of leaving the machine. Gemini embeddings go over
+gRPC rather than httpx; stub_embedding() replaces them with a deterministic
+bag-of-words vector so pgvector search and the reply cache still behave like
+they do with real embeddings.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+
+from app.services.reply_cache_service import EMBEDDING_DIMENSIONS
+
+LLM_BASE_URL = "http://llm.bench/v1"
+WHISPER_URL = "http://whisper.bench/transcribe"
+MEDIA_DOWNLOAD_URL = "https://lookaside.fbsbx.com/whatsapp_business/attachments/"
+
+# Fake voice notes carry their own transcript after the Ogg magic bytes
+FAKE_OGG_MAGIC = b"OggS"
+
+DEFAULT_LLM_REPLIES: List[Dict[str, Any]] = [
+    {"reply": "Sunday service starts at 9am and ends around 11:30am.", "action": {"type": "NONE"}, "generic": True},
+    {"reply": "We are at 12 Church Road, opposite the market. You are welcome!", "action": {"type": "NONE"}, "generic": True},
+    {"reply": "I've noted that. Would you like me to book a time with the pastor?", "action": {"type": "NONE"}},
+    {"reply": "You're booked. We look forward to seeing you!", "action": {"type": "CREATE_BOOKING", "purpose": "Counselling", "preferredDate": "tomorrow", "preferredTime": "10:00 AM"}},
+]
+
+
+@dataclass
+class Latency:
+    """Simulated upstream latency: mean plus uniform jitter, in milliseconds."""
+    mean_ms: float = 0.0
+    jitter_ms: float = 0.0
+
+    async def wait(self, rng: random.Random):
+        delay = self.mean_ms + (rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000.0)
+
+
+@dataclass
+class StubConfig:
+    llm: Latency = field(default_factory=lambda: Latency(800.0, 200.0))
+    meta: Latency = field(default_factory=lambda: Latency(120.0, 40.0))
+    whisper: Latency = field(default_factory=lambda: Latency(600.0, 150.0))
+    embedding: Latency = field(default_factory=lambda: Latency(80.0, 20.0))
+    llm_replies: List[Dict[str, Any]] = field(default_factory=lambda: list(DEFAULT_LLM_REPLIES))
+    seed: int = 7
+
+
+def fake_voice_note(transcript: str) -> bytes:
+    """Audio bytes the stub whisper endpoint will transcribe back to this text."""
+    return FAKE_OGG_MAGIC + b"\x00" * 24 + transcript.encode("utf-8") + b"\x00"
+
+
+def _voice_transcript(body: bytes) -> str:
+    """Transcript embedded by fake_voice_note (body is the multipart upload)."""
+    start = body.find(FAKE_OGG_MAGIC + b"\x00" * 24)
+    if start < 0:
+        return ""
+    start += len(FAKE_OGG_MAGIC) + 24
+    end = body.find(b"\x00", start)
+    return body[start:end if end >= 0 else len(body)].decode("utf-8", "ignore")
+
+
+def stub_embedding(text: str) -> List[float]:
+    """Deterministic unit vector: texts that share words land close together."""
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    for word in re.findall(r"\w+", (text or "").lower()):
+        digest = hashlib.sha256(word.encode("utf-8")).digest()
+        for i in range(0, 16, 2):
+            index = int.from_bytes(digest[i:i + 2], "big") % EMBEDDING_DIMENSIONS
+            vector[index] += 1.0 if digest[i + 16] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class StubUpstreams:
+    """In-process LLM, Meta Graph and whisper servers behind one httpx transport."""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self._rng = random.Random(config.seed)
+        self.requests: Dict[str, int] = {}
+        # media id -> fake voice note bytes, registered by the replay driver
+        self.media: Dict[str, bytes] = {}
+
+    def transport(self) -> httpx.AsyncBaseTransport:
+        return httpx.MockTransport(self.handle)
+
+    def _count(self, upstream: str):
+        self.requests[upstream] = self.requests.get(upstream, 0) + 1
+
+    async def embed(self, text: str, api_key: Optional[str] = None) -> List[float]:
+        """Drop-in for ai_service.generate_embedding."""
+        self._count("embedding")
+        await self.config.embedding.wait(self._rng)
+        return stub_embedding(text)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        if url.startswith(LLM_BASE_URL):
+            return await self._llm(request)
+        if url.startswith(WHISPER_URL):
+            return await self._whisper(request)
+        host = urlsplit(url).hostname or ""
+        if host == "graph.facebook.com":
+            return await self._graph(request)
+        if host == "lookaside.fbsbx.com":
+            return await self._media_download(request)
+        self._count("unexpected")
+        return httpx.Response(599, json={"error": f"benchmark stub has no upstream for {host}"})
+
+    async def _llm(self, request: httpx.Request) -> httpx.Response:
+        self._count("llm")
+        await self.config.llm.wait(self._rng)
+        body = json.loads(request.content or b"{}")
+        prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+        content = json.dumps(self._rng.choice(self.config.llm_replies))
+        return httpx.Response(200, json={
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": {
+                "prompt_tokens": prompt_chars // 4,
+                "completion_tokens": len(content) // 4,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        })
+
+    async def _whisper(self, request: httpx.Request) -> httpx.Response:
+        self._count("whisper")
+        await self.config.whisper.wait(self._rng)
+        return httpx.Response(200, json={"text": _voice_transcript(request.content)})
+
+    async def _graph(self, request: httpx.Request) -> httpx.Response:
+        await self.config.meta.wait(self._rng)
+        path = request.url.path.rstrip("/")
+        if request.method == "POST" and path.endswith("/media"):
+            self._count("meta_upload")
+            return httpx.Response(200, json={"id": f"upload-{self._rng.getrandbits(32):08x}"})
+        if request.method == "POST" and path.endswith("/messages"):
+            self._count("meta_send")
+            return httpx.Response(200, json={"messages": [{"id": f"wamid.bench{self._rng.getrandbits(48):012x}"}]})
+        media_id = path.rsplit("/", 1)[-1]
+        if request.method == "GET" and media_id in self.media:
+            self._count("meta_media_info")
+            return httpx.Response(200, json={
+                "url": f"{MEDIA_DOWNLOAD_URL}?mid={media_id}",
+                "mime_type": "audio/ogg; codecs=opus",
+            })
+        self._count("unexpected")
+        return httpx.Response(404, json={"error": {"message": f"unknown Graph path {path}"}})
+
+    async def _media_download(self, request: httpx.Request) -> httpx.Response:
+        self._count("meta_media_download")
+        await self.config.meta.wait(self._rng)
+        media_id = (parse_qs(request.url.query.decode()).get("mid") or [""])[0]
+        audio = self.media.get(media_id)
+        if audio is None:
+            return httpx.Response(404)
+        return httpx.Response(200, content=audio, headers={"Content-Type": "audio/ogg"})
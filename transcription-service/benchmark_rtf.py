@@ -0,0 +1,100 @@
+"""
+Real-time factor benchmark for the transcription service's decoding modes.
+
+Transcribes each audio file with the modes /transcribe can choose between and
+prints the real-time factor (processing seconds / audio seconds; lower is
+better) and the speed-up over the previous default (sequential, beam 5):
+
+    sequential-b5   model.transcribe, beam_size=5 (behaviour before batched mode)
+    sequential      model.transcribe, beam from WHISPER_BEAM_SCHEDULE
+    batched         BatchedInferencePipeline, beam from WHISPER_BEAM_SCHEDULE
+
+Run on the deployment VM with the service's environment, e.g.:
+
+    WHISPER_MODEL_SIZE=small WHISPER_COMPUTE_TYPE=int8 \\
+        python benchmark_rtf.py sermon.ogg testimony.ogg short_note.ogg --repeat 3
+
+The numbers depend entirely on the CPU, thread count and the audio itself, so
+measure with real voice notes rather than quoting figures from elsewhere.
+"""
+
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+from faster_whisper import WhisperModel, decode_audio
+
+try:
+    from faster_whisper import BatchedInferencePipeline
+except ImportError:  # faster-whisper < 1.1
+    BatchedInferencePipeline = None
+
+VAD_PARAMETERS = dict(min_silence_duration_ms=500)
+
+
+def parse_beam_schedule(schedule: str):
+    """Same format as the service: "30:5,120:3,*:1"."""
+    steps = []
+    for step in schedule.split(","):
+        limit, _, beam = step.strip().partition(":")
+        steps.append((float("inf") if limit.strip() == "*" else float(limit), max(1, int(beam))))
+    steps.sort()
+    if not steps or steps[-1][0] != float("inf"):
+        steps.append((float("inf"), steps[-1][1] if steps else 5))
+    return steps
+
+
+def run_once(runner, audio, **options):
+    start = time.perf_counter()
+    segments, _ = runner.transcribe(audio, vad_filter=True, vad_parameters=dict(VAD_PARAMETERS), **options)
+    text = " ".join(seg.text.strip() for seg in segments)
+    return time.perf_counter() - start, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("files", nargs="+", help="audio files (OGG/Opus voice notes, WAV, MP3...)")
+    parser.add_argument("--model", default=os.getenv("WHISPER_MODEL_SIZE", "small"))
+    parser.add_argument("--compute-type", default=os.getenv("WHISPER_COMPUTE_TYPE", "int8"))
+    parser.add_argument("--cpu-threads", type=int, default=int(os.getenv("WHISPER_CPU_THREADS", "0")))
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("WHISPER_BATCH_SIZE", "8")))
+    parser.add_argument("--beam-schedule", default=os.getenv("WHISPER_BEAM_SCHEDULE", "30:5,120:3,*:1"))
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per mode (median is reported)")
+    args = parser.parse_args()
+
+    steps = parse_beam_schedule(args.beam_schedule)
+    model = WhisperModel(args.model, device="cpu", compute_type=args.compute_type, cpu_threads=args.cpu_threads)
+    batched = BatchedInferencePipeline(model=model) if BatchedInferencePipeline is not None else None
+    if batched is None:
+        print("faster-whisper < 1.1: BatchedInferencePipeline unavailable, skipping the batched mode", file=sys.stderr)
+
+    print(f"model={args.model} compute_type={args.compute_type} cpu_threads={args.cpu_threads} "
+          f"batch_size={args.batch_size} beam_schedule={args.beam_schedule} repeat={args.repeat}")
+    print(f"{'file':<28} {'audio s':>8} {'mode':<14} {'beam':>4} {'proc s':>8} {'RTF':>7} {'speed-up':>8}")
+
+    sampling_rate = model.feature_extractor.sampling_rate
+    for path in args.files:
+        with open(path, "rb") as f:
+            audio = decode_audio(io.BytesIO(f.read()), sampling_rate=sampling_rate)
+        duration = len(audio) / sampling_rate
+        beam = next(b for limit, b in steps if duration <= limit)
+        modes = [("sequential-b5", model, dict(beam_size=5)), ("sequential", model, dict(beam_size=beam))]
+        if batched is not None:
+            modes.append(("batched", batched, dict(beam_size=beam, batch_size=args.batch_size)))
+
+        # Untimed warm-up so the first mode does not pay for allocator and cache warm-up
+        run_once(model, audio[:sampling_rate * 10], beam_size=1)
+        baseline = None
+        for name, runner, options in modes:
+            elapsed = statistics.median(run_once(runner, audio, **options)[0] for _ in range(max(1, args.repeat)))
+            baseline = baseline or elapsed
+            rtf = elapsed / duration if duration else float("nan")
+            print(f"{os.path.basename(path)[:28]:<28} {duration:>8.1f} {name:<14} {options['beam_size']:>4} "
+                  f"{elapsed:>8.2f} {rtf:>7.3f} {baseline / elapsed:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ sudo chown -R $USER:$USER $INSTALL_DIR
 
 echo "[2/5] Copying service files..."
 cp transcribe_service.py $INSTALL_DIR/
+cp benchmark_rtf.py $INSTALL_DIR/
 cp requirements.txt $INSTALL_DIR/
 cp shepherd-transcribe.service $INSTALL_DIR/
 
@@ -0,0 +1,235 @@
+"""
+Verification Suite for the Shepherd AI Transcription Service
+Runs without faster-whisper or a model download: a stand-in faster_whisper module
+(1 byte of audio = 0.1 s) is installed before transcribe_service is imported.
+
+    python -m pytest -q test_transcribe_service.py
+"""
+import asyncio
+import os
+import sys
+import threading
+import types
+import unittest
+from types import SimpleNamespace
+
+# Small queue, no warm-up and a known key, fixed before the service module reads its settings
+os.environ.update({
+    "TRANSCRIBE_SERVICE_KEY": "test-key",
+    "WHISPER_MODEL_SIZE": "small",
+    "WHISPER_FAST_MODEL_SIZE": "",
+    "WHISPER_WARMUP": "false",
+    "WHISPER_NUM_WORKERS": "1",
+    "INFERENCE_QUEUE_SIZE": "1",
+    "TRANSCRIPT_CACHE_DIR": "",
+})
+os.environ.pop("TRANSCRIPT_CACHE_SIZE", None)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLING_RATE = 16000
+# Cleared by a test to hold every decode on the inference thread until it is set again
+decode_gate = threading.Event()
+decode_gate.set()
+
+
+def _install_fake_faster_whisper():
+    fake = types.ModuleType("faster_whisper")
+
+    class Audio:
+        def __init__(self, samples: int):
+            self.samples = samples
+
+        def __len__(self):
+            return self.samples
+
+    def decode_audio(file, sampling_rate=SAMPLING_RATE):
+        return Audio(len(file.read()) * sampling_rate // 10)
+
+    def result(audio, text, options):
+        seconds = len(audio) / SAMPLING_RATE
+        segments = iter([SimpleNamespace(text=f" {text} {seconds:.0f}s beam={options['beam_size']} ", avg_logprob=-0.2)])
+        info = SimpleNamespace(language=options.get("language") or "en", language_probability=0.95, duration=seconds)
+        return segments, info
+
+    class WhisperModel:
+        supported_languages = ["en", "yo", "ha", "ig"]
+
+        def __init__(self, size, **kwargs):
+            self.size = size
+            self.feature_extractor = SimpleNamespace(sampling_rate=SAMPLING_RATE)
+
+        def transcribe(self, audio, **options):
+            decode_gate.wait(10)
+            return result(audio, self.size, options)
+
+    class BatchedInferencePipeline:
+        def __init__(self, model):
+            self.model = model
+
+        def transcribe(self, audio, batch_size=8, **options):
+            decode_gate.wait(10)
+            return result(audio, f"batched bs={batch_size}", options)
+
+    fake.decode_audio = decode_audio
+    fake.WhisperModel = WhisperModel
+    fake.BatchedInferencePipeline = BatchedInferencePipeline
+    sys.modules["faster_whisper"] = fake
+
+
+_install_fake_faster_whisper()
+
+import httpx  # noqa: E402
+import transcribe_service  # noqa: E402
+
+HEADERS = {"X-Api-Key": "test-key"}
+
+
+def _client() -> httpx.AsyncClient:
+    # One event loop for requests and the background job tasks they spawn
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=transcribe_service.app), base_url="http://service")
+
+
+async def _wait_for(predicate, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not reached in time")
+        await asyncio.sleep(0.01)
+
+
+class TestTranscriptionService(unittest.TestCase):
+
+    def setUp(self):
+        decode_gate.set()
+        transcribe_service.transcript_cache._memory.clear()
+        transcribe_service._in_progress.clear()
+
+    def test_01_full_queue_answers_503_with_retry_after(self):
+        """Verify uploads beyond workers + queue size are turned away with a Retry-After estimate."""
+        queue = transcribe_service.inference_queue
+        self.assertEqual(queue.capacity, 2)
+        admitted = 0
+        while queue.try_admit():
+            admitted += 1
+
+        async def submit():
+            async with _client() as client:
+                sync = await client.post("/transcribe", files={"file": ("a.ogg", b"q" * 30)}, headers=HEADERS)
+                job = await client.post("/jobs", files={"file": ("b.ogg", b"r" * 30)}, headers=HEADERS)
+                return sync, job
+
+        try:
+            sync, job = asyncio.run(submit())
+        finally:
+            for _ in range(admitted):
+                queue.release()
+        for response in (sync, job):
+            self.assertEqual(response.status_code, 503)
+            self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+        self.assertEqual(queue.stats()["in_flight"], 0)
+        self.assertGreaterEqual(queue.stats()["rejected"], 2)
+        print("[PASSED] Test 1: Full inference queue answers 503 with Retry-After.")
+
+    def test_02_cancelled_in_flight_transcription_readmits_waiting_job(self):
+        """Verify a job sharing an upload whose transcription is cancelled takes a slot and transcribes it itself."""
+        content = b"s" * 50
+        cache_key = transcribe_service.transcript_cache.key(content)
+        queue = transcribe_service.inference_queue
+
+        async def scenario():
+            decode_gate.clear()
+            self.assertTrue(queue.try_admit())
+            first = asyncio.create_task(transcribe_service._run_inference(content, cache_key))
+            await _wait_for(lambda: cache_key in transcribe_service._in_progress)
+            async with _client() as client:
+                submitted = await client.post("/jobs", files={"file": ("n.ogg", content)}, headers=HEADERS)
+                # The identical upload waits on the in-flight result instead of taking a slot
+                self.assertEqual(queue.stats()["in_flight"], 1)
+                first.cancel()
+                await asyncio.gather(first, return_exceptions=True)
+                await _wait_for(lambda: queue.stats()["in_flight"] == 1)
+                decode_gate.set()
+                job_id = submitted.json()["job_id"]
+                await _wait_for(lambda: transcribe_service.transcription_jobs.get(job_id)["status"] in ("done", "failed"))
+                return submitted, (await client.get(f"/jobs/{job_id}", headers=HEADERS)).json()
+
+        try:
+            submitted, job = asyncio.run(scenario())
+        finally:
+            decode_gate.set()
+        self.assertEqual(submitted.status_code, 202)
+        self.assertEqual(job["status"], "done")
+        self.assertFalse(job["result"]["cached"])
+        self.assertIn("5s", job["result"]["text"])
+        self.assertEqual(queue.stats()["in_flight"], 0)
+        print("[PASSED] Test 2: Cancelled in-flight transcription re-admits the waiting job.")
+
+    def test_03_long_notes_take_the_batched_path(self):
+        """Verify long notes go through the batched pipeline with a narrower beam, short ones stay sequential."""
+        async def transcribe(content):
+            async with _client() as client:
+                response = await client.post("/transcribe", files={"file": ("n.ogg", content)}, headers=HEADERS)
+                return response.json()
+
+        short = asyncio.run(transcribe(b"a" * 50))
+        long = asyncio.run(transcribe(b"b" * 900))
+        self.assertEqual((short["mode"], short["duration_seconds"]), ("sequential", 5.0))
+        self.assertIn("beam=5", short["text"])
+        self.assertEqual((long["mode"], long["duration_seconds"]), ("batched", 90.0))
+        self.assertIn(f"bs={transcribe_service.BATCH_SIZE}", long["text"])
+        self.assertIn("beam=3", long["text"])
+        self.assertTrue(asyncio.run(transcribe(b"b" * 900))["cached"])
+        print("[PASSED] Test 3: Long notes take the batched path.")
+
+    def test_04_job_store_purges_expired_jobs(self):
+        """Verify finished jobs expire after the TTL while unfinished ones are kept."""
+        from unittest.mock import patch
+
+        store = transcribe_service.JobStore(ttl=60)
+        finished = store.create(None, {"agent_job_id": "a"})
+        running = store.create(None, None)
+        store.finish(finished, result={"text": "hi"})
+        self.assertIn(store.view(finished)["expires_in"], (59, 60))
+
+        later = transcribe_service.time.time() + 61
+        with patch.object(transcribe_service.time, "time", return_value=later):
+            self.assertIsNone(store.get(finished["id"]))
+            self.assertIs(store.get(running["id"]), running)
+            self.assertEqual(store.stats()["expired"], 1)
+        print("[PASSED] Test 4: Job store TTL purge verified.")
+
+    def test_05_callback_is_signed_with_the_service_key(self):
+        """Verify the job callback carries an HMAC-SHA256 signature of its exact body."""
+        import hashlib
+        import hmac
+        import json
+
+        received = []
+
+        def handler(request):
+            received.append(request)
+            return httpx.Response(200)
+
+        job = transcribe_service.transcription_jobs.create("https://backend.example/callback", {"agent_job_id": "a"})
+        transcribe_service.transcription_jobs.finish(job, result={"text": "hi"})
+
+        async def deliver():
+            transcribe_service._callback_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            try:
+                await transcribe_service._deliver_callback(job)
+            finally:
+                await transcribe_service._callback_client.aclose()
+                transcribe_service._callback_client = None
+
+        asyncio.run(deliver())
+        self.assertEqual(len(received), 1)
+        body = received[0].content
+        expected = "sha256=" + hmac.new(b"test-key", body, hashlib.sha256).hexdigest()
+        self.assertTrue(hmac.compare_digest(received[0].headers["X-Transcribe-Signature"], expected))
+        self.assertEqual(json.loads(body)["metadata"], {"agent_job_id": "a"})
+        self.assertNotEqual(transcribe_service._sign(body + b" "), expected)
+        print("[PASSED] Test 5: Callback signing verified.")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,17 +2,63 @@
 Shepherd AI Transcription Microservice
 Powered by faster-whisper on CPU (int8 quantization)
 Handles OGG/Opus directly with zero external ffmpeg dependencies.
+
+Inference runs on a pool of WHISPER_NUM_WORKERS threads sharing one model, so the
+event loop (and /health) stays responsive while voice notes are transcribed.
+At most WHISPER_NUM_WORKERS + INFERENCE_QUEUE_SIZE requests are admitted at once;
+beyond that /transcribe answers 503 with a Retry-After estimate. Scale with
+WHISPER_NUM_WORKERS / WHISPER_CPU_THREADS rather than uvicorn workers: every
+uvicorn worker would load its own copy of the model.
+
+Results are cached by sha256 of the audio bytes, model and decoding options
+(memory LRU, plus a disk store when TRANSCRIPT_CACHE_DIR is set), and identical
+uploads that arrive while one is being transcribed wait for that result, so a
+forwarded or re-sent voice note is only transcribed once.
+
+Long voice notes (sermons, testimonies) go through faster-whisper's batched
+pipeline: the audio is split at VAD speech boundaries and the chunks are decoded
+in batches of WHISPER_BATCH_SIZE instead of one 30 s window after another. Beam
+width shrinks with duration (WHISPER_BEAM_SCHEDULE) so a ten-minute note is not
+decoded with the beam a ten-second note can afford.
+
+Besides the synchronous POST /transcribe, POST /jobs accepts the audio and returns
+a job id immediately; the result is polled from GET /jobs/{job_id} or POSTed to the
+job's callback_url, signed with the service key. Finished jobs expire after
+JOB_TTL_SECONDS. Jobs live in this process, so a restart loses queued ones.
+
+With WHISPER_FAST_MODEL_SIZE set, clips up to WHISPER_FAST_MAX_SECONDS go to that
+smaller model first and are re-run on WHISPER_MODEL_SIZE only when it is unsure
+(low average log-probability or, without a hint, an uncertain language). Every
+model is loaded and warmed with a dummy decode before the first request. Clients
+may pass a language hint, which skips language detection.
 """
 
+import asyncio
+import hashlib
+import hmac
+import io
+import json
+import math
 import os
 import tempfile
+import threading
 import time
+import uuid
+import wave
 import logging
-from typing import Optional
-from fastapi import FastAPI, UploadFile, File, Header, HTTPException, status
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+import httpx
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, decode_audio
+
+try:
+    from faster_whisper import BatchedInferencePipeline
+except ImportError:  # faster-whisper < 1.1
+    BatchedInferencePipeline = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -37,11 +83,344 @@ app.add_middleware(
 # API Secret Key
 API_KEY = os.getenv("TRANSCRIBE_SERVICE_KEY", "17f187c37b8164bc2f038779fa9ebe886ef771e3f721793e584bd816bf1a8ac5")
 MODEL_SIZE = os.getenv("WHISPER_MODEL_SIZE", "small")
+# Optional small model for short clips (e.g. "base" or "tiny"); empty = every clip uses MODEL_SIZE
+FAST_MODEL_SIZE = os.getenv("WHISPER_FAST_MODEL_SIZE", "").strip()
+FAST_MAX_SECONDS = float(os.getenv("WHISPER_FAST_MAX_SECONDS", "15"))
+# Below either threshold the fast model's transcript is discarded and the clip re-run on MODEL_SIZE
+FAST_MIN_AVG_LOGPROB = float(os.getenv("WHISPER_FAST_MIN_AVG_LOGPROB", "-0.8"))
+FAST_MIN_LANGUAGE_PROBABILITY = float(os.getenv("WHISPER_FAST_MIN_LANGUAGE_PROBABILITY", "0.7"))
+WARMUP_ENABLED = os.getenv("WHISPER_WARMUP", "true").lower() == "true"
 COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+# Concurrent transcriptions (threads sharing the model) and CTranslate2 threads per transcription
+NUM_WORKERS = max(1, int(os.getenv("WHISPER_NUM_WORKERS", "1")))
+CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", "0"))  # 0 = CTranslate2 default
+# Requests allowed to wait for a worker before new ones get 503
+QUEUE_SIZE = max(0, int(os.getenv("INFERENCE_QUEUE_SIZE", "8")))
+# Transcript cache: entries kept in memory (0 disables), optional disk store and its entry cap
+CACHE_SIZE = max(0, int(os.getenv("TRANSCRIPT_CACHE_SIZE", "2048")))
+CACHE_DIR = os.getenv("TRANSCRIPT_CACHE_DIR", "")
+CACHE_DISK_ENTRIES = max(1, int(os.getenv("TRANSCRIPT_CACHE_DISK_ENTRIES", "50000")))
+
+# Batched (VAD-chunked) decoding for notes at least WHISPER_BATCHED_MIN_SECONDS long
+BATCHED_ENABLED = os.getenv("WHISPER_BATCHED", "true").lower() == "true"
+BATCH_SIZE = max(1, int(os.getenv("WHISPER_BATCH_SIZE", "8")))
+BATCHED_MIN_SECONDS = float(os.getenv("WHISPER_BATCHED_MIN_SECONDS", "60"))
+# Beam width by audio duration: "<max seconds>:<beam>,...", "*" matches anything longer
+BEAM_SCHEDULE = os.getenv("WHISPER_BEAM_SCHEDULE", "30:5,120:3,*:1")
+# Asynchronous jobs: how long finished results stay pollable, and callback delivery
+JOB_TTL_SECONDS = max(60, int(os.getenv("JOB_TTL_SECONDS", "3600")))
+CALLBACK_TIMEOUT_SECONDS = float(os.getenv("CALLBACK_TIMEOUT_SECONDS", "10"))
+CALLBACK_ATTEMPTS = max(1, int(os.getenv("CALLBACK_ATTEMPTS", "4")))
+
+TRANSCRIBE_OPTIONS = dict(
+    vad_filter=True,
+    vad_parameters=dict(min_silence_duration_ms=500)
+)
+
+
+def parse_beam_schedule(schedule: str):
+    """"30:5,120:3,*:1" -> [(30.0, 5), (120.0, 3), (inf, 1)]"""
+    steps = []
+    for step in schedule.split(","):
+        limit, _, beam = step.strip().partition(":")
+        steps.append((math.inf if limit.strip() == "*" else float(limit), max(1, int(beam))))
+    steps.sort()
+    if not steps or steps[-1][0] != math.inf:
+        steps.append((math.inf, steps[-1][1] if steps else 5))
+    return steps
+
+
+BEAM_STEPS = parse_beam_schedule(BEAM_SCHEDULE)
+
+
+def beam_size_for(duration: float) -> int:
+    return next(beam for limit, beam in BEAM_STEPS if duration <= limit)
+
+
 
-logger.info(f"🚀 Loading WhisperModel('{MODEL_SIZE}', device='cpu', compute_type='{COMPUTE_TYPE}')...")
-model = WhisperModel(MODEL_SIZE, device="cpu", compute_type=COMPUTE_TYPE)
-logger.info("✅ WhisperModel loaded successfully and ready for requests.")
+def _load_model(size: str) -> WhisperModel:
+    logger.info(
+        f"🚀 Loading WhisperModel('{size}', device='cpu', compute_type='{COMPUTE_TYPE}', "
+        f"cpu_threads={CPU_THREADS}, num_workers={NUM_WORKERS})..."
+    )
+    loaded = WhisperModel(
+        size,
+        device="cpu",
+        compute_type=COMPUTE_TYPE,
+        cpu_threads=CPU_THREADS,
+        num_workers=NUM_WORKERS
+    )
+    logger.info(f"✅ WhisperModel('{size}') loaded.")
+    return loaded
+
+
+def _silent_wav(seconds: float = 1.0, sampling_rate: int = 16000) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sampling_rate)
+        wav.writeframes(b"\x00\x00" * int(seconds * sampling_rate))
+    return buffer.getvalue()
+
+
+def _warm_up(size: str, whisper_model: WhisperModel) -> Optional[float]:
+    """
+    Dummy decode through the same path as a request (PyAV decode, encoder, decoder), so
+    the first voice note does not pay for lazy allocations and cold caches. Returns seconds.
+    """
+    started = time.time()
+    try:
+        sampling_rate = whisper_model.feature_extractor.sampling_rate
+        audio = decode_audio(io.BytesIO(_silent_wav(sampling_rate=sampling_rate)), sampling_rate=sampling_rate)
+        segments, _ = whisper_model.transcribe(audio, beam_size=1, language="en", vad_filter=False)
+        list(segments)
+    except Exception as e:
+        logger.warning(f"⚠️ Warm-up of WhisperModel('{size}') failed: {e}")
+        return None
+    elapsed = time.time() - started
+    logger.info(f"🔥 WhisperModel('{size}') warmed up in {elapsed:.2f}s")
+    return elapsed
+
+
+model = _load_model(MODEL_SIZE)
+fast_model = _load_model(FAST_MODEL_SIZE) if FAST_MODEL_SIZE and FAST_MODEL_SIZE != MODEL_SIZE else None
+warmup_seconds: Dict[str, Optional[float]] = {}
+if WARMUP_ENABLED:
+    warmup_seconds[MODEL_SIZE] = _warm_up(MODEL_SIZE, model)
+    if fast_model is not None:
+        warmup_seconds[FAST_MODEL_SIZE] = _warm_up(FAST_MODEL_SIZE, fast_model)
+SUPPORTED_LANGUAGES = set(getattr(model, "supported_languages", None) or [])
+logger.info("✅ Models ready for requests.")
+
+batched_model = None
+if BATCHED_ENABLED:
+    if BatchedInferencePipeline is None:
+        logger.warning("⚠️ WHISPER_BATCHED is on but this faster-whisper has no BatchedInferencePipeline (needs >= 1.1); long notes decode sequentially")
+    else:
+        # Shares the loaded model's weights; only the decoding loop differs
+        batched_model = BatchedInferencePipeline(model=model)
+        logger.info(f"⚡ Batched inference on for notes >= {BATCHED_MIN_SECONDS:.0f}s (batch_size={BATCH_SIZE}, beams {BEAM_SCHEDULE})")
+
+
+class InferenceQueue:
+    """Admission control in front of the inference thread pool."""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whisper")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+        # Exponential moving average of processing time, for Retry-After
+        self._avg_seconds = 2.0
+
+    def try_admit(self) -> bool:
+        with self._lock:
+            if self._in_flight >= self.capacity:
+                self._rejected += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self, elapsed: Optional[float] = None):
+        with self._lock:
+            self._in_flight -= 1
+            if elapsed is not None:
+                self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to free up: the queue ahead drained by all workers."""
+        with self._lock:
+            return max(1, math.ceil(self._avg_seconds * self._in_flight / self.workers))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "in_flight": self._in_flight,
+                "rejected": self._rejected,
+                "avg_processing_seconds": round(self._avg_seconds, 2),
+            }
+
+
+inference_queue = InferenceQueue(NUM_WORKERS, QUEUE_SIZE)
+
+
+class TranscriptCache:
+    """sha256(model, options, audio) -> transcription result. Memory LRU plus optional disk store."""
+
+    def __init__(self, size: int, directory: str, disk_entries: int):
+        self.size = size
+        self.directory = directory
+        self.disk_entries = disk_entries
+        # Everything that changes the transcript for the same audio: a new policy must not hit old entries
+        decoding = [
+            TRANSCRIBE_OPTIONS, BEAM_STEPS, batched_model is not None and BATCHED_MIN_SECONDS,
+            fast_model is not None and [FAST_MODEL_SIZE, FAST_MAX_SECONDS, FAST_MIN_AVG_LOGPROB, FAST_MIN_LANGUAGE_PROBABILITY]
+        ]
+        self._fingerprint = json.dumps([MODEL_SIZE, COMPUTE_TYPE, decoding], sort_keys=True).encode("utf-8")
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._disk_writes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 or bool(self.directory)
+
+    def key(self, content: bytes, language: Optional[str] = None) -> str:
+        digest = hashlib.sha256(self._fingerprint)
+        digest.update(f"\x00{language or ''}\x00".encode("utf-8"))
+        digest.update(content)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Blocking when the disk store is on; call via asyncio.to_thread."""
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self._hits += 1
+                return result
+        if self.directory:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    result = json.load(f)
+            except (OSError, ValueError):
+                result = None
+            if result is not None:
+                self._remember(key, result)
+                with self._lock:
+                    self._hits += 1
+                return result
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def put(self, key: str, result: Dict[str, Any]):
+        """Blocking when the disk store is on; call via asyncio.to_thread."""
+        self._remember(key, result)
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp name and rename, so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Transcript cache write failed: {e}")
+            return
+        with self._lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % 256 == 0
+        if prune:
+            self._prune_disk()
+
+    def _remember(self, key: str, result: Dict[str, Any]):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)
+
+    def _prune_disk(self):
+        """Drop the oldest files beyond the disk entry cap."""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        if len(files) <= self.disk_entries:
+            return
+        files.sort()
+        for _, path in files[:len(files) - self.disk_entries]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "disk": bool(self.directory),
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+
+transcript_cache = TranscriptCache(CACHE_SIZE, CACHE_DIR, CACHE_DISK_ENTRIES)
+# cache key -> result future of the transcription in progress, shared by identical uploads
+_in_progress: Dict[str, "asyncio.Future"] = {}
+
+
+def _decode(runner, audio, options: Dict[str, Any], **extra):
+    """Run one model or pipeline to completion. Returns (segments, info)."""
+    # The batched pipeline rewrites vad_parameters in place, so every call gets its own copy
+    call_options = dict(options, vad_parameters=dict(options["vad_parameters"]))
+    segments, info = runner.transcribe(audio, **call_options, **extra)
+    return list(segments), info
+
+
+def _fast_result_is_confident(segments, info, language: Optional[str]) -> bool:
+    if segments:
+        avg_logprob = sum(seg.avg_logprob for seg in segments) / len(segments)
+        if avg_logprob < FAST_MIN_AVG_LOGPROB:
+            return False
+    # With a hint the language was not detected, so its probability says nothing
+    return language is not None or info.language_probability >= FAST_MIN_LANGUAGE_PROBABILITY
+
+
+def _transcribe_bytes(content: bytes, language: Optional[str] = None) -> Dict[str, Any]:
+    """Blocking: decode and transcribe on an inference thread. Segments are lazy, so they are consumed here too."""
+    sampling_rate = model.feature_extractor.sampling_rate
+    # Decode once up front: the duration picks the model, the beam and the pipeline, and all accept the waveform
+    audio = decode_audio(io.BytesIO(content), sampling_rate=sampling_rate)
+    duration = len(audio) / sampling_rate
+    beam_size = beam_size_for(duration)
+    options = dict(TRANSCRIBE_OPTIONS, beam_size=beam_size, language=language)
+
+    segments = info = None
+    model_used = MODEL_SIZE
+    mode = "sequential"
+    if fast_model is not None and duration <= FAST_MAX_SECONDS:
+        segments, info = _decode(fast_model, audio, options)
+        if _fast_result_is_confident(segments, info, language):
+            model_used = FAST_MODEL_SIZE
+        else:
+            logger.info(f"↪️ {FAST_MODEL_SIZE} unsure about a {duration:.1f}s clip; re-running on {MODEL_SIZE}")
+            segments = info = None
+    if segments is None:
+        if batched_model is not None and duration >= BATCHED_MIN_SECONDS:
+            mode = "batched"
+            segments, info = _decode(batched_model, audio, options, batch_size=BATCH_SIZE)
+        else:
+            segments, info = _decode(model, audio, options)
+    transcription_list = [seg.text.strip() for seg in segments]
+    return {
+        "text": " ".join(transcription_list).strip(),
+        "language": info.language,
+        "language_probability": info.language_probability,
+        "duration": info.duration,
+        "mode": mode,
+        "beam_size": beam_size,
+        "model": model_used,
+    }
 
 
 @app.get("/health")
@@ -50,16 +429,38 @@ async def health_check():
         "status": "healthy",
         "service": "shepherd-transcribe",
         "model": MODEL_SIZE,
-        "compute_type": COMPUTE_TYPE
+        "fast_model": FAST_MODEL_SIZE if fast_model is not None else None,
+        "fast_max_seconds": FAST_MAX_SECONDS,
+        "warmup_seconds": warmup_seconds,
+        "compute_type": COMPUTE_TYPE,
+        "cpu_threads": CPU_THREADS,
+        "batched": {
+            "enabled": batched_model is not None,
+            "batch_size": BATCH_SIZE,
+            "min_seconds": BATCHED_MIN_SECONDS,
+            "beam_schedule": BEAM_SCHEDULE
+        },
+        "queue": inference_queue.stats(),
+        "cache": transcript_cache.stats(),
+        "jobs": transcription_jobs.stats()
     }
 
 
-@app.post("/transcribe")
-async def transcribe_audio(
-    file: UploadFile = File(...),
-    x_api_key: Optional[str] = Header(None, alias="X-Api-Key")
-):
-    # Verify Authentication
+def _result_payload(result: Dict[str, Any], elapsed: float, cached: bool = False) -> Dict[str, Any]:
+    return {
+        "success": True,
+        "text": result["text"],
+        "language": result["language"],
+        "language_probability": round(result["language_probability"], 2),
+        "duration_seconds": round(result["duration"], 2),
+        "processing_time_seconds": round(elapsed, 2),
+        "mode": result.get("mode", "sequential"),
+        "model": result.get("model", MODEL_SIZE),
+        "cached": cached
+    }
+
+
+def _require_api_key(x_api_key: Optional[str]):
     if not x_api_key or x_api_key != API_KEY:
         logger.warning("⛔ Unauthorized transcription attempt with invalid or missing API Key.")
         raise HTTPException(
@@ -67,64 +468,306 @@ async def transcribe_audio(
             detail="Invalid or missing X-Api-Key header"
         )
 
-    # Determine file extension
-    ext = ".ogg"
-    if file.filename:
-        _, file_ext = os.path.splitext(file.filename)
-        if file_ext:
-            ext = file_ext.lower()
 
-    # Save incoming audio stream to temporary file
-    start_time = time.time()
-    with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-        content = await file.read()
-        tmp.write(content)
-        tmp_path = tmp.name
+def _language_hint(language: Optional[str]) -> Optional[str]:
+    """Validated language hint ("en", "yo", ...); None = detect the language."""
+    language = (language or "").strip().lower()
+    if not language:
+        return None
+    if SUPPORTED_LANGUAGES and language not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unsupported language '{language}'")
+    return language
 
-    file_size_kb = len(content) / 1024
-    logger.info(f"🎙️ Received audio: {file.filename or 'voice.ogg'} ({file_size_kb:.1f} KB)")
 
-    try:
-        # Transcribe with faster-whisper (supports OGG, Opus, WAV, MP3 natively)
-        segments, info = model.transcribe(
-            tmp_path,
-            beam_size=5,
-            vad_filter=True,
-            vad_parameters=dict(min_silence_duration_ms=500)
-        )
+def _queue_full() -> HTTPException:
+    retry_after = inference_queue.retry_after()
+    logger.warning(f"🚦 Inference queue full ({inference_queue.capacity}); asking client to retry in {retry_after}s")
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Transcription queue is full, retry later",
+        headers={"Retry-After": str(retry_after)}
+    )
 
-        transcription_list = [seg.text.strip() for seg in segments]
-        full_text = " ".join(transcription_list).strip()
-        elapsed = time.time() - start_time
 
+async def _run_inference(content: bytes, cache_key: Optional[str], language: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Transcribe admitted audio on the inference pool, cache the result and share it with
+    identical uploads that arrive meanwhile. Releases the caller's admission.
+    """
+    loop = asyncio.get_running_loop()
+    pending = loop.create_future() if cache_key else None
+    if pending is not None:
+        _in_progress[cache_key] = pending
+    started = time.time()
+    elapsed = None
+    try:
+        result = await loop.run_in_executor(inference_queue.executor, _transcribe_bytes, content, language)
+        elapsed = time.time() - started
+        if cache_key:
+            await asyncio.to_thread(transcript_cache.put, cache_key, result)
+        if pending is not None:
+            pending.set_result(result)
         logger.info(
-            f"✅ Transcribed in {elapsed:.2f}s | Language: {info.language} ({info.language_probability:.2f}) | "
-            f"Result: '{full_text[:80]}...'"
+            f"✅ Transcribed {result['duration']:.1f}s of audio in {elapsed:.2f}s "
+            f"({result['model']}, {result['mode']}, beam {result['beam_size']}) | Language: {result['language']} ({result['language_probability']:.2f}) | "
+            f"Result: '{result['text'][:80]}...'"
         )
+        return result
+    except Exception as e:
+        if pending is not None and not pending.done():
+            pending.set_exception(e)
+            # Waiters (if any) handle it; don't warn about an unretrieved exception
+            pending.exception()
+        raise
+    finally:
+        if pending is not None:
+            if not pending.done():
+                pending.cancel()
+            _in_progress.pop(cache_key, None)
+        inference_queue.release(elapsed)
 
-        return JSONResponse(
-            content={
-                "success": True,
-                "text": full_text,
-                "language": info.language,
-                "language_probability": round(info.language_probability, 2),
-                "duration_seconds": round(info.duration, 2),
-                "processing_time_seconds": round(elapsed, 2)
-            }
-        )
 
+async def _await_shared(shared: "asyncio.Future") -> Optional[Dict[str, Any]]:
+    """
+    Result of an identical in-flight transcription. None when that transcription was
+    cancelled before finishing, so the caller transcribes the audio itself.
+    """
+    try:
+        return await asyncio.shield(shared)
+    except asyncio.CancelledError:
+        if shared.cancelled():
+            return None
+        raise
+
+
+@app.post("/transcribe")
+async def transcribe_audio(
+    file: UploadFile = File(...),
+    language: Optional[str] = Form(None),
+    x_api_key: Optional[str] = Header(None, alias="X-Api-Key")
+):
+    _require_api_key(x_api_key)
+    language = _language_hint(language)
+
+    start_time = time.time()
+    # Decode straight from the uploaded bytes (PyAV reads OGG, Opus, WAV, MP3 from a file object)
+    content = await file.read()
+    file_size_kb = len(content) / 1024
+    logger.info(f"🎙️ Received audio: {file.filename or 'voice.ogg'} ({file_size_kb:.1f} KB, language={language or 'auto'})")
+
+    cache_key = transcript_cache.key(content, language) if transcript_cache.enabled else None
+    if cache_key:
+        cached = await asyncio.to_thread(transcript_cache.get, cache_key)
+        if cached is None and cache_key in _in_progress:
+            # The same audio is being transcribed right now: share that result
+            try:
+                cached = await _await_shared(_in_progress[cache_key])
+            except Exception:
+                cached = None
+        if cached is not None:
+            logger.info(f"♻️ Transcript cache hit ({file_size_kb:.1f} KB): '{cached['text'][:80]}'")
+            return JSONResponse(content=_result_payload(cached, time.time() - start_time, cached=True))
+
+    if not inference_queue.try_admit():
+        raise _queue_full()
+    try:
+        result = await _run_inference(content, cache_key, language)
     except Exception as e:
         logger.error(f"❌ Transcription error: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Transcription failed: {str(e)}"
         )
-    finally:
-        if os.path.exists(tmp_path):
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
+    return JSONResponse(content=_result_payload(result, time.time() - start_time))
+
+
+class JobStore:
+    """Asynchronous transcription jobs by id. Finished jobs are kept for JOB_TTL_SECONDS."""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._expired = 0
+
+    def create(self, callback_url: Optional[str], metadata: Optional[Any]) -> Dict[str, Any]:
+        self.purge()
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": now,
+            "finished_at": None,
+            "expires_at": now + self.ttl,
+            "callback_url": callback_url,
+            "metadata": metadata,
+            "result": None,
+            "error": None,
+        }
+        self._jobs[job["id"]] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        self.purge()
+        return self._jobs.get(job_id)
+
+    def finish(self, job: Dict[str, Any], result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        job["finished_at"] = time.time()
+        job["expires_at"] = job["finished_at"] + self.ttl
+        job["status"] = "done" if error is None else "failed"
+        job["result"] = result
+        job["error"] = error
+
+    def purge(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items() if job["finished_at"] and job["expires_at"] <= now]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self._expired += len(expired)
+
+    def view(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """Public representation, also the callback body."""
+        view = {
+            "job_id": job["id"],
+            "status": job["status"],
+            "created_at": job["created_at"],
+            "finished_at": job["finished_at"],
+            "expires_in": max(0, int(job["expires_at"] - time.time())) if job["finished_at"] else None,
+            "metadata": job["metadata"],
+        }
+        if job["result"] is not None:
+            view["result"] = job["result"]
+        if job["error"] is not None:
+            view["error"] = job["error"]
+        return view
+
+    def stats(self) -> Dict[str, Any]:
+        self.purge()
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"ttl_seconds": self.ttl, "by_status": counts, "expired": self._expired}
+
+
+transcription_jobs = JobStore(JOB_TTL_SECONDS)
+_callback_client: Optional[httpx.AsyncClient] = None
+# Strong references to running job tasks (the loop only keeps weak ones)
+_job_tasks = set()
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+
+
+def _sign(body: bytes) -> str:
+    return "sha256=" + hmac.new(API_KEY.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+async def _deliver_callback(job: Dict[str, Any]):
+    """POST the finished job to its callback URL, signed with the service key. Retried with backoff."""
+    global _callback_client
+    if _callback_client is None:
+        _callback_client = httpx.AsyncClient(timeout=CALLBACK_TIMEOUT_SECONDS)
+    body = json.dumps(transcription_jobs.view(job)).encode("utf-8")
+    headers = {"Content-Type": "application/json", "X-Transcribe-Signature": _sign(body)}
+    for attempt in range(1, CALLBACK_ATTEMPTS + 1):
+        try:
+            response = await _callback_client.post(job["callback_url"], content=body, headers=headers)
+            if response.status_code < 500:
+                if response.status_code >= 400:
+                    logger.warning(f"📮 Callback for job {job['id']} rejected: HTTP {response.status_code}")
+                return
+            error = f"HTTP {response.status_code}"
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+        if attempt < CALLBACK_ATTEMPTS:
+            await asyncio.sleep(2 ** (attempt - 1))
+    logger.warning(f"📮 Callback for job {job['id']} failed after {CALLBACK_ATTEMPTS} attempts ({error}); result stays pollable")
+
+
+async def _run_job(
+    job: Dict[str, Any],
+    content: bytes,
+    cache_key: Optional[str],
+    shared: Optional["asyncio.Future"],
+    language: Optional[str]
+):
+    """Background task behind POST /jobs: transcribe (or wait for an identical upload), then call back."""
+    job["status"] = "running"
+    started = time.time()
+    try:
+        result = await _await_shared(shared) if shared is not None else None
+        if result is not None:
+            payload = _result_payload(result, time.time() - started, cached=True)
+        else:
+            # The shared transcription was cancelled: this job was never admitted, so take a slot now
+            if shared is not None and not inference_queue.try_admit():
+                raise RuntimeError("inference queue is full, resubmit later")
+            result = await _run_inference(content, cache_key, language)
+            payload = _result_payload(result, time.time() - started)
+        transcription_jobs.finish(job, result=payload)
+    except Exception as e:
+        logger.error(f"❌ Transcription job {job['id']} failed: {e}", exc_info=True)
+        transcription_jobs.finish(job, error=f"Transcription failed: {e}")
+    if job["callback_url"]:
+        await _deliver_callback(job)
+
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(
+    file: UploadFile = File(...),
+    callback_url: Optional[str] = Form(None),
+    metadata: Optional[str] = Form(None),
+    language: Optional[str] = Form(None),
+    x_api_key: Optional[str] = Header(None, alias="X-Api-Key")
+):
+    """
+    Queue a transcription and return its job id at once. The result is fetched from
+    GET /jobs/{job_id} or POSTed to callback_url (signed X-Transcribe-Signature:
+    sha256=HMAC(service key, body)); metadata (JSON) is echoed back with it.
+    """
+    _require_api_key(x_api_key)
+    language = _language_hint(language)
+    try:
+        job_metadata = json.loads(metadata) if metadata else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="metadata must be JSON")
+    if callback_url and not callback_url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="callback_url must be an http(s) URL")
+
+    content = await file.read()
+    cache_key = transcript_cache.key(content, language) if transcript_cache.enabled else None
+    cached = await asyncio.to_thread(transcript_cache.get, cache_key) if cache_key else None
+    shared = _in_progress.get(cache_key) if cache_key and cached is None else None
+    # Jobs take an inference slot like /transcribe does, so a flood of submissions still gets 503
+    if cached is None and shared is None and not inference_queue.try_admit():
+        raise _queue_full()
+
+    job = transcription_jobs.create(callback_url, job_metadata)
+    if cached is not None:
+        transcription_jobs.finish(job, result=_result_payload(cached, 0.0, cached=True))
+        if callback_url:
+            _spawn(_deliver_callback(job))
+    else:
+        _spawn(_run_job(job, content, cache_key, shared, language))
+    logger.info(f"📥 Job {job['id']} accepted ({len(content) / 1024:.1f} KB, {job['status']}, callback={'yes' if callback_url else 'no'})")
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=transcription_jobs.view(job))
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, x_api_key: Optional[str] = Header(None, alias="X-Api-Key")):
+    _require_api_key(x_api_key)
+    job = transcription_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown or expired job")
+    return transcription_jobs.view(job)
+
+
+@app.on_event("shutdown")
+async def close_callback_client():
+    if _callback_client is not None:
+        await _callback_client.aclose()
 
 
 if __name__ == "__main__":